@@ -0,0 +1,534 @@
+"""Asyncio runtime, an alternative to the thread based `Updater` used by `bot.run`.
+
+Requests to Telegram are made through a single tornado `AsyncHTTPClient`, already a dependency of
+python-telegram-bot 13, so waiting on the network doesn't hold a thread and the number of users
+served at once isn't limited by the size of a thread pool.
+
+Database work, including persistence, runs in a single worker thread: it's CPU bound, so more
+threads wouldn't make it faster, and the persistence never sees changes made halfway.
+"""
+import asyncio
+import json
+import logging
+import signal
+import tempfile
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, Any, Awaitable, Callable, Dict, List, Optional, Set, TypeVar
+
+import telegram
+from telegram.ext import BasePersistence
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+
+from . import bot, importer, metrics, parser
+from .db import DB, MESSAGE_INDEX_SIZE, History
+from .errors import UserError
+from .models import Action
+from .persistence import IncrementalPersistence
+from .sqlite import SQLiteDB, SQLiteStorage
+
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+# Telegram API
+
+
+API_URL = 'https://api.telegram.org/bot{token}/{method}'
+FILE_URL = 'https://api.telegram.org/file/bot{token}/{path}'
+
+# Requests to Telegram running at the same time, the rest wait in a queue
+MAX_CLIENTS = 100
+
+REQUEST_TIMEOUT = 30
+POLL_TIMEOUT = 30
+RETRY_DELAY = 5
+
+UPLOAD_CHUNK_SIZE = 2**16
+DOWNLOAD_TIMEOUT = 300
+
+
+class TelegramError(Exception):
+    pass
+
+
+class TelegramAPI:
+    """Calls the Bot API methods, all of them share the same HTTP client."""
+
+    def __init__(
+        self,
+        token: str,
+        url: str = API_URL,
+        max_clients: int = MAX_CLIENTS,
+        file_url: str = FILE_URL,
+    ):
+        self.token = token
+        self.url = url
+        self.file_url = file_url
+        self.client = AsyncHTTPClient(force_instance=True, max_clients=max_clients)
+
+    async def call(self, method: str, request_timeout: float = REQUEST_TIMEOUT, **params) -> Any:
+        request = HTTPRequest(
+            self.url.format(token=self.token, method=method),
+            method='POST',
+            headers={'Content-Type': 'application/json'},
+            body=json.dumps({k: v for k, v in params.items() if v is not None}),
+            request_timeout=request_timeout,
+        )
+        return await self.fetch(request)
+
+    async def send_document(self, chat_id: int, file: IO[bytes], filename: str) -> Any:
+        """Uploads a file, reading it in chunks instead of loading it whole."""
+        boundary = uuid.uuid4().hex
+        head = (
+            f'--{boundary}\r\n'
+            'Content-Disposition: form-data; name="chat_id"\r\n\r\n'
+            f'{chat_id}\r\n'
+            f'--{boundary}\r\n'
+            f'Content-Disposition: form-data; name="document"; filename="{filename}"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n'
+        ).encode('utf-8')
+        tail = f'\r\n--{boundary}--\r\n'.encode('utf-8')
+
+        file.seek(0, 2)
+        size = file.tell()
+        file.seek(0)
+
+        async def body_producer(write: Callable[[bytes], Awaitable[None]]):
+            await write(head)
+            while True:
+                chunk = file.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                await write(chunk)
+            await write(tail)
+
+        request = HTTPRequest(
+            self.url.format(token=self.token, method='sendDocument'),
+            method='POST',
+            headers={
+                'Content-Type': f'multipart/form-data; boundary={boundary}',
+                'Content-Length': str(len(head) + size + len(tail)),
+            },
+            body_producer=body_producer,
+            request_timeout=REQUEST_TIMEOUT,
+        )
+        return await self.fetch(request)
+
+    async def download(self, file_id: str, file: IO[bytes]):
+        """Downloads a file sent to the bot, writing it in chunks as they arrive."""
+        info = await self.call('getFile', file_id=file_id)
+        request = HTTPRequest(
+            self.file_url.format(token=self.token, path=info['file_path']),
+            streaming_callback=file.write,
+            request_timeout=DOWNLOAD_TIMEOUT,
+        )
+        response = await self.client.fetch(request, raise_error=False)
+        if response.code != 200:
+            raise TelegramError(f'Download failed: {response.error}')
+
+    async def fetch(self, request: HTTPRequest) -> Any:
+        method = request.url.split('/')[-1]
+        histogram = metrics.registry.histogram(
+            'beanbot_telegram_seconds', 'Time spent calling the Telegram API', method=method
+        )
+        with histogram.timer():
+            response = await self.client.fetch(request, raise_error=False)
+        if not response.body:
+            raise TelegramError(f'{method} failed: {response.error}')
+
+        data = json.loads(response.body)
+        if not data.get('ok'):
+            raise TelegramError(data.get('description') or 'Unknown error')
+        return data['result']
+
+    def close(self):
+        self.client.close()
+
+
+# Runtime
+
+
+class Runtime:
+    def __init__(
+        self,
+        api: TelegramAPI,
+        persistence: Optional[BasePersistence] = None,
+        storage: Optional[SQLiteStorage] = None,
+        message_index_size: int = MESSAGE_INDEX_SIZE,
+        flush_interval: float = 0,
+    ):
+        self.api = api
+        self.persistence = persistence
+        self.storage = storage
+        self.message_index_size = message_index_size
+        self.flush_interval = flush_interval
+
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='beanbot-db')
+        self.user_data: Dict[int, Dict[str, Any]] = (
+            persistence.get_user_data() if persistence is not None else defaultdict(dict)
+        )
+
+        # Updates of the same user are handled one at a time, in order. A lock is dropped when
+        # no update of its user is left, so there aren't locks for every user ever seen.
+        self.locks: Dict[int, asyncio.Lock] = {}
+        self.pending: Counter[int] = Counter()
+        self.tasks: Set[asyncio.Task] = set()
+
+    def open_db(self, user_id: int) -> DB:
+        if self.storage is not None:
+            history = self.user_data[user_id].setdefault('history', History())
+            return SQLiteDB(self.storage, user_id, self.message_index_size, history)
+        user_data = self.user_data[user_id]
+        if self.persistence is not None:
+            self.persistence.refresh_user_data(user_id, user_data)
+        return DB(user_data, self.message_index_size)
+
+    async def run_db(self, user_id: int, fn: Callable[..., T], *args) -> T:
+        """Calls `fn(db, *args)` in the database thread."""
+
+        def call():
+            return fn(self.open_db(user_id), *args)
+
+        return await self.run_in_executor(call)
+
+    async def run_in_executor(self, fn: Callable[..., T], *args) -> T:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def poll(self):
+        """Gets updates from Telegram until cancelled, each one is handled in its own task."""
+        offset = None
+        while True:
+            try:
+                updates = await self.api.call(
+                    'getUpdates',
+                    request_timeout=POLL_TIMEOUT + REQUEST_TIMEOUT,
+                    offset=offset,
+                    timeout=POLL_TIMEOUT,
+                    allowed_updates=['message', 'edited_message', 'callback_query'],
+                )
+            except TelegramError as ex:
+                logger.warning('Failed to get updates: %s', ex)
+                await asyncio.sleep(RETRY_DELAY)
+                continue
+
+            for data in updates:
+                offset = data['update_id'] + 1
+                self.schedule(data)
+
+    def schedule(self, data: Dict[str, Any]) -> asyncio.Task:
+        task = asyncio.get_running_loop().create_task(self.process_update(data))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def process_update(self, data: Dict[str, Any]):
+        update = telegram.Update.de_json(data, None)
+        user = update.effective_user
+        if user is None:
+            return
+
+        lock = self.locks.setdefault(user.id, asyncio.Lock())
+        self.pending[user.id] += 1
+        try:
+            async with lock:
+                try:
+                    await self.dispatch(update)
+                except Exception as error:
+                    await self.reply_error(update, error)
+                finally:
+                    if self.persistence is not None:
+                        await self.run_in_executor(self.update_persistence, user.id)
+        finally:
+            self.pending[user.id] -= 1
+            if not self.pending[user.id]:
+                del self.pending[user.id]
+                del self.locks[user.id]
+
+    def update_persistence(self, user_id: int):
+        self.persistence.update_user_data(user_id, self.user_data[user_id])
+
+    async def dispatch(self, update: telegram.Update):
+        if update.callback_query is not None:
+            await handle_inline_button(self, update)
+            return
+
+        if update.message is not None and update.message.document is not None:
+            await handle_document(self, update)
+            return
+
+        message = update.effective_message
+        if message is None or not message.text:
+            return
+
+        if message.text.startswith('/'):
+            command, *args = message.text.split()
+            handler = COMMANDS.get(command[1:].split('@')[0])
+            if handler is not None:
+                await handler(self, update, args)
+                return
+
+        if update.message is not None:
+            await handle_text_message(self, update)
+
+    async def reply_error(self, update: telegram.Update, error: Exception):
+        text = bot.describe_error(update, error)
+        if update.effective_message is None:
+            return
+        try:
+            await self.send_message(update.effective_message.chat_id, text)
+        except TelegramError as ex:
+            logger.warning('Failed to reply with an error: %s', ex)
+
+    async def send_message(self, chat_id: int, text: str, **params) -> Any:
+        return await self.api.call('sendMessage', chat_id=chat_id, text=text, **params)
+
+    async def flush_periodically(self):
+        """Writes the pending changes every `flush_interval` seconds."""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.run_in_executor(self.persistence.flush_dirty)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        poll = loop.create_task(self.poll())
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, poll.cancel)
+
+        flush = None
+        if isinstance(self.persistence, IncrementalPersistence) and self.flush_interval > 0:
+            flush = loop.create_task(self.flush_periodically())
+
+        try:
+            await poll
+        except asyncio.CancelledError:
+            pass
+        finally:
+            if flush is not None:
+                flush.cancel()
+            await self.stop()
+
+    async def stop(self):
+        if self.tasks:
+            await asyncio.wait(list(self.tasks))
+        if self.persistence is not None:
+            await self.run_in_executor(self.persistence.flush)
+        self.executor.shutdown()
+        self.api.close()
+
+
+# Handlers, the same as the ones in `bot` but waiting on Telegram instead of blocking
+
+
+Handler = Callable[[Runtime, telegram.Update, List[str]], Awaitable[None]]
+
+
+@bot.timed_handler
+async def handle_start_command(runtime: Runtime, update: telegram.Update, args: List[str]):
+    await runtime.send_message(update.message.chat_id, bot.START_MESSAGE)
+
+
+@bot.timed_handler
+async def handle_json_command(runtime: Runtime, update: telegram.Update, args: List[str]):
+    file, filename = await runtime.run_db(update.effective_user.id, bot.export_json, args)
+    with file:
+        await runtime.api.send_document(update.message.chat_id, file, filename)
+
+
+@bot.timed_handler
+async def handle_beancount_command(runtime: Runtime, update: telegram.Update, args: List[str]):
+    file, filename = await runtime.run_db(update.effective_user.id, bot.export_beancount, args)
+    with file:
+        await runtime.api.send_document(update.message.chat_id, file, filename)
+
+
+@bot.timed_handler
+async def handle_clear_command(runtime: Runtime, update: telegram.Update, args: List[str]):
+    await runtime.run_db(update.effective_user.id, DB.clear)
+    await runtime.send_message(update.message.chat_id, 'Cleared!')
+
+
+@bot.timed_handler
+async def handle_config_command(runtime: Runtime, update: telegram.Update, args: List[str]):
+    msg = update.effective_message
+    if not args:
+        await runtime.send_message(msg.chat_id, bot.CONFIG_USAGE)
+        return
+
+    text = await runtime.run_db(update.effective_user.id, bot.configure, args)
+    await runtime.send_message(msg.chat_id, text)
+
+
+@bot.timed_handler
+async def handle_report_command(runtime: Runtime, update: telegram.Update, args: List[str]):
+    text = await runtime.run_db(update.effective_user.id, bot.report, args)
+    await runtime.send_message(
+        update.message.chat_id, text, parse_mode=telegram.ParseMode.MARKDOWN_V2
+    )
+
+
+@bot.timed_handler
+async def handle_search_command(runtime: Runtime, update: telegram.Update, args: List[str]):
+    text = await runtime.run_db(update.effective_user.id, bot.search, args)
+    await runtime.send_message(
+        update.message.chat_id, text, parse_mode=telegram.ParseMode.MARKDOWN_V2
+    )
+
+
+@bot.timed_handler
+async def handle_undo_command(runtime: Runtime, update: telegram.Update, args: List[str]):
+    text, edits = await runtime.run_db(update.effective_user.id, bot.undo)
+    await edit_messages(runtime, update.message.chat_id, edits)
+    await runtime.send_message(update.message.chat_id, text)
+
+
+@bot.timed_handler
+async def handle_redo_command(runtime: Runtime, update: telegram.Update, args: List[str]):
+    text, edits = await runtime.run_db(update.effective_user.id, bot.undo, True)
+    await edit_messages(runtime, update.message.chat_id, edits)
+    await runtime.send_message(update.message.chat_id, text)
+
+
+async def edit_messages(runtime: Runtime, chat_id: int, edits: List[bot.MessageEdit]):
+    for message_id, text, keyboard in edits:
+        try:
+            await runtime.api.call(
+                'editMessageText',
+                chat_id=chat_id,
+                message_id=message_id,
+                text=text,
+                parse_mode=telegram.ParseMode.MARKDOWN_V2,
+                reply_markup=keyboard.to_dict(),
+            )
+        except TelegramError as error:
+            # The message was deleted, or already shows the same
+            logger.warning('Failed to edit message %s: %s', message_id, error)
+
+
+COMMANDS: Dict[str, Handler] = {
+    'start': handle_start_command,
+    'json': handle_json_command,
+    'beancount': handle_beancount_command,
+    'clear': handle_clear_command,
+    'config': handle_config_command,
+    'report': handle_report_command,
+    'search': handle_search_command,
+    'undo': handle_undo_command,
+    'redo': handle_redo_command,
+}
+
+
+@bot.timed_handler
+async def handle_text_message(runtime: Runtime, update: telegram.Update):
+    chat_id = update.message.chat_id
+    try:
+        event = parser.parse_message(update.message.text)
+    except UserError as ex:
+        await runtime.send_message(chat_id, str(ex))
+        return
+
+    def process(db: DB):
+        tx, posting = db.process_event(event)
+        return (tx, posting, *bot.render(db, tx, posting))
+
+    user_id = update.effective_user.id
+    tx, posting, tx_string, keyboard = await runtime.run_db(user_id, process)
+
+    message = await runtime.send_message(
+        chat_id,
+        tx_string,
+        parse_mode=telegram.ParseMode.MARKDOWN_V2,
+        reply_markup=keyboard.to_dict(),
+    )
+
+    await runtime.run_db(user_id, DB.update_message_index, message['message_id'], tx, posting)
+
+
+@bot.timed_handler
+async def handle_document(runtime: Runtime, update: telegram.Update):
+    chat_id = update.message.chat_id
+    document = update.message.document
+    importer.file_format(document.file_name, document.file_size)  # Raises if it can't be read
+    message_id = (await runtime.send_message(chat_id, 'Importing...'))['message_id']
+
+    # Called from the database thread, the edits are sent meanwhile
+    loop = asyncio.get_running_loop()
+    edits = []
+
+    def progress(count: int):
+        edit = edit_text(runtime, chat_id, message_id, importer.format_progress(count))
+        edits.append(asyncio.run_coroutine_threadsafe(edit, loop))
+
+    with tempfile.TemporaryFile() as file:
+        await runtime.api.download(document.file_id, file)
+        file.seek(0)
+        text = await runtime.run_db(
+            update.effective_user.id, bot.import_file, file, document.file_name, progress
+        )
+    # So the summary isn't replaced by a late one
+    await asyncio.gather(*map(asyncio.wrap_future, edits))
+    await edit_text(runtime, chat_id, message_id, text)
+
+
+async def edit_text(runtime: Runtime, chat_id: int, message_id: int, text: str):
+    try:
+        await runtime.api.call(
+            'editMessageText', chat_id=chat_id, message_id=message_id, text=text
+        )
+    except TelegramError as error:
+        logger.warning('Failed to edit message %s: %s', message_id, error)
+
+
+@bot.timed_handler
+async def handle_inline_button(runtime: Runtime, update: telegram.Update):
+    query = update.callback_query
+    event = parser.parse_keyboard_data(query.data)
+    event.message_id = query.message.message_id
+
+    def process(db: DB):
+        tx, posting = db.process_event(event)
+        if event.action == Action.COMMIT:
+            return None, None
+        elif event.action == Action.DELETE:
+            return bot.deleted_text(tx, posting), bot.EMPTY_KEYBOARD
+        return bot.render(db, tx, posting)
+
+    text, keyboard = await runtime.run_db(update.effective_user.id, process)
+
+    target = dict(chat_id=query.message.chat_id, message_id=query.message.message_id)
+    if text is None:
+        await runtime.api.call(
+            'editMessageReplyMarkup', reply_markup=bot.EMPTY_KEYBOARD.to_dict(), **target
+        )
+        return
+
+    await runtime.api.call(
+        'editMessageText',
+        text=text,
+        parse_mode=telegram.ParseMode.MARKDOWN_V2,
+        reply_markup=keyboard.to_dict(),
+        **target,
+    )
+
+
+# Main function
+
+
+def run(
+    token: str,
+    persistence: Optional[BasePersistence] = None,
+    storage: Optional[SQLiteStorage] = None,
+    message_index_size: int = MESSAGE_INDEX_SIZE,
+    flush_interval: float = 0,
+    api_url: str = API_URL,
+):
+    async def main():
+        runtime = Runtime(
+            TelegramAPI(token, api_url), persistence, storage, message_index_size, flush_interval
+        )
+        await runtime.run()
+
+    asyncio.run(main())
@@ -0,0 +1,114 @@
+import bisect
+import pickle
+import zlib
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Iterator, List, Optional, Set, Tuple
+
+from .models import Transaction
+
+
+# Archive
+
+
+@dataclass
+class Block:
+    """A group of transactions, pickled and compressed."""
+
+    data: bytes
+    count: int
+    # Range of the timestamps of the transactions, to skip the block without decompressing it
+    start: float
+    end: float
+    # Range of the ids, to find transactions by id. Blocks archived before it was kept have
+    # None and are always decompressed.
+    first_id: Optional[int] = None
+    last_id: Optional[int] = None
+
+    @classmethod
+    def pack(cls, transactions: List[Transaction]) -> 'Block':
+        timestamps = [tx.date.timestamp() for tx in transactions]
+        return cls(
+            data=zlib.compress(pickle.dumps(transactions, protocol=pickle.HIGHEST_PROTOCOL)),
+            count=len(transactions),
+            start=min(timestamps),
+            end=max(timestamps),
+            first_id=min(tx.id for tx in transactions),
+            last_id=max(tx.id for tx in transactions),
+        )
+
+    def unpack(self) -> List[Transaction]:
+        return pickle.loads(zlib.decompress(self.data))
+
+
+class Archive:
+    """The transactions that can't be modified anymore, sorted by id, in compressed blocks.
+
+    It's append-only and only one block is decompressed at a time, so reading it takes little
+    memory no matter how big it is.
+    """
+
+    def __init__(self):
+        self.blocks: List[Block] = []
+
+    def __len__(self) -> int:
+        return sum(block.count for block in self.blocks)
+
+    def __iter__(self) -> Iterator[Transaction]:
+        for block in self.blocks:
+            yield from block.unpack()
+
+    def append(self, block: Block):
+        self.blocks.append(block)
+
+    def between(
+        self, start: Optional[datetime], end: Optional[datetime]
+    ) -> Iterator[Transaction]:
+        """Yields the transactions from `start` until `end` (exclusive), a block at a time.
+
+        Blocks come in id order, only the transactions of each block are sorted by date. Older
+        transactions can come later, e.g. those imported from another ledger.
+        """
+        start_ts, end_ts = timestamps(start, end)
+        for block in self.blocks:
+            if block.end < start_ts or block.start >= end_ts:
+                continue
+            transactions = [
+                tx for tx in block.unpack() if start_ts <= tx.date.timestamp() < end_ts
+            ]
+            yield from sorted(transactions, key=lambda tx: (tx.date.timestamp(), tx.id))
+
+    def find(
+        self, tx_ids: Set[int], start: Optional[datetime] = None, end: Optional[datetime] = None
+    ) -> Iterator[Transaction]:
+        """Yields the transactions with an id in `tx_ids`, from `start` until `end` (exclusive).
+
+        Only the blocks whose ranges can have them are decompressed, one at a time.
+        """
+        start_ts, end_ts = timestamps(start, end)
+        sorted_ids = sorted(tx_ids)
+        for block in self.blocks:
+            if block.end < start_ts or block.start >= end_ts:
+                continue
+            if block.first_id is not None:
+                i = bisect.bisect_left(sorted_ids, block.first_id)
+                if i == len(sorted_ids) or sorted_ids[i] > block.last_id:
+                    continue
+            for tx in block.unpack():
+                if tx.id in tx_ids and start_ts <= tx.date.timestamp() < end_ts:
+                    yield tx
+
+    def clear(self):
+        # A new list, undoing a clear brings back the old one
+        self.blocks = []
+
+
+# Helpers
+
+
+def timestamps(start: Optional[datetime], end: Optional[datetime]) -> Tuple[float, float]:
+    """Returns the range of timestamps from `start` until `end`, unbounded if None."""
+    return (
+        float('-inf') if start is None else start.timestamp(),
+        float('inf') if end is None else end.timestamp(),
+    )
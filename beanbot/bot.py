@@ -1,76 +1,276 @@
-import codecs
-import json
+import functools
 import logging
 import os
+import re
+import tempfile
 import textwrap
+import threading
 import traceback
-from dataclasses import asdict
-from datetime import datetime
-from io import BytesIO
-from typing import Optional
+from dataclasses import dataclass, field
+from datetime import date, datetime, time, timedelta
+from typing import IO, TYPE_CHECKING, Any, Callable, List, Optional, Tuple
 
-import pytz
 import telegram
-from dotenv import load_dotenv
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
+    BasePersistence,
     CallbackQueryHandler,
     CommandHandler,
+    Dispatcher,
+    ExtBot,
     Filters,
     MessageHandler,
-    PicklePersistence,
     Updater,
 )
 from telegram.utils import helpers
+from telegram.utils.request import Request
 
 from . import db as database
-from . import formatter, parser
+from . import concurrency, export, formatter, importer, metrics, parser, timezones, webhook
 from .errors import UserError
 from .models import Action, Posting, Transaction, UserConfig
+from .persistence import (
+    EventLogPersistence,
+    IncrementalPersistence,
+    JournalPersistence,
+    ShardedPersistence,
+    UserPicklePersistence,
+)
+
+if TYPE_CHECKING:
+    from .profiling import Profiler
+    from .sqlite import SQLiteStorage
 
 
 # Config
 
 
-load_dotenv()
+@dataclass
+class Config:
+    """The settings of `run`."""
+
+    token: Optional[str] = None
+    runtime: str = 'threads'  # threads or asyncio
+    # Bot API server, the token and method are appended to it
+    api_url: str = 'https://api.telegram.org/bot'
+    db_path: str = 'db.pickle'
+    db_persistence: str = 'pickle'  # pickle, journal, sharded or events
+    db_engine: str = 'memory'  # memory or sqlite
+    # Seconds between journal writes, changes are written after every update if 0
+    db_flush_interval: float = 0
+    # Seconds until an inactive user is dropped from memory, only for sharded persistence
+    db_idle_timeout: float = 600
+    tz_backend: str = 'pytz'  # pytz or zoneinfo
+    message_index_size: int = database.MESSAGE_INDEX_SIZE
+
+    # Handle updates in a pool of workers, updates of the same user are still handled in order.
+    # Not with the pickle persistence, see `run`.
+    run_async: bool = False
+    workers: int = 4
+
+    # Webhook mode, only for the threads runtime, polling is used if there is no URL
+    webhook_url: Optional[str] = None  # public URL Telegram posts to, without the path
+    webhook_listen: str = '127.0.0.1'
+    webhook_port: int = 8443
+    webhook_path: Optional[str] = None  # defaults to the bot token, so it isn't guessable
+    webhook_workers: int = webhook.WORKERS
+    webhook_queue_size: int = webhook.QUEUE_SIZE
+
+    # Prometheus metrics at /metrics, disabled if there is no port
+    metrics_listen: str = '127.0.0.1'
+    metrics_port: int = 0
+
+    # Profile some updates into .pstats files, only for the threads runtime, disabled if there
+    # is no directory. Updates are picked at random, with this probability, or by user.
+    profile_dir: Optional[str] = None
+    profile_sample_rate: float = 0
+    profile_user_ids: List[int] = field(default_factory=list)
+    profile_max_files: int = 100
+
+    @classmethod
+    def from_env(cls) -> 'Config':
+        """Reads the config from environment variables, and from a .env file if there's one."""
+        from dotenv import load_dotenv
+
+        load_dotenv()
+        env = os.environ.get
+        default = cls()
+        return cls(
+            token=env('BOT_TOKEN'),
+            runtime=env('BOT_RUNTIME') or default.runtime,
+            api_url=env('BOT_API_URL') or default.api_url,
+            db_path=env('DB_PATH') or default.db_path,
+            db_persistence=env('DB_PERSISTENCE') or default.db_persistence,
+            db_engine=env('DB_ENGINE') or default.db_engine,
+            db_flush_interval=float(env('DB_FLUSH_INTERVAL') or default.db_flush_interval),
+            db_idle_timeout=float(env('DB_IDLE_TIMEOUT') or default.db_idle_timeout),
+            tz_backend=env('TZ_BACKEND') or default.tz_backend,
+            message_index_size=int(env('MESSAGE_INDEX_SIZE') or default.message_index_size),
+            run_async=(env('RUN_ASYNC') or 'false').lower() == 'true',
+            workers=int(env('WORKERS') or default.workers),
+            webhook_url=env('WEBHOOK_URL'),
+            webhook_listen=env('WEBHOOK_LISTEN') or default.webhook_listen,
+            webhook_port=int(env('WEBHOOK_PORT') or default.webhook_port),
+            webhook_path=env('WEBHOOK_PATH'),
+            webhook_workers=int(env('WEBHOOK_WORKERS') or default.webhook_workers),
+            webhook_queue_size=int(env('WEBHOOK_QUEUE_SIZE') or default.webhook_queue_size),
+            metrics_listen=env('METRICS_LISTEN') or default.metrics_listen,
+            metrics_port=int(env('METRICS_PORT') or default.metrics_port),
+            profile_dir=env('PROFILE_DIR'),
+            profile_sample_rate=float(env('PROFILE_SAMPLE_RATE') or default.profile_sample_rate),
+            profile_user_ids=[int(i) for i in (env('PROFILE_USER_IDS') or '').split(',') if i],
+            profile_max_files=int(env('PROFILE_MAX_FILES') or default.profile_max_files),
+        )
 
-TOKEN = os.environ.get('BOT_TOKEN')
-DB_PATH = os.environ.get('DB_PATH') or 'db.pickle'
+
+# Only replaced by `run`, handlers read it
+config = Config()
 
 
 # Logging
 
 
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
-)
-
 logger = logging.getLogger(__name__)
 
 
+# Database
+
+
+# Only set when using the sqlite engine
+storage: Optional['SQLiteStorage'] = None
+
+
+def open_db(update: telegram.Update, context: telegram.ext.CallbackContext) -> database.DB:
+    if storage is not None:
+        from .sqlite import SQLiteDB
+
+        history = context.user_data.setdefault('history', database.History())
+        return SQLiteDB(storage, update.effective_user.id, config.message_index_size, history)
+    return database.DB(context.user_data, config.message_index_size)
+
+
 # Main function
 
 
 def run():
-    # Create a persistence object
-    persistence = PicklePersistence(filename=DB_PATH, store_chat_data=False)
+    global config, storage
 
-    # Create the Updater and pass it your bot's token
-    updater = Updater(TOKEN, persistence=persistence)
+    # Side effects and imports only some setups need are left until here, so importing this
+    # module stays cheap
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
+    )
+    config = Config.from_env()
+    timezones.set_backend(config.tz_backend)
+
+    # Create a persistence object, the sqlite engine doesn't need one
+    persistence = None
+    if config.db_engine == 'sqlite':
+        from .sqlite import SQLiteStorage
+
+        storage = SQLiteStorage(config.db_path)
+    elif config.db_persistence == 'journal':
+        persistence = JournalPersistence(
+            filename=config.db_path, flush_interval=config.db_flush_interval
+        )
+    elif config.db_persistence == 'sharded':
+        # DB_PATH is a directory with a file per user
+        persistence = ShardedPersistence(
+            config.db_path,
+            flush_interval=config.db_flush_interval,
+            idle_timeout=config.db_idle_timeout,
+        )
+    elif config.db_persistence == 'events':
+        # Like sharded, with a log of what each user did
+        persistence = EventLogPersistence(
+            config.db_path,
+            flush_interval=config.db_flush_interval,
+            idle_timeout=config.db_idle_timeout,
+            message_index_size=config.message_index_size,
+        )
+    else:
+        # It pickles every user on each update, while workers could be changing other users
+        if config.run_async and config.runtime == 'threads':
+            raise ValueError(
+                'RUN_ASYNC needs DB_PERSISTENCE journal, sharded or events, or DB_ENGINE sqlite'
+            )
+        persistence = UserPicklePersistence(config.db_path)
+
+    # The data is read while the bot starts, updates wait for it
+    if persistence is not None:
+        persistence.start_loading()
+
+    if config.metrics_port:
+        metrics.MetricsServer(config.metrics_listen, config.metrics_port).start()
+
+    if config.runtime == 'asyncio':
+        from . import aio
+
+        aio.run(
+            config.token,
+            persistence,
+            storage,
+            config.message_index_size,
+            flush_interval(persistence),
+            api_url=f'{config.api_url}{{token}}/{{method}}',
+        )
+        return
+
+    # Create the Updater and pass it your bot's token, the pool has room for the workers, the
+    # updater and the job queue like the one `Updater` creates
+    bot = ExtBot(
+        config.token,
+        base_url=config.api_url,
+        request=TimedRequest(con_pool_size=config.workers + 4),
+    )
+    updater = Updater(bot=bot, persistence=persistence, workers=config.workers)
 
     # Get the dispatcher to register handlers
     dp = updater.dispatcher
+    profiler = None
+    if config.profile_dir:
+        from .profiling import Profiler
+
+        profiler = Profiler(
+            config.profile_dir,
+            config.profile_sample_rate,
+            config.profile_user_ids,
+            max_files=config.profile_max_files,
+        )
+    add_handlers(dp, config.run_async, profiler)
 
-    # Add message handlers
-    dp.add_handler(CommandHandler('start', handle_start_command))
-    dp.add_handler(CommandHandler('json', handle_json_command))
-    dp.add_handler(CommandHandler('clear', handle_clear_command))
-    dp.add_handler(CommandHandler('config', handle_config_command))
-    dp.add_handler(MessageHandler(Filters.text, handle_text_message))
-    dp.add_handler(CallbackQueryHandler(handle_inline_button))
+    # Write the pending changes even if no more updates come
+    if flush_interval(persistence) > 0:
+        updater.job_queue.run_repeating(
+            lambda context: persistence.flush_dirty(), interval=flush_interval(persistence)
+        )
 
-    # Log all errors
-    dp.add_error_handler(error_handler)
+    if config.webhook_url:
+        url_path = config.webhook_path or f'/{config.token}'
+        server = webhook.WebhookServer(
+            dp,
+            listen=config.webhook_listen,
+            port=config.webhook_port,
+            url_path=url_path,
+            workers=config.webhook_workers,
+            queue_size=config.webhook_queue_size,
+        )
+        # Updates are handed to the dispatcher directly, it only runs for its worker pool
+        dispatcher_thread = threading.Thread(target=dp.start, name='dispatcher')
+        dispatcher_thread.start()
+        updater.job_queue.start()
+        server.start()
+        updater.bot.set_webhook(config.webhook_url.rstrip('/') + url_path)
+
+        # Run until a signal is received, the queued updates are handled before stopping
+        server.idle()
+        updater.job_queue.stop()
+        dp.stop()
+        dispatcher_thread.join()
+        if persistence is not None:
+            dp.update_persistence()
+            persistence.flush()
+        return
 
     # Start the Bot
     updater.start_polling()
@@ -81,39 +281,146 @@ def run():
     updater.idle()
 
 
-# Command handlers
+def flush_interval(persistence: Optional[BasePersistence]) -> float:
+    """Seconds between the periodic calls to `flush_dirty`, 0 if they aren't needed."""
+    if isinstance(persistence, ShardedPersistence):
+        # Idle users are evicted when flushing
+        return min(config.db_flush_interval or config.db_idle_timeout, config.db_idle_timeout)
+    if isinstance(persistence, JournalPersistence):
+        return config.db_flush_interval
+    return 0
 
 
-def handle_start_command(update: telegram.Update, context: telegram.ext.CallbackContext):
-    update.message.reply_text(
-        "Hi! I'm Beanbot. I can help you keep track of your financial transactions.",
+def add_handlers(
+    dp: Dispatcher, run_async: bool = False, profiler: Optional['Profiler'] = None
+):
+    def handler(callback):
+        callback = timed_handler(callback)
+        if profiler is not None:
+            callback = profiler.wrap(callback)
+        callback = with_user_lock(callback)
+        return in_user_queue(callback) if run_async else callback
+
+    # Add message handlers
+    dp.add_handler(CommandHandler('start', handler(handle_start_command)))
+    dp.add_handler(CommandHandler('json', handler(handle_json_command)))
+    dp.add_handler(CommandHandler('beancount', handler(handle_beancount_command)))
+    dp.add_handler(CommandHandler('clear', handler(handle_clear_command)))
+    dp.add_handler(CommandHandler('config', handler(handle_config_command)))
+    dp.add_handler(CommandHandler('report', handler(handle_report_command)))
+    dp.add_handler(CommandHandler('search', handler(handle_search_command)))
+    dp.add_handler(CommandHandler('undo', handler(handle_undo_command)))
+    dp.add_handler(CommandHandler('redo', handler(handle_redo_command)))
+    dp.add_handler(
+        MessageHandler(Filters.document & Filters.update.message, handler(handle_document))
     )
+    dp.add_handler(MessageHandler(Filters.text, handler(handle_text_message)))
+    dp.add_handler(CallbackQueryHandler(handler(handle_inline_button)))
 
+    # Log all errors
+    dp.add_error_handler(error_handler)
 
-def handle_json_command(update: telegram.Update, context: telegram.ext.CallbackContext):
-    db = database.DB(context.user_data)
 
-    date = datetime.now(tz=db.config.tzinfo).strftime('%Y-%m-%d-%H-%M-%S')
-    filename = f'beanbot-{date}.json'
+def timed_handler(callback: Callable) -> Callable:
+    """Records how long `callback` takes, labeled by its name."""
+    return metrics.timed(
+        'beanbot_handler_seconds',
+        'Time spent handling updates, by handler',
+        handler=callback.__name__,
+    )(callback)
 
-    def transform(value):
-        if isinstance(value, datetime):
-            return value.isoformat()
-        else:
-            return f'{value}'
 
-    data = list(map(asdict, db.transactions))
+class TimedRequest(Request):
+    """Records how long every call to the Telegram API takes, by method."""
+
+    def post(self, url: str, data: dict, timeout: float = None):
+        method = url.rsplit('/', 1)[-1]
+        histogram = metrics.registry.histogram(
+            'beanbot_telegram_seconds', 'Time spent calling the Telegram API', method=method
+        )
+        with histogram.timer():
+            return super().post(url, data, timeout)
+
+
+def with_user_lock(callback: Callable[[telegram.Update, telegram.ext.CallbackContext], None]):
+    """Makes a handler hold the lock of its user in the persistence, see `user_lock`.
+
+    A flush from another thread, i.e. the periodic one, doesn't write the data while it changes.
+    """
+
+    @functools.wraps(callback)
+    def wrapper(update: telegram.Update, context: telegram.ext.CallbackContext):
+        persistence = context.dispatcher.persistence
+        if not isinstance(persistence, IncrementalPersistence) or update.effective_user is None:
+            return callback(update, context)
+        with persistence.locked_user(update.effective_user.id):
+            return callback(update, context)
 
-    StreamWriter = codecs.getwriter('utf-8')
-    file = BytesIO()
-    json.dump(data, StreamWriter(file), default=transform, indent=4)
+    return wrapper
 
-    file.seek(0)
-    update.message.reply_document(file, filename=filename)
+
+user_queues = concurrency.UserQueues()
+
+
+def in_user_queue(callback: Callable[[telegram.Update, telegram.ext.CallbackContext], None]):
+    """Makes a handler run in the dispatcher worker pool, after the previous updates of the user.
+
+    PTB's `run_async` doesn't keep the order, and would let two updates of the same user change
+    their data at the same time.
+    """
+
+    @functools.wraps(callback)
+    def wrapper(update: telegram.Update, context: telegram.ext.CallbackContext):
+        if update.effective_user is None:
+            callback(update, context)
+            return
+
+        dispatcher = context.dispatcher
+
+        def job():
+            try:
+                callback(update, context)
+            except Exception as error:
+                dispatcher.dispatch_error(update, error)
+            dispatcher.update_persistence(update)
+
+        user_queues.submit(update.effective_user.id, job, dispatcher.run_async)
+
+    return wrapper
+
+
+# Command handlers
+
+
+START_MESSAGE = "Hi! I'm Beanbot. I can help you keep track of your financial transactions."
+
+CONFIG_USAGE = textwrap.dedent(
+    """\
+    /config timezone <tz>
+    /config currencies <cur 1> [<currencies>]
+    /config accounts <acc 1> [<accounts>]
+    """
+)
+
+
+def handle_start_command(update: telegram.Update, context: telegram.ext.CallbackContext):
+    update.message.reply_text(START_MESSAGE)
+
+
+def handle_json_command(update: telegram.Update, context: telegram.ext.CallbackContext):
+    file, filename = export_json(open_db(update, context), context.args or [])
+    with file:
+        update.message.reply_document(file, filename=filename)
+
+
+def handle_beancount_command(update: telegram.Update, context: telegram.ext.CallbackContext):
+    file, filename = export_beancount(open_db(update, context), context.args or [])
+    with file:
+        update.message.reply_document(file, filename=filename)
 
 
 def handle_clear_command(update: telegram.Update, context: telegram.ext.CallbackContext):
-    db = database.DB(context.user_data)
+    db = open_db(update, context)
     db.clear()
 
     update.message.reply_text('Cleared!')
@@ -123,18 +430,163 @@ def handle_config_command(update: telegram.Update, context: telegram.ext.Callbac
     msg = update.message or update.edited_message
 
     if not context.args:
-        msg.reply_text(
-            textwrap.dedent(
-                """\
-            /config timezone <tz>
-            /config currencies <cur 1> [<currencies>]
-            /config accounts <acc 1> [<accounts>]
-            """
-            )
-        )
+        msg.reply_text(CONFIG_USAGE)
         return
 
-    key, *values = context.args
+    msg.reply_text(configure(open_db(update, context), context.args))
+
+
+def handle_report_command(update: telegram.Update, context: telegram.ext.CallbackContext):
+    text = report(open_db(update, context), context.args or [])
+    update.message.reply_text(text, parse_mode=telegram.ParseMode.MARKDOWN_V2)
+
+
+def handle_search_command(update: telegram.Update, context: telegram.ext.CallbackContext):
+    text = search(open_db(update, context), context.args or [])
+    update.message.reply_text(text, parse_mode=telegram.ParseMode.MARKDOWN_V2)
+
+
+def handle_undo_command(update: telegram.Update, context: telegram.ext.CallbackContext):
+    text, edits = undo(open_db(update, context))
+    edit_messages(context.bot, update.message.chat_id, edits)
+    update.message.reply_text(text)
+
+
+def handle_redo_command(update: telegram.Update, context: telegram.ext.CallbackContext):
+    text, edits = undo(open_db(update, context), redo=True)
+    edit_messages(context.bot, update.message.chat_id, edits)
+    update.message.reply_text(text)
+
+
+def edit_messages(bot: telegram.Bot, chat_id: int, edits: List['MessageEdit']):
+    for message_id, text, keyboard in edits:
+        try:
+            bot.edit_message_text(
+                text,
+                chat_id=chat_id,
+                message_id=message_id,
+                parse_mode=telegram.ParseMode.MARKDOWN_V2,
+                reply_markup=keyboard,
+            )
+        except telegram.error.BadRequest as error:
+            # The message was deleted, or already shows the same
+            logger.warning('Failed to edit message %s: %s', message_id, error)
+
+
+# Commands, shared with the asyncio runtime in `aio`
+
+
+# Trailing arguments of /search that are dates instead of words
+DATE_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}')
+
+
+def export_json(db: database.DB, args: List[str]) -> Tuple[IO[bytes], str]:
+    """Returns a file with every transaction and its name."""
+    options = set(args)
+    if not options <= {'compact', 'gzip'}:
+        raise UserError('Usage: /json [compact] [gzip]')
+
+    date = datetime.now(tz=db.config.tzinfo).strftime('%Y-%m-%d-%H-%M-%S')
+    filename = f'beanbot-{date}.json'
+    if 'gzip' in options:
+        filename += '.gz'
+
+    chunks = export.iter_json(db.iter_transactions(), compact='compact' in options)
+    return export.export_file(chunks, compress='gzip' in options), filename
+
+
+def export_beancount(db: database.DB, args: List[str]) -> Tuple[IO[bytes], str]:
+    """Returns a ledger with the transactions between the given dates and its name."""
+    if len(args) > 2:
+        raise UserError('Usage: /beancount [from] [to]')
+    start, end = date_range(db, [parser.parse_date(value) for value in args])
+
+    date = datetime.now(tz=db.config.tzinfo).strftime('%Y-%m-%d-%H-%M-%S')
+    filename = f'beanbot-{date}.beancount'
+
+    chunks = export.iter_beancount(db.iter_transactions(start, end))
+    return export.export_file(chunks), filename
+
+
+def import_file(
+    db: database.DB, file: IO[bytes], filename: str, progress: Callable[[int], None]
+) -> str:
+    """Imports the transactions of an uploaded file, returns the summary.
+
+    `progress` is called with the number of transactions imported so far, now and then.
+    """
+    errors = importer.ImportErrors()
+    transactions = importer.read_file(file, filename, db.config, errors)
+    count = db.import_transactions(importer.report_progress(transactions, progress))
+    return importer.format_summary(count, errors)
+
+
+def search(db: database.DB, args: List[str]) -> str:
+    """Returns the postings with the given words, between the dates at the end if any."""
+    words = list(args)
+    dates: List[date] = []
+    while words and len(dates) < 2 and DATE_PATTERN.fullmatch(words[-1]):
+        dates.insert(0, parser.parse_date(words.pop()))
+    if not words:
+        raise UserError('Usage: /search <words> [from] [to]')
+
+    query = ' '.join(words)
+    return formatter.format_search(query, db.search(query, *date_range(db, dates)))
+
+
+def date_range(
+    db: database.DB, dates: List[date]
+) -> Tuple[Optional[datetime], Optional[datetime]]:
+    """Returns the start and end of the range between the dates, both are included."""
+    tzinfo = db.config.tzinfo
+    start = end = None
+    if len(dates) > 0:
+        start = timezones.localize(datetime.combine(dates[0], time()), tzinfo)
+    if len(dates) > 1:
+        end = timezones.localize(datetime.combine(dates[1] + timedelta(days=1), time()), tzinfo)
+    return start, end
+
+
+# A bot message to show something else: its id, text and keyboard
+MessageEdit = Tuple[int, str, InlineKeyboardMarkup]
+
+
+def undo(db: database.DB, redo: bool = False) -> Tuple[str, List[MessageEdit]]:
+    """Undoes or redoes the last change, returns the reply and the messages it changed."""
+    changed = db.redo() if redo else db.undo()
+
+    edits = []
+    for tx, posting in changed:
+        found = db.find_message(tx.id, posting and posting.id)
+        if found is None:
+            continue
+        message_id, posting_id = found
+        if posting is not None and posting not in tx.postings:
+            edits.append((message_id, deleted_text(tx, posting), EMPTY_KEYBOARD))
+        else:
+            posting = next((p for p in tx.postings if p.id == posting_id), None)
+            edits.append((message_id, *render(db, tx, posting)))
+    return ('Redone!' if redo else 'Undone!'), edits
+
+
+def report(db: database.DB, args: List[str]) -> str:
+    """Returns the totals of a month, the current one by default, or of every month."""
+    if len(args) > 1:
+        raise UserError('Usage: /report [YYYY-MM | all]')
+
+    if args and args[0] == 'all':
+        return formatter.format_report('All months', db.get_totals())
+
+    if args:
+        month = parser.parse_month(args[0])
+    else:
+        month = datetime.now(tz=db.config.tzinfo).strftime('%Y-%m')
+    return formatter.format_report(f'Report {month}', db.get_totals(month))
+
+
+def configure(db: database.DB, args: List[str]) -> str:
+    """Shows or updates a config value, returns the reply."""
+    key, *values = args
 
     if key not in ['timezone', 'currencies', 'accounts']:
         raise UserError(f'Unknown key {key}')
@@ -142,32 +594,23 @@ def handle_config_command(update: telegram.Update, context: telegram.ext.Callbac
     if key == 'accounts':
         key = 'credit_accounts'
 
-    db = database.DB(context.user_data)
-
     if not values:
-        value = ''
         if key == 'timezone':
-            value = db.config.timezone
-        else:
-            value = '\n'.join(getattr(db.config, key))
-        msg.reply_text(value)
-        return
+            return db.config.timezone
+        return '\n'.join(getattr(db.config, key))
 
     if key == 'timezone':
         tz = values[0]
-        try:
-            pytz.timezone(tz)
-        except pytz.UnknownTimeZoneError:
-            raise UserError(f'Invalid IANA timezone: {tz}')
-        db.config.timezone = tz
+        timezones.get_timezone(tz)  # Raises if invalid
+        db.set_config(key, tz)
     else:  # lists
         if len(values) > 4:
             raise UserError('Max values allowed are 4')
         if not all(v.strip() for v in values):
             raise UserError('There are invalid values')
-        setattr(db.config, key, values)
+        db.set_config(key, values)
 
-    msg.reply_text('Updated!')
+    return 'Updated!'
 
 
 # Message handlers
@@ -181,12 +624,10 @@ def handle_text_message(update: telegram.Update, context: telegram.ext.CallbackC
         return
 
     # Process
-    db = database.DB(context.user_data)
+    db = open_db(update, context)
     tx, posting = db.process_event(event)
 
-    tx_string = formatter.format_transaction(tx, default_currency=db.config.currencies[0])
-    keyboard = make_actions_keyboard(db.config, tx, posting)
-
+    tx_string, keyboard = render(db, tx, posting)
     message = update.message.reply_text(
         tx_string, parse_mode=telegram.ParseMode.MARKDOWN_V2, reply_markup=keyboard
     )
@@ -194,57 +635,86 @@ def handle_text_message(update: telegram.Update, context: telegram.ext.CallbackC
     db.update_message_index(message.message_id, tx, posting)
 
 
+def handle_document(update: telegram.Update, context: telegram.ext.CallbackContext):
+    document = update.message.document
+    importer.file_format(document.file_name, document.file_size)  # Raises if it can't be read
+    message = update.message.reply_text('Importing...')
+
+    def progress(count: int):
+        try:
+            message.edit_text(importer.format_progress(count))
+        except telegram.error.TelegramError as error:
+            # Only a report, the import goes on
+            logger.warning('Failed to report progress: %s', error)
+
+    # On disk, only a block of transactions is in memory at a time
+    with tempfile.TemporaryFile() as file:
+        document.get_file().download(out=file)
+        file.seek(0)
+        text = import_file(open_db(update, context), file, document.file_name, progress)
+    message.edit_text(text)
+
+
 def handle_inline_button(update: telegram.Update, context: telegram.ext.CallbackContext):
     event = parser.parse_keyboard_data(update.callback_query.data)
     event.message_id = update.callback_query.message.message_id
 
-    db = database.DB(context.user_data)
+    db = open_db(update, context)
     tx, posting = db.process_event(event)
 
     if event.action == Action.COMMIT:
         update.callback_query.edit_message_reply_markup(EMPTY_KEYBOARD)
         return
     elif event.action == Action.DELETE:
-        message = helpers.escape_markdown(
-            f'{posting.debit_account} {posting.amount}' if posting is not None else tx.info,
-            version=2,
-        )
         update.callback_query.edit_message_text(
-            f'~{message}~',
+            deleted_text(tx, posting),
             parse_mode=telegram.ParseMode.MARKDOWN_V2,
             reply_markup=EMPTY_KEYBOARD,
         )
         return
 
-    tx_string = formatter.format_transaction(tx, default_currency=db.config.currencies[0])
-    keyboard = make_actions_keyboard(db.config, tx, posting)
-
+    tx_string, keyboard = render(db, tx, posting)
     update.callback_query.edit_message_text(
         tx_string, parse_mode=telegram.ParseMode.MARKDOWN_V2, reply_markup=keyboard
     )
 
 
+def render(
+    db: database.DB, tx: Transaction, posting: Optional[Posting]
+) -> Tuple[str, InlineKeyboardMarkup]:
+    """Returns the message text and keyboard of a transaction."""
+    tx_string = formatter.format_transaction(tx, default_currency=db.config.currencies[0])
+    return tx_string, make_actions_keyboard(db.config, tx, posting)
+
+
+def deleted_text(tx: Transaction, posting: Optional[Posting]) -> str:
+    message = helpers.escape_markdown(
+        f'{posting.debit_account} {posting.amount}' if posting is not None else tx.info,
+        version=2,
+    )
+    return f'~{message}~'
+
+
 # Error handler
 
 
 def error_handler(update: telegram.Update, context: telegram.ext.CallbackContext):
-    error = context.error
+    update.effective_message.reply_text(describe_error(update, context.error))
 
-    def reply_text(message: str):
-        update.effective_message.reply_text(message)
 
+def describe_error(update: Any, error: Exception) -> str:
+    """Logs an error raised while handling `update`, returns the message for the user."""
     if isinstance(error, UserError):
         logger.warning('Update "%s" caused user error "%s".', update, error)
-        reply_text(str(error))
-        return
+        return str(error)
 
     trace = traceback.format_exception(
         type(error),
         error,
         error.__traceback__,
     )
-    logger.error('Update "%s" caused error "%s".\n%s', update, context.error, ''.join(trace))
-    reply_text(f'Internal error: {error}')
+    logger.error('Update "%s" caused error "%s".\n%s', update, error, ''.join(trace))
+    return f'Internal error: {error}'
 
 
 # Keyboards
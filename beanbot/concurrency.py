@@ -0,0 +1,54 @@
+import logging
+import threading
+from collections import deque
+from typing import Callable, Deque, Dict
+
+
+logger = logging.getLogger(__name__)
+
+
+# Concurrency
+
+
+Job = Callable[[], None]
+
+
+class UserQueues:
+    """Runs the jobs of each user one at a time and in order, jobs of different users in parallel.
+
+    `DB` isn't thread safe, running every job that touches the data of a user through here is
+    what makes it safe to handle updates in several threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Jobs waiting to run, by user. A user is here while one of its jobs is running.
+        self.pending: Dict[int, Deque[Job]] = {}
+
+    def submit(self, user_id: int, job: Job, run: Callable[..., object]):
+        """Queues `job` after the previous jobs of the user.
+
+        `run(fn, *args)` should call `fn(*args)` in a worker thread, it's only used when the user
+        has no jobs running, otherwise the job is left for that worker.
+        """
+        with self.lock:
+            queue = self.pending.get(user_id)
+            if queue is not None:
+                queue.append(job)
+                return
+            self.pending[user_id] = deque([job])
+        run(self.drain, user_id)
+
+    def drain(self, user_id: int):
+        while True:
+            with self.lock:
+                queue = self.pending[user_id]
+                if not queue:
+                    del self.pending[user_id]
+                    return
+                job = queue.popleft()
+
+            try:
+                job()
+            except Exception:
+                logger.exception('Job of user %s failed', user_id)
@@ -1,21 +1,277 @@
+import bisect
+import contextlib
+import copy
+import dataclasses
+import itertools
+import logging
+from collections import deque
 from datetime import datetime, timedelta
-from typing import Any, Dict, List, Optional, Tuple
-
-import pytz
+from decimal import Decimal
+from typing import Any, Deque, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
+from . import metrics
+from .archive import Archive, Block, timestamps
 from .errors import UserError
 from .models import Action, Event, Posting, Transaction, UserConfig
+from .search import Match, SearchIndex
+
+
+logger = logging.getLogger(__name__)
 
 
 # Database
 
 
+# What `DB` did, in order: ('event', Event), ('config', key, value), ('clear',),
+# ('index', message_id, tx_id, posting_id), ('import', transactions, next_ids) or ('revert', Step)
+# for /undo and /redo. Applying them again gives the same data.
+Operation = Tuple[Any, ...]
+
+# What undoes an event, a clear or an import, operations like ('info', tx_id, old_info) applied in
+# reverse order by `DB._revert`
+Step = List[Tuple[Any, ...]]
+
+# The transactions a step changed, with the last of their postings it changed
+Reverted = List[Tuple[Transaction, Optional[Posting]]]
+
+
+class Changes:
+    """Keeps track of what `DB` modified since the last time persistence saved it.
+
+    It is only recorded when a `Changes` instance is found under the `changes` key of
+    `user_data`, persistence backends that write incrementally are expected to put it there.
+    A user is dirty while its changes aren't empty, `DB` only records actual modifications, so
+    read-only commands leave it clean. `operations` are only recorded if `record_operations`,
+    for the persistences that write them, they copy each event, import and undo.
+    """
+
+    def __init__(self, record_operations: bool = False):
+        self.record_operations = record_operations
+        self.cleared = False
+        self.keys: Set[str] = set()  # modified small values, i.e. config, next_ids or vars
+        self.transactions: Dict[int, Transaction] = {}  # new or modified
+        self.deleted: Set[int] = set()  # ids of deleted transactions
+        self.message_ids: Set[int] = set()  # updated index entries
+        self.archived: List[Block] = []  # new archive blocks, their transactions are deleted
+        self.operations: List[Operation] = []  # what caused the changes, see `DB.apply`
+
+    def __bool__(self):
+        return bool(
+            self.cleared
+            or self.keys
+            or self.transactions
+            or self.deleted
+            or self.message_ids
+            or self.archived
+            or self.operations
+        )
+
+    def __reduce__(self):
+        # Pending changes are never persisted
+        return Changes, (self.record_operations,)
+
+    def reset(self):
+        self.cleared = False
+        self.keys.clear()
+        self.transactions.clear()
+        self.deleted.clear()
+        self.message_ids.clear()
+        self.archived.clear()
+        self.operations.clear()
+
+    def update(self, tx: Transaction):
+        self.transactions[tx.id] = tx
+
+    def delete(self, tx: Transaction):
+        self.transactions.pop(tx.id, None)
+        self.deleted.add(tx.id)
+
+    def archive(self, block: Block, transactions: List[Transaction]):
+        for tx in transactions:
+            self.delete(tx)
+        self.archived.append(block)
+
+    def clear(self):
+        # Small values are kept, they are written after the clear, and `vars` was reset
+        self.transactions.clear()
+        self.deleted.clear()
+        self.message_ids.clear()
+        self.archived.clear()
+        self.keys.add('vars')
+        self.cleared = True
+
+
+class IdIndex:
+    """Transactions and postings by id.
+
+    It isn't persisted, it's rebuilt by `sync` when it doesn't match the transactions.
+    """
+
+    def __init__(self):
+        self.transactions: Dict[int, Transaction] = {}
+        self.postings: Dict[int, Posting] = {}
+
+    def __reduce__(self):
+        return IdIndex, ()
+
+    def sync(self, transactions: List[Transaction]):
+        if len(self.transactions) == len(transactions):
+            return
+        self.transactions = {tx.id: tx for tx in transactions}
+        self.postings = {p.id: p for tx in transactions for p in tx.postings}
+
+    def clear(self):
+        self.transactions.clear()
+        self.postings.clear()
+
+
+# Max number of bot messages whose buttons can be used, older ones are forgotten
+MESSAGE_INDEX_SIZE = 1000
+
+# Transactions are archived in blocks of at least this size, once they can't be modified
+ARCHIVE_BLOCK_SIZE = 100
+# Transactions older than this can't be modified anymore, even if their messages are indexed
+ARCHIVE_AGE = timedelta(days=7)
+
+# Imported transactions are added in blocks of this size, which take their ids at once
+IMPORT_BLOCK_SIZE = 1000
+
+# Max number of events that can be undone
+HISTORY_SIZE = 50
+
+
+class History:
+    """The steps /undo and /redo apply, the oldest are dropped.
+
+    Like `IdIndex`, it isn't persisted, it only lasts while the user stays in memory.
+    """
+
+    def __init__(self, size: int = HISTORY_SIZE):
+        self.undo: Deque[Step] = deque(maxlen=size)
+        self.redo: Deque[Step] = deque(maxlen=size)
+
+    def __reduce__(self):
+        return History, ()
+
+    def push(self, step: Step):
+        # Something new was done, what was undone before can't be redone on top of it
+        self.undo.append(step)
+        self.redo.clear()
+
+    def clear(self):
+        self.undo.clear()
+        self.redo.clear()
+
+
+class DateIndex:
+    """Transaction ids sorted by date. Like `IdIndex`, it isn't persisted."""
+
+    def __init__(self):
+        self.entries: List[Tuple[float, int]] = []  # (timestamp, id)
+
+    def __reduce__(self):
+        return DateIndex, ()
+
+    def sync(self, transactions: List[Transaction]):
+        if len(self.entries) == len(transactions):
+            return
+        self.entries = sorted(self.key(tx) for tx in transactions)
+
+    def add(self, tx: Transaction):
+        # Usually at the end, so this doesn't move anything
+        bisect.insort(self.entries, self.key(tx))
+
+    def remove(self, tx: Transaction):
+        key = self.key(tx)
+        i = bisect.bisect_left(self.entries, key)
+        if i < len(self.entries) and self.entries[i] == key:
+            del self.entries[i]
+
+    def between(self, start: Optional[datetime], end: Optional[datetime]) -> List[int]:
+        """Returns the ids of the transactions from `start` until `end` (exclusive)."""
+        lo, hi = 0, len(self.entries)
+        if start is not None:
+            lo = bisect.bisect_left(self.entries, (start.timestamp(),))
+        if end is not None:
+            hi = bisect.bisect_left(self.entries, (end.timestamp(),))
+        return [tx_id for _, tx_id in self.entries[lo:hi]]
+
+    def clear(self):
+        self.entries.clear()
+
+    @staticmethod
+    def key(tx: Transaction) -> Tuple[float, int]:
+        return tx.date.timestamp(), tx.id
+
+
+# (currency, debit account, credit account)
+TotalsKey = Tuple[str, str, str]
+
+
+class Totals:
+    """Sums of the posting amounts by month, currency, debit and credit account.
+
+    `DB` updates it as postings change. Like `IdIndex`, it isn't persisted, it's built from the
+    transactions the first time it's used.
+    """
+
+    def __init__(self):
+        self.built = False
+        self.months: Dict[str, Dict[TotalsKey, Decimal]] = {}  # by 'YYYY-MM'
+
+    def __reduce__(self):
+        return Totals, ()
+
+    def build(self, transactions: Iterable[Transaction]):
+        self.months = {}
+        self.built = True
+        for tx in transactions:
+            for posting in tx.postings:
+                self.add(tx, posting)
+
+    def add(self, tx: Transaction, posting: Posting, sign: int = 1):
+        if not self.built:
+            return
+        month = self.month(tx)
+        totals = self.months.setdefault(month, {})
+        key = (posting.currency, posting.debit_account, posting.credit_account)
+        total = totals.get(key, 0) + sign * posting.amount
+        # Zeros are dropped, so after deleting a posting it's like it was never there
+        if total:
+            totals[key] = total
+        else:
+            totals.pop(key, None)
+            if not totals:
+                del self.months[month]
+
+    def get(self, month: Optional[str] = None) -> Dict[TotalsKey, Decimal]:
+        """Returns the totals of `month`, or of every month."""
+        if month is not None:
+            return dict(self.months.get(month, {}))
+
+        result: Dict[TotalsKey, Decimal] = {}
+        for totals in self.months.values():
+            for key, total in totals.items():
+                result[key] = result.get(key, 0) + total
+        return result
+
+    def clear(self):
+        self.months.clear()
+        self.built = True
+
+    @staticmethod
+    def month(tx: Transaction) -> str:
+        return f'{tx.date.year:04}-{tx.date.month:02}'
+
+
 class DB:
-    def __init__(self, user_data: Dict[str, Any]):
+    def __init__(self, user_data: Dict[str, Any], message_index_size: int = MESSAGE_INDEX_SIZE):
         """Creates a database interface on top of `user_data`.
 
         `user_data` should be PTB's `context.user_data` but can be any dict.
         """
+        self.message_index_size = message_index_size
+
         self.transactions: List[Transaction] = user_data.setdefault('transactions', [])
         self.config: UserConfig = user_data.setdefault('config', UserConfig())
 
@@ -24,28 +280,155 @@ class DB:
             'message_id_index', {}
         )
         self.vars = user_data.setdefault('vars', {})
+        # Older transactions, `transactions` only has the ones that can still be modified
+        self.archive: Archive = user_data.setdefault('archive', Archive())
+        self.changes: Optional[Changes] = user_data.get('changes')
+        self.index: IdIndex = user_data.setdefault('id_index', IdIndex())
+        self.date_index: DateIndex = user_data.setdefault('date_index', DateIndex())
+        self.totals: Totals = user_data.setdefault('totals', Totals())
+        self.search_index: SearchIndex = user_data.setdefault('search_index', SearchIndex())
+        self.history: History = user_data.setdefault('history', History())
+        self._step: Optional[Step] = None
+
+    def iter_transactions(
+        self, start: Optional[datetime] = None, end: Optional[datetime] = None
+    ) -> Iterator[Transaction]:
+        """Iterates over the transactions from `start` until `end` (exclusive).
+
+        Archived transactions come first, they are read one block at a time.
+        """
+        if start is None and end is None:
+            return itertools.chain(self.archive, self.transactions)
+
+        self.index.sync(self.transactions)
+        self.date_index.sync(self.transactions)
+        return itertools.chain(
+            self.archive.between(start, end),
+            (self.index.transactions[tx_id] for tx_id in self.date_index.between(start, end)),
+        )
+
+    @property
+    def has_transactions(self) -> bool:
+        return self._last_transaction() is not None
 
     @property
     def last_entries(self) -> Tuple[Transaction, Posting]:
-        if self.transactions:
-            tx = self.transactions[-1]
-            return tx, tx.postings[-1]
-        raise UserError('There are no transactions')
+        tx = self._last_transaction()
+        if tx is None:
+            raise UserError('There are no transactions')
+        return tx, tx.postings[-1]
 
     def get_entries_by_message_id(self, message_id: int) -> Tuple[Transaction, Optional[Posting]]:
-        index = self.message_id_index.get(message_id)
+        index = self.message_id_index.pop(message_id, None)
         if index is None:
-            raise UserError(f'No transaction for message {message_id}')
+            raise UserError("This message is too old or was already done, it can't be changed")
 
-        # TODO: Could be binary search
-        tx = next(filter(lambda v: v.id == index[0], self.transactions), None)
+        # Move it to the end, so the least recently used are evicted first
+        self.message_id_index[message_id] = index
+
+        self.index.sync(self.transactions)
+
+        tx = self.index.transactions.get(index[0])
         if tx is None:
             raise UserError(f'No transaction for message {message_id}')
 
-        posting = index[1] and next(filter(lambda v: v.id == index[1], tx.postings), None)
+        posting = index[1] and self.index.postings.get(index[1])
+        if index[1] and posting is None:
+            # Its posting was undone
+            raise UserError(f'No posting for message {message_id}')
         return tx, posting
 
+    @metrics.timed('beanbot_process_event_seconds', 'Time spent applying events to the data')
     def process_event(self, event: Event) -> Tuple[Transaction, Optional[Posting]]:
+        # Recorded as it came, processing it may change its action
+        recorded = copy_event(event) if self._recording else None
+        # Like `_undo_step`, events are never nested
+        step = self._step = []
+        try:
+            result = self._apply_event(event)
+        except UserError:
+            # It may have changed something already, replaying it fails the same way
+            self._record('event', recorded)
+            raise
+        except Exception:
+            # A bug, it isn't recorded so what it changed is taken back
+            self._step = []
+            self._revert(step)
+            raise
+        finally:
+            self._step = None
+        self._record('event', recorded)
+        if step:
+            self.history.push(step)
+        return result
+
+    def undo(self) -> Reverted:
+        """Reverts the last event or clear, returns the transactions and postings it changed.
+
+        A transaction that isn't in `iter_transactions` anymore was deleted.
+        """
+        if not self.history.undo:
+            raise UserError('There is nothing to undo')
+        changed, step = self._revert_step(self.history.undo.pop())
+        self.history.redo.append(step)
+        return changed
+
+    def redo(self) -> Reverted:
+        """Does again what `undo` reverted, returns the same as it."""
+        if not self.history.redo:
+            raise UserError('There is nothing to redo')
+        changed, step = self._revert_step(self.history.redo.pop())
+        self.history.undo.append(step)
+        return changed
+
+    def apply(self, operation: Operation):
+        """Does again something this or another `DB` recorded in `Changes.operations`.
+
+        Like `process_event`, it may change the event or step in it, pass a copy to keep it.
+        """
+        kind, *args = operation
+        if kind == 'event':
+            try:
+                self._apply_event(args[0])
+            except UserError:
+                # It failed the same way the first time
+                pass
+        elif kind == 'config':
+            self.set_config(*args)
+        elif kind == 'index':
+            self._index_message(*args)
+        elif kind == 'clear':
+            self.clear()
+        elif kind == 'import':
+            transactions, next_ids = args
+            self._start_import()
+            self.next_ids.update(next_ids)
+            self._changed('next_ids')
+            self._add_transactions(transactions)
+        elif kind == 'revert':
+            self._revert(args[0])
+        else:
+            raise ValueError(f'Unknown operation {kind}')
+
+    def _apply_event(self, event: Event) -> Tuple[Transaction, Optional[Posting]]:
+        if event.action == Action.BATCH:
+            return self._process_batch(event.payload)
+        return self._process_event(event)
+
+    def _process_batch(self, events: List[Event]) -> Tuple[Transaction, Optional[Posting]]:
+        """Returns the last transaction and the last posting the events worked on."""
+        # Only the first event can fail, the rest work on the transaction it leaves as the last
+        # one. Check it beforehand so a failed batch doesn't change anything.
+        if events[0].action in (Action.SET_INFO, Action.FIX_AMOUNT) and not self.has_transactions:
+            raise UserError('There are no transactions')
+
+        tx, posting = None, None
+        for event in events:
+            tx, event_posting = self._process_event(event)
+            posting = event_posting or posting
+        return tx, posting
+
+    def _process_event(self, event: Event) -> Tuple[Transaction, Optional[Posting]]:
         # Convert `new` to `add` if the last event was received in the last 5 minutes
         if event.action == Action.NEW:
             if self.last_event and (event.date - self.last_event) < timedelta(minutes=5):
@@ -54,7 +437,7 @@ class DB:
         self.last_event = event.date
 
         # Convert `add` to `new` if there are no previous transactions
-        if event.action == Action.ADD and not self.transactions:
+        if event.action == Action.ADD and not self.has_transactions:
             event.action = Action.NEW
 
         # Helper functions
@@ -66,7 +449,10 @@ class DB:
                 postings=[],
             )
             self.next_ids['transaction'] += 1
-            self.transactions.append(tx)
+            self._changed('next_ids')
+            self.last_transaction_id = None
+            self._undoable('delete', tx.id)
+            self._insert_transaction(tx)
             return tx
 
         def create_new_posting(tx: Transaction) -> Posting:
@@ -78,7 +464,8 @@ class DB:
                 currency=self.config.currencies[0],
             )
             self.next_ids['posting'] += 1
-            tx.postings.append(posting)
+            self._changed('next_ids')
+            self._add_posting(tx, posting)
             return posting
 
         tx, posting = None, None
@@ -94,48 +481,596 @@ class DB:
 
         elif event.action == Action.SET_INFO:
             tx, _ = self.last_entries
-            tx.info = event.payload
+            self._set_info(tx, event.payload)
 
         elif event.action == Action.FIX_AMOUNT:
             tx, posting = self.last_entries
-            posting.amount += event.payload
+            self._set_posting(tx, posting, 'amount', posting.amount + event.payload)
 
         elif event.action == Action.SET_CURRENCY:
             tx, posting = self.get_entries_by_message_id(event.message_id)
-            posting.currency = self.config.currencies[event.payload]
+            currency = config_value(self.config.currencies, event.payload, 'currency')
+            self._set_posting(tx, posting, 'currency', currency)
 
         elif event.action == Action.SET_CREDIT_ACCOUNT:
             tx, posting = self.get_entries_by_message_id(event.message_id)
-            posting.credit_account = self.config.credit_accounts[event.payload]
+            account = config_value(self.config.credit_accounts, event.payload, 'account')
+            self._set_posting(tx, posting, 'credit_account', account)
 
         elif event.action == Action.DELETE:
             tx, posting = self.get_entries_by_message_id(event.message_id)
             if posting is None:
                 raise UserError(f'Not posting for message {event.message_id}')
-            tx.postings.remove(posting)
+            self._drop_posting(tx, posting)
+            self._unindex_messages(tx.id, posting.id)
             if not tx.postings:
-                # TODO: Clear the index
-                self.transactions.remove(tx)
+                self._unindex_messages(tx.id)
 
         elif event.action == Action.COMMIT:
             self.last_event = None
+            # Its messages can't be edited anymore
+            entry = event.message_id is not None and self._get_message_entry(event.message_id)
+            if entry:
+                self._unindex_messages(entry[0])
+
+        if tx is not None and event.action != Action.COMMIT:
+            tx.touch()
+            if tx.postings:
+                self._save_transaction(tx)
+            else:
+                self._undoable('insert', tx)
+                self._delete_transaction(tx)
+
+        # The previous transaction can't be modified anymore, unless it has indexed messages
+        if event.action == Action.NEW:
+            self._archive_transactions(event.date)
 
         return tx, posting
 
     def clear(self):
-        self.transactions.clear()
-        self.message_id_index.clear()
+        with self._undo_step():
+            # Not copied, `Archive.clear` replaces the list of blocks
+            self._undoable(
+                'restore',
+                list(self.transactions),
+                self.archive.blocks,
+                dict(self.message_id_index),
+            )
+            self.transactions.clear()
+            self.archive.clear()
+            self.message_id_index.clear()
+            self.index.clear()
+            self.date_index.clear()
+            self.totals.clear()
+            self.search_index.clear()
+            self.last_event = None
+            self.last_transaction_id = None
+
+        if self.changes is not None:
+            self.changes.clear()
+        self._record('clear')
+
+    def import_transactions(self, transactions: Iterable[Transaction]) -> int:
+        """Adds transactions made elsewhere, returns how many.
+
+        They are given new ids, and added a block at a time so `transactions` can be a stream
+        that is never whole in memory. The whole import is a single step of the history.
+
+        Events keep working on the transaction that was the last one, the next message is a new
+        transaction.
+        """
+        first_id = self.next_ids['transaction']
+        count = 0
+        with self._undo_step():
+            iterator = iter(transactions)
+            while True:
+                block = list(itertools.islice(iterator, IMPORT_BLOCK_SIZE))
+                if not block:
+                    break
+                self._start_import()
+                self._import_block(block)
+                count += len(block)
+            if count:
+                self._undoable('unimport', first_id)
+        return count
+
+    def _import_block(self, transactions: List[Transaction]):
+        tx_id, posting_id = self.next_ids['transaction'], self.next_ids['posting']
+        for tx in transactions:
+            tx.id = tx_id
+            tx_id += 1
+            for posting in tx.postings:
+                posting.id = posting_id
+                posting_id += 1
+        self.next_ids.update(transaction=tx_id, posting=posting_id)
+        self._changed('next_ids')
+
+        if self._recording:
+            # Copied, the events that come next may change them
+            copies = [copy_transaction(tx) for tx in transactions]
+            self._record('import', copies, dict(self.next_ids))
+        self._add_transactions(transactions)
+
+    def _start_import(self):
+        # Imported transactions come last by id, but they are older
         self.last_event = None
+        if self.last_transaction_id is None:
+            tx = self._last_transaction()
+            self.last_transaction_id = tx.id if tx is not None else 0
+
+    def search(
+        self, query: str, start: Optional[datetime] = None, end: Optional[datetime] = None
+    ) -> List[Match]:
+        """Returns the postings whose account or transaction info has every word of `query`."""
+        if not self.search_index.built:
+            self.search_index.build(self.iter_transactions())
+        found = self.search_index.search(query)
+        if not found:
+            return []
+
+        self.index.sync(self.transactions)
+        # Only the archive blocks with the other transactions are decompressed
+        hot = [self.index.transactions[i] for i in found if i in self.index.transactions]
+        archived = found.keys() - {tx.id for tx in hot}
+        start_ts, end_ts = timestamps(start, end)
+        matches = [
+            Match(p.id, tx.id, tx.date, tx.info, p.debit_account, p.amount, p.currency)
+            for tx in itertools.chain(self.archive.find(archived, start, end), hot)
+            if start_ts <= tx.date.timestamp() < end_ts
+            for p in tx.postings
+            if p.id in found[tx.id]
+        ]
+        return sorted(matches, key=lambda m: (m.date, m.posting_id))
+
+    def get_totals(self, month: Optional[str] = None) -> Dict[TotalsKey, Decimal]:
+        """Returns the totals of `month`, 'YYYY-MM', or of every month."""
+        if not self.totals.built:
+            self.totals.build(self.iter_transactions())
+        return self.totals.get(month)
+
+    def check_totals(self) -> List[str]:
+        """Compares the totals with ones built from scratch, returns the months that differ.
+
+        The totals are replaced by the rebuilt ones, so a drift doesn't last.
+        """
+        if not self.totals.built:
+            return []
+
+        rebuilt = Totals()
+        rebuilt.build(self.iter_transactions())
+        months = sorted(
+            month
+            for month in self.totals.months.keys() | rebuilt.months.keys()
+            if self.totals.months.get(month) != rebuilt.months.get(month)
+        )
+        if months:
+            logger.warning('Totals drifted in %s', ', '.join(months))
+            self.totals.months = rebuilt.months
+        return months
+
+    def set_config(self, key: str, value: Any):
+        if getattr(self.config, key) != value:
+            setattr(self.config, key, value)
+            self._changed('config')
+            self._record('config', key, value)
 
     def update_message_index(self, message_id: int, tx: Transaction, posting: Posting):
         assert message_id is not None
         assert tx.id is not None
-        self.message_id_index[message_id] = (tx.id, posting and posting.id)
+        posting_id = posting and posting.id
+        self._record('index', message_id, tx.id, posting_id)
+        self._index_message(message_id, tx.id, posting_id)
+
+    def _index_message(self, message_id: int, tx_id: int, posting_id: Optional[int]):
+        self.message_id_index.pop(message_id, None)
+        self.message_id_index[message_id] = (tx_id, posting_id)
+
+        if self.changes is not None:
+            self.changes.message_ids.add(message_id)
+
+        # Evict the least recently used
+        while len(self.message_id_index) > self.message_index_size:
+            evicted = next(iter(self.message_id_index))
+            del self.message_id_index[evicted]
+            if self.changes is not None:
+                self.changes.message_ids.add(evicted)
 
     @property
     def last_event(self) -> Optional[datetime]:
         return self.vars.get('last_event')
 
     @last_event.setter
-    def last_event(self, value: datetime):
-        self.vars['last_event'] = value
+    def last_event(self, value: Optional[datetime]):
+        if self.vars.get('last_event') != value:
+            self._undoable('last_event', self.vars.get('last_event'))
+            self.vars['last_event'] = value
+            self._changed('vars')
+
+    @property
+    def last_transaction_id(self) -> Optional[int]:
+        """The transaction events work on after an import, 0 if none, else it's the last one."""
+        return self.vars.get('last_transaction')
+
+    @last_transaction_id.setter
+    def last_transaction_id(self, value: Optional[int]):
+        if self.vars.get('last_transaction') != value:
+            self._undoable('last_transaction', self.vars.get('last_transaction'))
+            self.vars['last_transaction'] = value
+            self._changed('vars')
+
+    def _last_transaction(self) -> Optional[Transaction]:
+        if self.last_transaction_id is None:
+            return self._get_last_transaction()
+        return self._get_transaction(self.last_transaction_id)
+
+    def _changed(self, key: str):
+        if self.changes is not None:
+            self.changes.keys.add(key)
+
+    @property
+    def _recording(self) -> bool:
+        return self.changes is not None and self.changes.record_operations
+
+    def _record(self, *operation: Any):
+        if self._recording:
+            self.changes.operations.append(operation)
+
+    # Undo
+
+    @contextlib.contextmanager
+    def _undo_step(self):
+        """Collects what undoes the changes made inside, as a step of the history.
+
+        Nested ones are part of the outer step. Nothing is kept if it raises, what was
+        changed until then can't be undone.
+        """
+        if self._step is not None:
+            yield
+            return
+
+        step = self._step = []
+        try:
+            yield
+        finally:
+            self._step = None
+        if step:
+            self.history.push(step)
+
+    def _undoable(self, *operation: Any):
+        if self._step is not None:
+            self._step.append(operation)
+
+    def _revert_step(self, step: Step) -> Tuple[Reverted, Step]:
+        """Reverts `step`, returns what it changed and the step that reverts it back.
+
+        If an operation fails, those before it are reverted back, so nothing changes.
+        """
+        # Copied before, reverting it changes the objects in it
+        recorded = copy.deepcopy(step) if self._recording else None
+        inverse = self._step = []
+        try:
+            changed = self._revert(step)
+        except Exception:
+            self._step = []
+            self._revert(inverse)
+            raise
+        finally:
+            self._step = None
+        if recorded is not None:
+            self._record('revert', recorded)
+        return changed, inverse
+
+    def _revert(self, step: Step) -> Reverted:
+        transactions: Dict[int, Transaction] = {}
+        postings: Dict[int, Optional[Posting]] = {}  # the last one changed, by transaction id
+        deleted: Set[int] = set()
+
+        def get_transaction(tx_id: int) -> Transaction:
+            tx = transactions.get(tx_id) or self._get_transaction(tx_id)
+            if tx is None:
+                raise UserError("It can't be undone anymore")
+            transactions[tx_id] = tx
+            postings.setdefault(tx_id, None)
+            return tx
+
+        def get_posting(tx: Transaction, posting_id: int) -> Posting:
+            posting = next(p for p in tx.postings if p.id == posting_id)
+            postings[tx.id] = posting
+            return posting
+
+        for kind, *args in reversed(step):
+            if kind == 'last_event':
+                self.last_event = args[0]
+            elif kind == 'last_transaction':
+                self.last_transaction_id = args[0]
+            elif kind == 'info':
+                tx_id, info = args
+                self._set_info(get_transaction(tx_id), info)
+            elif kind == 'posting':
+                tx_id, posting_id, field, value = args
+                tx = get_transaction(tx_id)
+                self._set_posting(tx, get_posting(tx, posting_id), field, value)
+            elif kind == 'add':
+                tx_id, position, posting = args
+                postings[tx_id] = posting
+                self._add_posting(get_transaction(tx_id), posting, position)
+            elif kind == 'remove':
+                tx_id, posting_id = args
+                tx = get_transaction(tx_id)
+                self._drop_posting(tx, get_posting(tx, posting_id))
+            elif kind == 'insert':
+                (tx,) = args
+                self._undoable('delete', tx.id)
+                self._insert_transaction(tx)
+                transactions[tx.id] = tx
+                postings.setdefault(tx.id, None)
+                deleted.discard(tx.id)
+            elif kind == 'delete':
+                tx = get_transaction(args[0])
+                self._undoable('insert', tx)
+                self._delete_transaction(tx)
+                deleted.add(tx.id)
+            elif kind == 'index':
+                message_id, entry = args
+                self._set_message_entry(message_id, entry)
+                if entry is not None:
+                    # Its message is shown again
+                    get_transaction(entry[0])
+            elif kind == 'restore':
+                self._restore(*args)
+            elif kind == 'import':
+                (imported,) = args
+                self._undoable('unimport', imported[0].id)
+                self._add_transactions(imported)
+            elif kind == 'unimport':
+                removed = self._remove_transactions(args[0])
+                self._undoable('import', removed)
+            elif kind == 'clear':
+                self.clear()
+            else:
+                raise ValueError(f'Unknown undo operation {kind}')
+
+        for tx_id, tx in transactions.items():
+            if tx_id not in deleted:
+                tx.touch()
+                self._save_transaction(tx)
+        return [(transactions[tx_id], posting) for tx_id, posting in postings.items()]
+
+    def _set_info(self, tx: Transaction, info: str):
+        self._undoable('info', tx.id, tx.info)
+        tx.info = info
+
+    def _set_posting(self, tx: Transaction, posting: Posting, field: str, value: Any):
+        self._undoable('posting', tx.id, posting.id, field, getattr(posting, field))
+        self._count_posting(tx, posting, -1)
+        setattr(posting, field, value)
+        self._count_posting(tx, posting)
+
+    def _add_posting(self, tx: Transaction, posting: Posting, position: Optional[int] = None):
+        self._undoable('remove', tx.id, posting.id)
+        self._insert_posting(tx, posting, position)
+        self._count_posting(tx, posting)
+
+    def _drop_posting(self, tx: Transaction, posting: Posting):
+        self._undoable('add', tx.id, tx.postings.index(posting), posting)
+        self._count_posting(tx, posting, -1)
+        self._remove_posting(tx, posting)
+
+    # Storage, these are overridden by other engines
+
+    def _insert_transaction(self, tx: Transaction):
+        self.index.sync(self.transactions)
+        self.date_index.sync(self.transactions)
+        # At the end, unless an undo brings back a deleted one
+        self.transactions.insert(bisect_by_id(self.transactions, tx.id), tx)
+        self.index.transactions[tx.id] = tx
+        self.date_index.add(tx)
+
+    def _get_transaction(self, tx_id: int) -> Optional[Transaction]:
+        self.index.sync(self.transactions)
+        return self.index.transactions.get(tx_id)
+
+    def _get_last_transaction(self) -> Optional[Transaction]:
+        # The last transaction is never archived
+        return self.transactions[-1] if self.transactions else None
+
+    def _insert_posting(self, tx: Transaction, posting: Posting, position: Optional[int] = None):
+        tx.postings.insert(len(tx.postings) if position is None else position, posting)
+        self.index.postings[posting.id] = posting
+
+    def _count_posting(self, tx: Transaction, posting: Posting, sign: int = 1):
+        self.totals.add(tx, posting, sign)
+
+    def _remove_posting(self, tx: Transaction, posting: Posting):
+        tx.postings.remove(posting)
+        self.index.postings.pop(posting.id, None)
+
+    def _get_message_entry(self, message_id: int) -> Optional[Tuple[int, Optional[int]]]:
+        return self.message_id_index.get(message_id)
+
+    def _unindex_messages(self, tx_id: int, posting_id: Optional[int] = None):
+        """Removes the messages of a transaction, or only those of one of its postings."""
+        message_ids = [
+            message_id
+            for message_id, (t, p) in self.message_id_index.items()
+            if t == tx_id and (posting_id is None or p == posting_id)
+        ]
+        for message_id in message_ids:
+            self._undoable('index', message_id, self.message_id_index.pop(message_id))
+            if self.changes is not None:
+                self.changes.message_ids.add(message_id)
+
+    def _set_message_entry(self, message_id: int, entry: Optional[Tuple[int, Optional[int]]]):
+        self._undoable('index', message_id, self.message_id_index.get(message_id))
+        if entry is None:
+            self.message_id_index.pop(message_id, None)
+        else:
+            self.message_id_index[message_id] = entry
+        if self.changes is not None:
+            self.changes.message_ids.add(message_id)
+
+    def find_message(
+        self, tx_id: int, posting_id: Optional[int] = None
+    ) -> Optional[Tuple[int, Optional[int]]]:
+        """Returns the last indexed message of a posting, or else of its transaction.
+
+        That is, its id and the id of the posting it shows.
+        """
+        found = None
+        for message_id, (t, p) in reversed(self.message_id_index.items()):
+            if t == tx_id:
+                if p == posting_id:
+                    return message_id, p
+                found = found or (message_id, p)
+        return found
+
+    def _restore(
+        self,
+        transactions: List[Transaction],
+        blocks: List[Block],
+        message_id_index: Dict[int, Tuple[int, Optional[int]]],
+    ):
+        """Brings back what `clear` removed, the data is empty before."""
+        self._undoable('clear')
+        self.transactions.extend(transactions)
+        self.archive.blocks = blocks
+        self.message_id_index.update(message_id_index)
+        # Rebuilt the next time they are used
+        self.index.clear()
+        self.date_index.clear()
+        self.totals.built = False
+        self.search_index.built = False
+
+        if self.changes is not None:
+            self.changes.clear()
+            self.changes.archived.extend(blocks)
+            for tx in transactions:
+                self.changes.update(tx)
+            self.changes.message_ids.update(message_id_index)
+
+    def _add_transactions(self, transactions: List[Transaction]):
+        """Adds transactions with greater ids than the rest, in bulk."""
+        self.index.sync(self.transactions)
+        self.transactions.extend(transactions)
+        for tx in transactions:
+            self.index.transactions[tx.id] = tx
+            for posting in tx.postings:
+                self.index.postings[posting.id] = posting
+                self._count_posting(tx, posting)
+            self._save_transaction(tx)
+        # Usually older than the rest, sorted again the next time it's used
+        self.date_index.clear()
+
+    def _remove_transactions(self, tx_id: int) -> List[Transaction]:
+        """Removes the transactions from `tx_id` on, in bulk, returns them."""
+        i = bisect_by_id(self.transactions, tx_id)
+        removed = self.transactions[i:]
+        del self.transactions[i:]
+        self.index.clear()
+        self.date_index.clear()
+        for tx in removed:
+            for posting in tx.postings:
+                self._count_posting(tx, posting, -1)
+            self.search_index.remove(tx)
+            if self.changes is not None:
+                self.changes.delete(tx)
+        return removed
+
+    def _save_transaction(self, tx: Transaction):
+        self.search_index.update(tx)
+        if self.changes is not None:
+            self.changes.update(tx)
+
+    def _delete_transaction(self, tx: Transaction):
+        # Transactions are sorted by id, and usually the deleted one is among the last ones
+        i = bisect_by_id(self.transactions, tx.id)
+        if i < len(self.transactions) and self.transactions[i] is tx:
+            del self.transactions[i]
+        else:
+            self.transactions.remove(tx)
+        self.index.transactions.pop(tx.id, None)
+        self.date_index.remove(tx)
+        self.search_index.remove(tx)
+
+        if self.changes is not None:
+            self.changes.delete(tx)
+
+    def _archive_transactions(self, now: datetime):
+        """Moves the oldest transactions that can't be modified anymore to the archive.
+
+        That is, those before the last one without indexed messages, or older than
+        `ARCHIVE_AGE`, whose messages are forgotten. Only a prefix of `transactions` is moved, so
+        the archive stays sorted by id.
+        """
+        if len(self.transactions) <= ARCHIVE_BLOCK_SIZE:
+            return
+
+        indexed = {tx_id for tx_id, _ in self.message_id_index.values()}
+        old = now - ARCHIVE_AGE
+        count = 0
+        for tx in itertools.islice(self.transactions, len(self.transactions) - 1):
+            if tx.id in indexed and tx.date >= old:
+                break
+            count += 1
+        if count < ARCHIVE_BLOCK_SIZE:
+            return
+
+        transactions = self.transactions[:count]
+        block = Block.pack(transactions)
+        self.archive.append(block)
+        del self.transactions[:count]
+        # Rebuilt from the remaining transactions the next time they are used
+        self.index.clear()
+        self.date_index.clear()
+        # Undoing could change archived transactions, only what comes next can be undone
+        self.history.clear()
+
+        archived = {tx.id for tx in transactions} & indexed
+        if archived:
+            for message_id, (tx_id, _) in list(self.message_id_index.items()):
+                if tx_id in archived:
+                    del self.message_id_index[message_id]
+                    if self.changes is not None:
+                        self.changes.message_ids.add(message_id)
+
+        if self.changes is not None:
+            self.changes.archive(block, transactions)
+
+
+# Helpers
+
+
+def config_value(values: List[str], index: int, name: str) -> str:
+    """Returns the option of a button, the config may have changed since it was shown."""
+    if not 0 <= index < len(values):
+        raise UserError(f'That {name} is not in the config anymore')
+    return values[index]
+
+
+def copy_event(event: Event) -> Event:
+    """Copies an event, and those of a batch, processing it changes their action."""
+    if event.action == Action.BATCH:
+        return dataclasses.replace(event, payload=[copy_event(e) for e in event.payload])
+    return dataclasses.replace(event)
+
+
+def copy_transaction(tx: Transaction) -> Transaction:
+    """Copies a transaction and its postings, faster than `copy.deepcopy`."""
+    return Transaction(
+        id=tx.id,
+        date=tx.date,
+        info=tx.info,
+        postings=[dataclasses.replace(p) for p in tx.postings],
+    )
+
+
+def bisect_by_id(transactions: List[Transaction], id: int) -> int:
+    """Returns the position of transaction `id` in `transactions`, which is sorted by id."""
+    lo, hi = 0, len(transactions)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if transactions[mid].id < id:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
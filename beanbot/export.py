@@ -0,0 +1,152 @@
+import gzip
+import json
+from dataclasses import asdict
+from datetime import datetime
+from decimal import Decimal
+from tempfile import SpooledTemporaryFile
+from typing import IO, Iterable, Iterator
+
+from .models import Transaction
+
+
+# Files are kept in memory up to this size, then moved to disk
+SPOOL_SIZE = 2**20
+
+CHUNK_SIZE = 2**16
+
+
+# Export
+
+
+def export_file(chunks: Iterable[str], compress: bool = False) -> IO[bytes]:
+    """Writes `chunks` into a temporary file, ready to be read from the start."""
+    file = SpooledTemporaryFile(max_size=SPOOL_SIZE)
+
+    output = gzip.GzipFile(fileobj=file, mode='wb') if compress else file
+    buffer = []
+    size = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= CHUNK_SIZE:
+            output.write(''.join(buffer).encode('utf-8'))
+            buffer.clear()
+            size = 0
+    output.write(''.join(buffer).encode('utf-8'))
+
+    if compress:
+        output.close()  # Doesn't close `file`
+    file.seek(0)
+    return file
+
+
+# JSON
+
+
+def json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    else:
+        return f'{value}'
+
+
+def iter_json(transactions: Iterable[Transaction], compact: bool = False) -> Iterator[str]:
+    """Serializes the transactions as a JSON list, one transaction at a time.
+
+    The output is the same `json.dump(list_of_transactions, indent=4)` would produce, or
+    without any whitespace if `compact`.
+    """
+    if compact:
+        options = dict(separators=(',', ':'))
+        start, sep, end = '[', ',', ']'
+    else:
+        options = dict(indent=4)
+        start, sep, end = '[\n', ',\n', '\n]'
+
+    first = True
+    for tx in transactions:
+        item = json.dumps(asdict(tx), default=json_default, **options)
+        if not compact:
+            item = '    ' + item.replace('\n', '\n    ')
+        if first:
+            yield start
+            first = False
+        else:
+            yield sep
+        yield item
+
+    yield '[]' if first else end
+
+
+# Beancount
+
+
+ACCOUNT_TYPES = ('Assets', 'Liabilities', 'Equity', 'Income', 'Expenses')
+
+
+def iter_beancount(transactions: Iterable[Transaction]) -> Iterator[str]:
+    """Serializes the transactions as a Beancount ledger, one transaction at a time.
+
+    Debit accounts are placed under `Expenses` and credit accounts under `Assets`, unless they
+    already start with an account type. The `open` directives go at the end, dated on the first
+    transaction, since the accounts are only known after going through every transaction.
+    """
+    accounts = set()
+    first_date = None
+
+    for tx in transactions:
+        if not tx.postings:
+            continue
+
+        date = tx.date.strftime('%Y-%m-%d')
+        if first_date is None or date < first_date:
+            first_date = date
+
+        lines = []
+        credits = {}
+        for p in tx.postings:
+            currency = beancount_currency(p.currency)
+            lines.append((beancount_account(p.debit_account, 'Expenses'), p.amount, currency))
+            key = (beancount_account(p.credit_account, 'Assets'), currency)
+            credits[key] = credits.get(key, Decimal(0)) - p.amount
+        lines.extend(
+            (account, amount, currency) for (account, currency), amount in credits.items()
+        )
+
+        amounts = [format(amount, 'f') for _, amount, _ in lines]
+        account_width = max(len(account) for account, _, _ in lines)
+        amount_width = max(len(amount) for amount in amounts)
+
+        yield f'{date} * "{beancount_string(tx.info)}"\n'
+        for (account, _, currency), amount in zip(lines, amounts):
+            accounts.add(account)
+            yield f'  {account:<{account_width}}  {amount:>{amount_width}} {currency}\n'
+        yield '\n'
+
+    for account in sorted(accounts):
+        yield f'{first_date} open {account}\n'
+
+
+def beancount_account(name: str, default_type: str) -> str:
+    """Turns a free form account name into a valid Beancount account."""
+    components = [c for c in map(beancount_account_component, name.split(':')) if c]
+    if not components:
+        components = ['Unknown']
+    if components[0] not in ACCOUNT_TYPES:
+        components.insert(0, default_type)
+    return ':'.join(components)
+
+
+def beancount_account_component(name: str) -> str:
+    name = ''.join(c if c.isalnum() else ' ' for c in name)
+    name = '-'.join(name.split())
+    return name[:1].upper() + name[1:]
+
+
+def beancount_currency(name: str) -> str:
+    name = ''.join(c for c in name.upper() if 'A' <= c <= 'Z' or c.isdigit())
+    return name or 'UNKNOWN'
+
+
+def beancount_string(s: str) -> str:
+    return s.replace('\\', '\\\\').replace('"', '\\"')
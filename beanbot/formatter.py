@@ -1,39 +1,59 @@
+import threading
+from collections import OrderedDict
 from decimal import Decimal
-from typing import Dict
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
 
 from telegram.utils import helpers
 
-from .models import Posting, Transaction
+from . import metrics
+from .models import Transaction
+from .search import Match
 
 
 # Formatter
 
 
+# Max number of postings listed in search results, the totals include every match
+SEARCH_LIMIT = 20
+
+# Rendered transactions by `id(tx)`. The transaction is kept in the entry, so a new object that
+# reuses the id of a collected one can't be mistaken for it.
+CACHE_SIZE = 1024
+
+cache: 'OrderedDict[int, Tuple[Transaction, int, Optional[str], str]]' = OrderedDict()
+cache_lock = threading.Lock()
+
+
+@metrics.timed('beanbot_format_transaction_seconds', 'Time spent formatting transactions')
 def format_transaction(tx: Transaction, default_currency=None) -> str:
-    """Returns a string representation of a transaction suitable for displaying in Telegram."""
-
-    def format_debit(p: Posting, width: int, display_currency: bool) -> str:
-        return "`{amount:= {width}.2f} {currency}`_{info}_".format(
-            width=width,
-            amount=p.amount,
-            info=escape_markdown(p.debit_account),
-            currency=f'{escape_markdown(p.currency)} ' if display_currency else '',
-        )
+    """Returns a string representation of a transaction suitable for displaying in Telegram.
 
-    def format_credit(
-        info: str, accumulators: Dict[str, Decimal], width: int, display_currency: bool
-    ):
-        return '\n'.join(
-            "`{amount:= {width}.2f} {currency}`{info}".format(
-                width=width,
-                amount=amount,
-                info=escape_markdown(info) if i == 0 else '',
-                currency=f'{escape_markdown(currency)} ' if display_currency else '',
-            )
-            for i, (currency, amount) in enumerate(accumulators.items())
-        )
+    The result is cached until the transaction version changes, see `Transaction.touch`.
+    """
+    key = id(tx)
+    with cache_lock:
+        entry = cache.get(key)
+        if entry is not None and entry[0] is tx:
+            _, version, currency, result = entry
+            if version == tx.version and currency == default_currency:
+                cache.move_to_end(key)
+                return result
+
+    result = render_transaction(tx, default_currency)
+
+    with cache_lock:
+        cache[key] = (tx, tx.version, default_currency, result)
+        cache.move_to_end(key)
+        while len(cache) > CACHE_SIZE:
+            cache.popitem(last=False)
 
-    credits = {}
+    return result
+
+
+def render_transaction(tx: Transaction, default_currency=None) -> str:
+    credits: Dict[str, Dict[str, Decimal]] = {}
+    formatted: Dict[str, Dict[str, str]] = {}  # the credit totals, formatted only once
     currencies = set()
     amount_width = 0
 
@@ -43,11 +63,11 @@ def format_transaction(tx: Transaction, default_currency=None) -> str:
 
         # To sum the credit account total
         accumulator = credits.setdefault(p.credit_account, {})
-        accumulator.setdefault(p.currency, Decimal(0))
-        accumulator[p.currency] -= p.amount
+        amount = accumulator[p.currency] = accumulator.get(p.currency, Decimal(0)) - p.amount
 
         # To format the amounts
-        amount_width = max(amount_width, len(f"{accumulator[p.currency]:.2f}"))
+        amount_string = formatted.setdefault(p.credit_account, {})[p.currency] = f'{amount:.2f}'
+        amount_width = max(amount_width, len(amount_string))
 
     amount_width += 1
     display_currency = (
@@ -55,12 +75,12 @@ def format_transaction(tx: Transaction, default_currency=None) -> str:
     )
 
     debits = '\n'.join(
-        format_debit(p, width=amount_width, display_currency=display_currency)
+        format_debit(p.amount, p.debit_account, p.currency, amount_width, display_currency)
         for p in tx.postings
     )
     credits = '\n'.join(
-        format_credit(info, acc, width=amount_width, display_currency=display_currency)
-        for info, acc in credits.items()
+        format_credit(info, amounts, amount_width, display_currency)
+        for info, amounts in formatted.items()
     )
     sep = f"`{'=' * (amount_width)}`"
 
@@ -79,5 +99,107 @@ def format_transaction(tx: Transaction, default_currency=None) -> str:
     # fmt: on
 
 
+def format_report(title: str, totals: Dict[Tuple[str, str, str], Decimal]) -> str:
+    """Returns totals by (currency, debit account, credit account) laid out like a transaction.
+
+    Debit accounts come first with what went into each, then what came out of each credit account.
+    """
+    if not totals:
+        return f'{escape_markdown(title)}\nThere are no transactions'
+
+    debits: Dict[Tuple[str, str], Decimal] = {}
+    credits: Dict[str, Dict[str, Decimal]] = {}
+    for (currency, debit_account, credit_account), amount in totals.items():
+        debits[debit_account, currency] = debits.get((debit_account, currency), 0) + amount
+        amounts = credits.setdefault(credit_account, {})
+        amounts[currency] = amounts.get(currency, 0) - amount
+
+    formatted = {
+        account: {currency: f'{amount:.2f}' for currency, amount in sorted(amounts.items())}
+        for account, amounts in sorted(credits.items())
+    }
+    amount_width = 1 + max(
+        [len(f'{amount:.2f}') for amount in debits.values()]
+        + [len(amount) for amounts in formatted.values() for amount in amounts.values()]
+    )
+
+    lines = [escape_markdown(title)]
+    lines.extend(
+        format_debit(amount, account, currency, amount_width, True)
+        for (account, currency), amount in sorted(debits.items())
+    )
+    lines.append(f"`{'=' * amount_width}`")
+    lines.extend(
+        format_credit(account, amounts, amount_width, True)
+        for account, amounts in formatted.items()
+    )
+    return '\n'.join(lines)
+
+
+def format_search(query: str, matches: List[Match], limit: int = SEARCH_LIMIT) -> str:
+    """Returns the last `limit` matches, with their dates, and the totals of all of them."""
+    if not matches:
+        return escape_markdown(f'Nothing found for {query}')
+
+    totals: Dict[str, Decimal] = {}
+    for m in matches:
+        totals[m.currency] = totals.get(m.currency, 0) + m.amount
+
+    shown = matches[-limit:]
+    formatted = {currency: f'{amount:.2f}' for currency, amount in sorted(totals.items())}
+    # Room for a sign, so it looks like a transaction
+    amount_width = 2 + max(
+        [len(f'{m.amount:.2f}') for m in shown] + [len(amount) for amount in formatted.values()]
+    )
+
+    title = f'{len(matches)} found for {query}'
+    if len(shown) < len(matches):
+        title += f', the last {len(shown)}:'
+    lines = [escape_markdown(title)]
+    lines.extend(
+        '{posting} {date}'.format(
+            posting=format_debit(m.amount, m.account, m.currency, amount_width, True),
+            date=escape_markdown(f'{m.date:%Y-%m-%d}'),
+        )
+        for m in shown
+    )
+    lines.append(f"`{'=' * amount_width}`")
+    lines.append(format_credit('Total', formatted, amount_width, True))
+    return '\n'.join(lines)
+
+
+# Postings usually repeat in later renders of the same transaction, only their lines are cached,
+# keyed by everything that goes into them.
+@lru_cache(maxsize=4096)
+def format_debit(
+    amount: Decimal, info: str, currency: str, width: int, display_currency: bool
+) -> str:
+    return "`{amount:= {width}.2f} {currency}`_{info}_".format(
+        width=width,
+        amount=amount,
+        info=escape_markdown(info),
+        currency=f'{escape_markdown(currency)} ' if display_currency else '',
+    )
+
+
+def format_credit(info: str, amounts: Dict[str, str], width: int, display_currency: bool):
+    return '\n'.join(
+        "`{amount} {currency}`{info}".format(
+            amount=pad_amount(amount, width),
+            info=escape_markdown(info) if i == 0 else '',
+            currency=f'{escape_markdown(currency)} ' if display_currency else '',
+        )
+        for i, (currency, amount) in enumerate(amounts.items())
+    )
+
+
+def pad_amount(amount: str, width: int) -> str:
+    """Pads a formatted amount like the `= {width}` format spec would, i.e. `-   1.00`."""
+    if amount.startswith('-'):
+        return '-' + amount[1:].rjust(width - 1)
+    return ' ' + amount.rjust(width - 1)
+
+
+@lru_cache(maxsize=4096)
 def escape_markdown(s: str) -> str:
     return helpers.escape_markdown(s, version=2)
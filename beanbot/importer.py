@@ -0,0 +1,320 @@
+import csv
+import io
+import os
+import re
+import time
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from typing import IO, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from . import timezones
+from .errors import UserError
+from .models import Posting, Transaction, UserConfig
+
+
+# Bots can't download bigger files from Telegram
+MAX_FILE_SIZE = 20 * 2**20
+
+# A byte order mark at the start, which spreadsheets often write, is skipped
+ENCODING = 'utf-8-sig'
+
+FORMATS = {'.csv': 'csv', '.beancount': 'beancount', '.bean': 'beancount'}
+
+FORMATS_USAGE = (
+    'Send a .csv file with the columns date, info, debit_account, credit_account, amount and '
+    'currency, or a .beancount ledger'
+)
+
+# Only the first errors are shown, the rest are counted
+MAX_ERRORS = 20
+
+# Seconds between progress reports, Telegram limits how often a message can be edited
+PROGRESS_INTERVAL = 2.0
+
+
+# Import
+
+
+class ImportErrors:
+    """The rows that couldn't be imported, by line number. Only the first ones are kept."""
+
+    def __init__(self, max_errors: int = MAX_ERRORS):
+        self.max_errors = max_errors
+        self.count = 0
+        self.first: List[Tuple[int, str]] = []
+
+    def add(self, line: int, message: str):
+        self.count += 1
+        if len(self.first) < self.max_errors:
+            self.first.append((line, message))
+
+
+def file_format(filename: str, size: Optional[int] = None) -> str:
+    """Returns the format of a file by its extension, raises if it can't be imported."""
+    name = FORMATS.get(os.path.splitext(filename or '')[1].lower())
+    if name is None:
+        raise UserError(FORMATS_USAGE)
+    if size is not None and size > MAX_FILE_SIZE:
+        raise UserError(f'The file is too big, the limit is {MAX_FILE_SIZE // 2**20} MB')
+    return name
+
+
+def read_file(
+    file: IO[bytes], filename: str, config: UserConfig, errors: ImportErrors
+) -> Iterator[Transaction]:
+    """Reads the transactions of a CSV file or a Beancount ledger, one at a time.
+
+    Only the transaction being read is kept in memory. They don't have ids, and rows that can't be
+    read are added to `errors` instead of stopping the import.
+    """
+    lines = io.TextIOWrapper(file, encoding=ENCODING, errors='replace', newline='')
+    if file_format(filename) == 'csv':
+        return iter_csv(lines, config, errors)
+    return iter_beancount(lines, config, errors)
+
+
+def report_progress(
+    transactions: Iterable[Transaction],
+    progress: Callable[[int], None],
+    interval: float = PROGRESS_INTERVAL,
+) -> Iterator[Transaction]:
+    """Passes the transactions through, calling `progress` with their count now and then."""
+    count = 0
+    next_report = time.monotonic() + interval
+    for tx in transactions:
+        yield tx
+        count += 1
+        if count % 100 == 0 and time.monotonic() >= next_report:
+            progress(count)
+            next_report = time.monotonic() + interval
+
+
+def format_progress(count: int) -> str:
+    return f'Importing... {count} transactions so far'
+
+
+def format_summary(count: int, errors: ImportErrors) -> str:
+    lines = [f'Imported {count} transactions']
+    if errors.count:
+        lines.append(f'{errors.count} rows have errors and were skipped:')
+        lines.extend(f'Line {line}: {message}' for line, message in errors.first)
+        if errors.count > len(errors.first):
+            lines.append(f'And {errors.count - len(errors.first)} more')
+    return '\n'.join(lines)
+
+
+def parse_datetime(value: str, config: UserConfig) -> datetime:
+    """Parses a date or an ISO datetime, those without a timezone are in the user's one."""
+    try:
+        date = datetime.fromisoformat(value.strip())
+    except ValueError as ex:
+        raise UserError(f'Invalid date {value}, use YYYY-MM-DD') from ex
+    if date.tzinfo is None:
+        return timezones.localize(date, config.tzinfo)
+    return date.astimezone(config.tzinfo)
+
+
+def parse_amount(value: str) -> Decimal:
+    try:
+        amount = Decimal(value.strip())
+    except (ValueError, InvalidOperation) as ex:
+        raise UserError(f'Invalid amount {value}') from ex
+    if not amount.is_finite():
+        raise UserError(f'Invalid amount {value}')
+    return amount
+
+
+# CSV
+
+
+CSV_COLUMNS = ('date', 'info', 'debit_account', 'credit_account', 'amount', 'currency')
+CSV_REQUIRED_COLUMNS = ('date', 'debit_account', 'amount')
+
+
+def iter_csv(
+    lines: Iterable[str], config: UserConfig, errors: ImportErrors
+) -> Iterator[Transaction]:
+    """Reads a CSV file with a posting per row, the columns are named in the first one.
+
+    A row without a date adds its posting to the transaction of the previous row. Missing credit
+    accounts and currencies are the user's defaults.
+    """
+    reader = csv.reader(lines)
+    header = [name.strip().lower() for name in next(reader, [])]
+    missing = [name for name in CSV_REQUIRED_COLUMNS if name not in header]
+    if missing:
+        raise UserError(f'Missing columns: {", ".join(missing)}. {FORMATS_USAGE}')
+    columns = [(name, header.index(name)) for name in CSV_COLUMNS if name in header]
+
+    tx: Optional[Transaction] = None
+    for row in reader:
+        if not any(value.strip() for value in row):
+            continue
+        values = dict.fromkeys(CSV_COLUMNS, '')
+        values.update((name, row[i]) for name, i in columns if i < len(row))
+
+        try:
+            posting = Posting(
+                id=None,
+                debit_account=required(values['debit_account'], 'debit account'),
+                credit_account=values['credit_account'].strip() or config.credit_accounts[0],
+                amount=parse_amount(values['amount']),
+                currency=values['currency'].strip() or config.currencies[0],
+            )
+            if not values['date'].strip():
+                if tx is None:
+                    raise UserError('The date is missing')
+                tx.postings.append(posting)
+                continue
+            date = parse_datetime(values['date'], config)
+        except UserError as ex:
+            errors.add(reader.line_num, str(ex))
+            if values['date'].strip() and tx is not None:
+                # The rows without date that follow aren't added to the previous transaction
+                yield tx
+                tx = None
+            continue
+
+        if tx is not None:
+            yield tx
+        tx = Transaction(id=None, date=date, info=values['info'].strip(), postings=[posting])
+
+    if tx is not None:
+        yield tx
+
+
+def required(value: str, name: str) -> str:
+    value = value.strip()
+    if not value:
+        raise UserError(f"The {name} can't be empty")
+    return value
+
+
+# Beancount
+
+
+BEANCOUNT_TRANSACTION = re.compile(r'(\d{4}-\d{2}-\d{2})\s+(?:txn|[*!])(?=\s|$)(.*)')
+BEANCOUNT_STRING = re.compile(r'"((?:[^"\\]|\\.)*)"')
+BEANCOUNT_POSTING = re.compile(
+    r'\s+(?:[*!]\s+)?([A-Z][^\s:]*(?::[^\s:]+)+)(?:\s+(-?[\d,.]+)\s+([A-Z][A-Z0-9\'._-]*))?'
+    r'\s*(?:$|[{@;])'
+)
+BEANCOUNT_METADATA = re.compile(r'\s+[a-z][\w-]*:')
+
+# (account, amount, currency), the amount is missing in the leg that balances the others
+Leg = Tuple[str, Optional[Decimal], Optional[str]]
+
+
+def iter_beancount(
+    lines: Iterable[str], config: UserConfig, errors: ImportErrors
+) -> Iterator[Transaction]:
+    """Reads the transactions of a Beancount ledger, other directives are skipped.
+
+    The inverse of `export.iter_beancount`. Expenses are the debit accounts, or the legs with
+    positive amounts if there are none, and each one is paired with a credit leg of the same
+    currency. The `Expenses` and `Assets` prefixes the export adds are removed.
+    """
+    start = 0
+    header: Optional[Tuple[datetime, str]] = None
+    legs: List[Leg] = []
+    failed = False
+
+    def finish() -> Optional[Transaction]:
+        if header is None or failed:
+            return None
+        try:
+            return beancount_transaction(*header, legs, config)
+        except UserError as ex:
+            errors.add(start, str(ex))
+            return None
+
+    for number, line in enumerate(lines, start=1):
+        if line[:1] in (' ', '\t') and line.strip():
+            if header is None or failed:
+                continue
+            if line.lstrip().startswith(';') or BEANCOUNT_METADATA.match(line):
+                continue
+            match = BEANCOUNT_POSTING.match(line)
+            try:
+                if match is None:
+                    raise UserError(f'Invalid posting {line.strip()}')
+                account, amount, currency = match.groups()
+                legs.append((account, amount and parse_amount(amount.replace(',', '')), currency))
+            except UserError as ex:
+                errors.add(number, str(ex))
+                failed = True
+            continue
+
+        # Anything else ends the transaction
+        tx = finish()
+        if tx is not None:
+            yield tx
+        header, legs, failed = None, [], False
+
+        match = BEANCOUNT_TRANSACTION.match(line)
+        if match is None:
+            continue
+        start = number
+        date, rest = match.groups()
+        strings = [unescape(s) for s in BEANCOUNT_STRING.findall(rest.split(';', 1)[0])]
+        try:
+            header = (parse_datetime(date, config), ' '.join(s for s in strings[:2] if s))
+        except UserError as ex:
+            errors.add(number, str(ex))
+
+    tx = finish()
+    if tx is not None:
+        yield tx
+
+
+def beancount_transaction(
+    date: datetime, info: str, legs: List[Leg], config: UserConfig
+) -> Transaction:
+    elided = [i for i, (_, amount, _) in enumerate(legs) if amount is None]
+    if len(elided) > 1:
+        raise UserError('Only one posting can be without amount')
+    if elided:
+        currencies = {currency for _, amount, currency in legs if amount is not None}
+        if len(currencies) != 1:
+            raise UserError("The missing amount can't be inferred")
+        total = sum(amount for _, amount, _ in legs if amount is not None)
+        legs[elided[0]] = (legs[elided[0]][0], -total, currencies.pop())
+
+    expenses = [leg for leg in legs if leg[0].startswith('Expenses:')]
+    if expenses:
+        debits = expenses
+        credits = [leg for leg in legs if not leg[0].startswith('Expenses:')]
+    else:
+        debits = [leg for leg in legs if leg[1] > 0]
+        credits = [leg for leg in legs if leg[1] <= 0]
+    if not debits:
+        raise UserError('The transaction has no postings')
+
+    # What is left of each credit leg, debits take it from one of the same currency
+    remaining: Dict[int, Decimal] = {i: -amount for i, (_, amount, _) in enumerate(credits)}
+    postings = []
+    for account, amount, currency in debits:
+        same_currency = [i for i, leg in enumerate(credits) if leg[2] == currency]
+        i = next(
+            (i for i in same_currency if remaining[i] == amount),
+            next((i for i in same_currency if remaining[i] >= amount), None),
+        )
+        if i is None and credits:
+            i = same_currency[0] if same_currency else 0
+        if i is None:
+            credit_account = config.credit_accounts[0]
+        else:
+            remaining[i] -= amount
+            credit_account = strip_prefix(credits[i][0], 'Assets:')
+        postings.append(
+            Posting(None, strip_prefix(account, 'Expenses:'), credit_account, amount, currency)
+        )
+    return Transaction(id=None, date=date, info=info, postings=postings)
+
+
+def strip_prefix(account: str, prefix: str) -> str:
+    return account[len(prefix):] if account.startswith(prefix) else account
+
+
+def unescape(s: str) -> str:
+    return re.sub(r'\\(.)', r'\1', s)
@@ -0,0 +1,202 @@
+"""Timings of the handlers and the slow paths, exposed in the Prometheus text format.
+
+Durations are counted in log spaced buckets, so recording one is cheap and the memory used
+doesn't grow. They are exposed as summaries whose quantiles are estimated from the buckets, off
+by at most the width of a bucket (about 19%). Counts give the throughput.
+"""
+import bisect
+import functools
+import inspect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Tuple, TypeVar
+
+
+logger = logging.getLogger(__name__)
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+# Upper bounds of the buckets, in seconds, from 1 microsecond to about 2 minutes
+BOUNDS = [1e-6 * 2 ** (i / 4) for i in range(108)]
+
+
+# Metrics
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BOUNDS) + 1)  # the last one is for values over every bound
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(BOUNDS, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    @contextmanager
+    def timer(self) -> Iterator[None]:
+        """Observes how long the block takes, also when it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def quantile(self, q: float) -> float:
+        """Returns the upper bound of the bucket of the `q` quantile, 0 if there's nothing."""
+        with self.lock:
+            counts, count = list(self.counts), self.count
+        if not count:
+            return 0.0
+
+        rank = q * count
+        seen = 0
+        for i, bucket_count in enumerate(counts):
+            seen += bucket_count
+            if seen >= rank:
+                return BOUNDS[min(i, len(BOUNDS) - 1)]
+        return BOUNDS[-1]
+
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Registry:
+    def __init__(self):
+        # Description and histograms by labels, by name
+        self.families: Dict[str, Tuple[str, Dict[Labels, Histogram]]] = {}
+        self.lock = threading.Lock()
+
+    def histogram(self, name: str, description: str, **labels: str) -> Histogram:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            _, histograms = self.families.setdefault(name, (description, {}))
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms[key] = Histogram()
+            return histogram
+
+    def render(self) -> str:
+        """Returns every metric in the Prometheus text format."""
+        with self.lock:
+            families = [
+                (name, description, list(histograms.items()))
+                for name, (description, histograms) in sorted(self.families.items())
+            ]
+
+        lines: List[str] = []
+        for name, description, histograms in families:
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} summary')
+            for labels, histogram in sorted(histograms):
+                for q in QUANTILES:
+                    quantile_labels = format_labels(labels + (('quantile', str(q)),))
+                    lines.append(f'{name}{quantile_labels} {histogram.quantile(q):.6g}')
+                lines.append(f'{name}_sum{format_labels(labels)} {histogram.sum}')
+                lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    values = ','.join(f'{key}="{escape_label(value)}"' for key, value in labels)
+    return f'{{{values}}}'
+
+
+def escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+registry = Registry()
+
+
+F = TypeVar('F', bound=Callable)
+
+
+def timed(name: str, description: str, **labels: str) -> Callable[[F], F]:
+    """Records the duration of every call of the decorated function, also when it raises.
+
+    Coroutine functions are timed until they return, not until they yield.
+    """
+
+    def decorator(fn):
+        histogram = registry.histogram(name, description, **labels)
+
+        if inspect.iscoroutinefunction(fn):
+
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - start)
+
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+# Server
+
+
+class MetricsServer:
+    """Serves `registry` at /metrics, meant to be reachable only from the machine or network."""
+
+    def __init__(self, listen: str = '127.0.0.1', port: int = 9090):
+        self.httpd = ThreadingHTTPServer((listen, port), MetricsHandler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(
+            target=self.httpd.serve_forever, name='metrics-server', daemon=True
+        )
+
+    @property
+    def port(self) -> int:
+        return self.httpd.server_address[1]
+
+    def start(self) -> 'MetricsServer':
+        self.thread.start()
+        logger.info('Metrics listening on port %s', self.port)
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args):
+        logger.debug(format, *args)
@@ -1,10 +1,11 @@
+import sys
 from dataclasses import dataclass, field
-from datetime import datetime, tzinfo
+from datetime import datetime, timezone, tzinfo
 from decimal import Decimal
 from enum import Enum, auto
 from typing import Any, List, Optional
 
-import pytz
+from .timezones import get_timezone
 
 
 # Models
@@ -18,24 +19,72 @@ class UserConfig:
 
     @property
     def tzinfo(self) -> tzinfo:
-        return pytz.timezone(self.timezone)
+        return get_timezone(self.timezone)
+
+
+# Postings and transactions are the bulk of the data, so they use slots to save memory, and
+# pickle as a plain tuple of values. Older pickles, which stored a dict, can still be loaded.
 
 
 @dataclass
 class Posting:
+    __slots__ = ('id', 'debit_account', 'credit_account', 'amount', 'currency')
+
     id: Optional[int]
     debit_account: str  # i.e. money is going into this account, usually an Expense
     credit_account: str  # i.e. money is going out of this account, usually an Asset
     amount: Decimal
     currency: str
 
+    def __post_init__(self):
+        # Account names and currencies repeat a lot, so keep a single copy of each
+        self.debit_account = intern(self.debit_account)
+        self.credit_account = intern(self.credit_account)
+        self.currency = intern(self.currency)
+
+    def __getstate__(self):
+        return (self.id, self.debit_account, self.credit_account, self.amount, self.currency)
+
+    def __setstate__(self, state):
+        set_slots(self, state)
+        self.__post_init__()
+
 
 @dataclass
 class Transaction:
+    __slots__ = ('id', 'date', 'info', 'postings', '_version')
+
     id: Optional[int]
     date: datetime
     info: str
-    postings: List[Posting] = field(default_factory=list)
+    postings: List[Posting]
+
+    @property
+    def version(self) -> int:
+        """Increased by `touch`, the formatter uses it to know the transaction changed."""
+        return getattr(self, '_version', 0)
+
+    def touch(self):
+        self._version = self.version + 1
+
+    def __getstate__(self):
+        return (self.id, self.date, self.info, self.postings)
+
+    def __setstate__(self, state):
+        set_slots(self, state)
+
+
+def set_slots(obj: Any, state: Any):
+    if isinstance(state, tuple) and len(state) == 2 and isinstance(state[1], dict):
+        state = state[1]  # (None, slots) from the default `__getstate__` of slotted objects
+    if isinstance(state, dict):
+        state = tuple(state[name] for name in obj.__slots__ if name in state)
+    for name, value in zip(obj.__slots__, state):
+        object.__setattr__(obj, name, value)
+
+
+def intern(s: str) -> str:
+    return sys.intern(s) if type(s) is str else s
 
 
 class Action(Enum):
@@ -47,6 +96,7 @@ class Action(Enum):
     SET_CREDIT_ACCOUNT = auto()  # Set credict account of given posting
     DELETE = auto()  # Delete posting or transaction
     COMMIT = auto()  # Commit transaction, don't allow modifications
+    BATCH = auto()  # Several of the above, from a multi-line message
 
 
 @dataclass
@@ -61,9 +111,10 @@ class Event:
     - set_credit_account: index of account in config
     - delete: None
     - commit: None
+    - batch: list of events, applied all at once
     """
 
     action: Action
     payload: Any
-    date: datetime = field(default_factory=lambda: datetime.now(tz=pytz.utc))
+    date: datetime = field(default_factory=lambda: datetime.now(tz=timezone.utc))
     message_id: Optional[int] = None
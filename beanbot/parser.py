@@ -1,4 +1,6 @@
+from datetime import date, datetime
 from decimal import Decimal, InvalidOperation
+from typing import List
 
 from .errors import UserError
 from .models import Action, Event
@@ -8,7 +10,39 @@ from .models import Action, Event
 
 
 def parse_message(message: str) -> Event:
-    """Transform a user message into an event that can be handled by the database."""
+    """Transform a user message into an event that can be handled by the database.
+
+    A message with several lines becomes a batch, with one event per line.
+    """
+    lines = [line for line in message.splitlines() if line.strip()]
+    if len(lines) > 1:
+        return parse_batch(lines)
+    return parse_line(message)
+
+
+def parse_batch(lines: List[str]) -> Event:
+    """Parses every line before returning, so an invalid line rejects the whole message.
+
+    Postings after the first one are added to its transaction.
+    """
+    events = []
+    has_posting = False
+    for number, line in enumerate(lines, start=1):
+        try:
+            event = parse_line(line)
+        except UserError as ex:
+            raise UserError(f'Line {number}: {ex}') from ex
+
+        if event.action in (Action.NEW, Action.ADD):
+            if has_posting:
+                event.action = Action.ADD
+            has_posting = True
+        events.append(event)
+
+    return Event(Action.BATCH, events)
+
+
+def parse_line(message: str) -> Event:
     message = message.strip()
 
     def inner_parse():
@@ -61,3 +95,17 @@ def parse_keyboard_data(data: str) -> Event:
         return Event(Action.SET_CREDIT_ACCOUNT, index)
 
     raise ValueError(f'Invalid key ${key}')
+
+
+def parse_date(value: str) -> date:
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError as ex:
+        raise UserError(f'Invalid date {value}, use YYYY-MM-DD') from ex
+
+
+def parse_month(value: str) -> str:
+    try:
+        return datetime.strptime(value, '%Y-%m').strftime('%Y-%m')
+    except ValueError as ex:
+        raise UserError(f'Invalid month {value}, use YYYY-MM') from ex
@@ -0,0 +1,826 @@
+import contextlib
+import logging
+import os
+import pickle
+import shutil
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import (
+    Any,
+    Callable,
+    DefaultDict,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from telegram.ext import BasePersistence, PicklePersistence
+
+from . import metrics
+from .archive import Archive
+from .db import DB, MESSAGE_INDEX_SIZE, Changes
+
+
+logger = logging.getLogger(__name__)
+
+
+# Journal
+
+
+Record = Tuple[Any, ...]
+
+
+class Journal:
+    """An append-only file of pickled records."""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.file = None
+        self.size = 0
+
+    def replay(self) -> Iterator[Record]:
+        """Yields every record in the file.
+
+        A truncated record at the end, i.e. a write interrupted by a crash, is discarded.
+        """
+        if not os.path.exists(self.filename):
+            return
+
+        with open(self.filename, 'rb') as file:
+            offset = 0
+            while True:
+                try:
+                    record = pickle.load(file)
+                except EOFError:
+                    break
+                except (pickle.UnpicklingError, ValueError, AttributeError, IndexError):
+                    logger.warning('Discarding corrupted journal tail at offset %s', offset)
+                    break
+                offset = file.tell()
+                yield record
+
+        if offset != os.path.getsize(self.filename):
+            os.truncate(self.filename, offset)
+
+    def append(self, records: Iterable[Record]) -> int:
+        """Appends the records and returns the number of bytes written."""
+        data = b''.join(pickle.dumps(r, protocol=pickle.HIGHEST_PROTOCOL) for r in records)
+        if not data:
+            return 0
+
+        if self.file is None:
+            self.file = open(self.filename, 'ab')
+        self.file.write(data)
+        self.file.flush()
+        self.size += len(data)
+        return len(data)
+
+    def rewrite(self, records: Iterable[Record]):
+        """Atomically replaces the whole file with `records`."""
+        self.close()
+
+        tmp_filename = f'{self.filename}.tmp'
+        with open(tmp_filename, 'wb') as file:
+            for record in records:
+                pickle.dump(record, file, protocol=pickle.HIGHEST_PROTOCOL)
+            file.flush()
+            os.fsync(file.fileno())
+            size = file.tell()
+        os.replace(tmp_filename, self.filename)
+
+        self.size = size
+
+    def sync(self):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+# User data records
+
+
+# Values that are never written
+TRANSIENT_KEYS = ('changes', 'id_index', 'date_index', 'totals', 'search_index', 'history')
+
+
+def make_user_data() -> Dict[str, Any]:
+    return dict(changes=Changes())
+
+
+def snapshot_records(user_data: Dict[int, Dict[str, Any]]) -> Iterator[Record]:
+    for user_id, data in user_data.items():
+        data = {k: v for k, v in data.items() if k not in TRANSIENT_KEYS}
+        yield ('user', user_id, data)
+
+
+def change_records(user_id: int, data: Dict[str, Any], changes: Changes) -> Iterator[Record]:
+    if changes.cleared:
+        yield ('clear', user_id)
+
+    # Small values are rewritten whole
+    for key in sorted(changes.keys):
+        yield ('set', user_id, key, data[key])
+
+    for tx_id in changes.deleted:
+        yield ('delete', user_id, tx_id)
+
+    for block in changes.archived:
+        yield ('archive', user_id, block)
+
+    for tx_id in sorted(changes.transactions):
+        yield ('transaction', user_id, changes.transactions[tx_id])
+
+    index = data.get('message_id_index', {})
+    for message_id in changes.message_ids:
+        yield ('index', user_id, message_id, index.get(message_id))
+
+
+class Replay:
+    """Rebuilds `user_data` from journal records."""
+
+    def __init__(self):
+        self.users: DefaultDict[int, Dict[str, Any]] = defaultdict(make_user_data)
+        # Transactions by id, so updates and deletes don't need to search the list
+        self.transactions: DefaultDict[int, Dict[int, Any]] = defaultdict(dict)
+
+    def apply(self, record: Record):
+        kind, user_id, *args = record
+        data = self.users[user_id]
+
+        if kind == 'user':
+            (value,) = args
+            data.clear()
+            data.update(value, changes=Changes())
+            self.transactions[user_id] = {tx.id: tx for tx in value.get('transactions', [])}
+        elif kind == 'set':
+            key, value = args
+            data[key] = value
+        elif kind == 'clear':
+            self.transactions[user_id].clear()
+            data.setdefault('message_id_index', {}).clear()
+            data.setdefault('archive', Archive()).clear()
+        elif kind == 'transaction':
+            (tx,) = args
+            self.transactions[user_id][tx.id] = tx
+        elif kind == 'delete':
+            (tx_id,) = args
+            self.transactions[user_id].pop(tx_id, None)
+        elif kind == 'archive':
+            (block,) = args
+            data.setdefault('archive', Archive()).append(block)
+        elif kind == 'index':
+            message_id, value = args
+            index = data.setdefault('message_id_index', {})
+            if value is None:
+                index.pop(message_id, None)
+            else:
+                index[message_id] = value
+        else:
+            raise ValueError(f'Unknown journal record {kind}')
+
+    def result(self) -> DefaultDict[int, Dict[str, Any]]:
+        for user_id, transactions in self.transactions.items():
+            self.users[user_id]['transactions'] = sorted(
+                transactions.values(), key=lambda tx: tx.id
+            )
+        self.transactions.clear()
+        return self.users
+
+
+# Persistence
+
+
+FLUSH_SECONDS = metrics.registry.histogram(
+    'beanbot_flush_seconds', 'Time spent writing the changes of the dirty users'
+)
+
+
+@dataclass
+class FlushMetrics:
+    """Totals of the flush cycles that wrote something, and the numbers of the last one."""
+
+    cycles: int = 0
+    users: int = 0
+    records: int = 0
+    bytes: int = 0
+    last_users: int = 0
+    last_seconds: float = 0.0
+
+    def record(self, users: int, records: int, size: int, seconds: float):
+        self.cycles += 1
+        self.users += users
+        self.records += records
+        self.bytes += size
+        self.last_users = users
+        self.last_seconds = seconds
+
+
+class IncrementalPersistence(BasePersistence):
+    """Base of the persistences that only write what `DB` modified.
+
+    `DB` records what it modifies (see `Changes`), users without changes aren't written at all.
+    With a `flush_interval`, in seconds, the changes of the dirty users are written together at
+    most once per interval instead of after every update. Someone has to call `flush_dirty`
+    periodically, so changes don't wait for the next update to be written.
+
+    Handlers that change the data of a user in other threads hold its `user_lock` meanwhile,
+    a flush skips the users whose lock is held, they stay dirty until the next one. A
+    compaction, which writes every user, is put off while any is held.
+
+    Subclasses read the data in `read` and write the changes of some users in `write`.
+    Only `user_data` is stored.
+    """
+
+    def __init__(self, flush_interval: float = 0):
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=False)
+        self.flush_interval = flush_interval
+        self.user_data: Optional[DefaultDict[int, Dict[str, Any]]] = None
+
+        # Users with changes not written yet
+        self.dirty: Set[int] = set()
+        self.last_flush = time.monotonic()
+        self.metrics = FlushMetrics()
+
+        # Updates and the periodic flush can come from different threads
+        self.lock = threading.RLock()
+        self.user_locks: Dict[int, threading.RLock] = {}
+        # Held while `user_locks` changes, and while every user is locked
+        self.user_locks_lock = threading.Lock()
+
+    # PTB copies the whole data on every update to replace `Bot` instances, which would make
+    # saving proportional to the size of the data. There are no bots in it, so skip that.
+
+    @classmethod
+    def replace_bot(cls, obj: object) -> object:
+        return obj
+
+    def insert_bot(self, obj: object) -> object:
+        return obj
+
+    def read(self) -> DefaultDict[int, Dict[str, Any]]:
+        raise NotImplementedError()
+
+    def load(self):
+        self.user_data = self.read()
+
+    def start_loading(self):
+        """Reads the data in a background thread, see `BackgroundUserData`."""
+        with self.lock:
+            if self.user_data is None:
+                self.user_data = BackgroundUserData(self.read)
+
+    def write(self, user_ids: Set[int]) -> Tuple[int, int]:
+        """Writes the changes of the users, returns the number of records and bytes written."""
+        raise NotImplementedError()
+
+    def get_user_data(self) -> DefaultDict[int, Dict[str, Any]]:
+        with self.lock:
+            if self.user_data is None:
+                self.load()
+            return self.user_data
+
+    def update_user_data(self, user_id: int, data: Dict[str, Any]):
+        with self.lock:
+            if self.user_data is None:
+                self.load()
+            self.user_data[user_id] = data
+
+            if not data.setdefault('changes', Changes()):
+                return
+            self.dirty.add(user_id)
+
+            if time.monotonic() - self.last_flush >= self.flush_interval:
+                self.flush_dirty()
+
+    def user_lock(self, user_id: int) -> threading.RLock:
+        """Held while the data of the user is changed, so it isn't written halfway."""
+        with self.user_locks_lock:
+            return self.user_locks.setdefault(user_id, threading.RLock())
+
+    @contextlib.contextmanager
+    def locked_user(self, user_id: int) -> Iterator[None]:
+        """Holds the lock of the user, see `user_lock`."""
+        while True:
+            lock = self.user_lock(user_id)
+            with lock:
+                # Otherwise the user was evicted meanwhile, see `drop_user_lock`
+                if self.user_locks.get(user_id) is lock:
+                    yield
+                    return
+
+    def drop_user_lock(self, user_id: int) -> bool:
+        """Forgets the lock of a user leaving memory, returns False if it's held."""
+        with self.user_locks_lock:
+            lock = self.user_locks.get(user_id)
+            if lock is None:
+                return True
+            if not lock.acquire(blocking=False):
+                return False
+            del self.user_locks[user_id]
+            lock.release()
+            return True
+
+    @contextlib.contextmanager
+    def all_users_locked(self, wait: bool = True) -> Iterator[bool]:
+        """Holds the lock of every user, yields False without them if one is held and not `wait`.
+
+        Users without a lock can't get one meanwhile, so none starts changing its data.
+        """
+        acquired: List[threading.RLock] = []
+        with self.user_locks_lock:
+            try:
+                for lock in self.user_locks.values():
+                    if not lock.acquire(blocking=wait):
+                        yield False
+                        return
+                    acquired.append(lock)
+                yield True
+            finally:
+                for lock in acquired:
+                    lock.release()
+
+    def flush_dirty(self, wait: bool = False):
+        """Writes the changes of the dirty users, those being changed only if `wait`."""
+        with self.lock:
+            self.last_flush = time.monotonic()
+            if not self.dirty:
+                return
+
+            start = time.perf_counter()
+            locks = {user_id: self.user_lock(user_id) for user_id in self.dirty}
+            user_ids = {user_id for user_id, lock in locks.items() if lock.acquire(blocking=wait)}
+            if not user_ids:
+                return
+            try:
+                records, size = self.write(user_ids)
+                for user_id in user_ids:
+                    self.user_data[user_id]['changes'].reset()
+            finally:
+                for user_id in user_ids:
+                    locks[user_id].release()
+
+            users = len(user_ids)
+            self.dirty -= user_ids
+            seconds = time.perf_counter() - start
+            self.metrics.record(users, records, size, seconds)
+            FLUSH_SECONDS.observe(seconds)
+            logger.debug('Flushed %s users, %s records, %s bytes', users, records, size)
+
+    # Chat data, bot data and conversations are not stored
+
+    def get_chat_data(self) -> DefaultDict[int, Dict[Any, Any]]:
+        return defaultdict(dict)
+
+    def get_bot_data(self) -> Dict[Any, Any]:
+        return {}
+
+    def get_conversations(self, name: str) -> Dict:
+        return {}
+
+    def update_conversation(self, name: str, key: Tuple[int, ...], new_state: Optional[object]):
+        pass
+
+    def update_chat_data(self, chat_id: int, data: Dict[Any, Any]):
+        pass
+
+    def update_bot_data(self, data: Dict[Any, Any]):
+        pass
+
+
+class JournalPersistence(IncrementalPersistence):
+    """Stores `user_data` as a journal of changes instead of rewriting it on every update.
+
+    Only the changes are appended to the journal, so the cost of an update doesn't depend on the
+    size of the data. The state is rebuilt on start by replaying the journal, which is compacted
+    into a snapshot once the records appended since the last compaction outgrow `compact_ratio`
+    times the snapshot size.
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        compact_ratio: float = 1.0,
+        compact_min_size: int = 2**20,
+        flush_interval: float = 0,
+    ):
+        super().__init__(flush_interval)
+        self.journal = Journal(filename)
+        self.compact_ratio = compact_ratio
+        self.compact_min_size = compact_min_size
+        self.snapshot_size = 0
+
+    def read(self) -> DefaultDict[int, Dict[str, Any]]:
+        replay = Replay()
+        for record in self.journal.replay():
+            replay.apply(record)
+
+        self.journal.size = self.snapshot_size = (
+            os.path.getsize(self.journal.filename) if os.path.exists(self.journal.filename) else 0
+        )
+        return replay.result()
+
+    def compact(self, wait: bool = True) -> bool:
+        """Rewrites the journal as a single snapshot of the current data, returns if it did.
+
+        Every user is locked meanwhile, without `wait` it isn't compacted if one is being
+        changed. The snapshot has the changes that weren't written, they are dropped.
+        """
+        with self.lock:
+            if self.user_data is None:
+                self.load()
+            if isinstance(self.user_data, BackgroundUserData):
+                self.user_data.wait()
+            with self.all_users_locked(wait) as locked:
+                if not locked:
+                    return False
+                self.journal.rewrite(snapshot_records(self.user_data))
+                self.snapshot_size = self.journal.size
+                for user_id in self.dirty:
+                    self.user_data[user_id]['changes'].reset()
+                self.dirty.clear()
+        logger.info('Compacted journal to %s bytes', self.snapshot_size)
+        return True
+
+    def write(self, user_ids: Set[int]) -> Tuple[int, int]:
+        records: List[Record] = []
+        for user_id in user_ids:
+            data = self.user_data[user_id]
+            records.extend(change_records(user_id, data, data['changes']))
+        size = self.journal.append(records)
+        self.maybe_compact()
+        return len(records), size
+
+    def maybe_compact(self):
+        appended = self.journal.size - self.snapshot_size
+        if appended > max(self.compact_min_size, self.compact_ratio * self.snapshot_size):
+            # Tried again after the next write if a user is being changed
+            self.compact(wait=False)
+
+    def flush(self):
+        with self.lock:
+            if self.user_data is not None:
+                self.flush_dirty(wait=True)
+            self.journal.sync()
+            self.journal.close()
+
+
+class LazyUserData(DefaultDict[int, Dict[str, Any]]):
+    """A `user_data` that loads users the first time they are looked up.
+
+    `load(user_id)` has to store the data it returns.
+    """
+
+    def __init__(self, load: Callable[[int], Dict[str, Any]]):
+        super().__init__()
+        self.load = load
+
+    def __missing__(self, user_id: int) -> Dict[str, Any]:
+        return self.load(user_id)
+
+
+class BackgroundUserData(LazyUserData):
+    """A `user_data` filled by `read()` in a background thread.
+
+    It's handed to PTB right away, so the bot starts while the data is read. Looking up a user
+    waits until the data is read, users that aren't in it are created with `make_user_data`. If
+    reading fails, every lookup raises instead, so the data on disk isn't overwritten.
+    """
+
+    def __init__(self, read: Callable[[], Dict[int, Dict[str, Any]]]):
+        super().__init__(self.load_user)
+        self.loaded = threading.Event()
+        self.error: Optional[Exception] = None
+        self.lock = threading.Lock()
+        threading.Thread(target=self.run, args=(read,), name='load', daemon=True).start()
+
+    def __reduce__(self):
+        self.wait()
+        return dict, (dict(self),)
+
+    def run(self, read: Callable[[], Dict[int, Dict[str, Any]]]):
+        start = time.perf_counter()
+        try:
+            self.update(read())
+        except Exception as ex:
+            logger.exception('Failed to read the data')
+            self.error = ex
+        else:
+            logger.info('Read %s users in %.3fs', len(self), time.perf_counter() - start)
+        finally:
+            self.loaded.set()
+
+    def wait(self):
+        """Waits until the data is read, raises if it couldn't be."""
+        self.loaded.wait()
+        if self.error is not None:
+            raise RuntimeError('The data could not be read') from self.error
+
+    def load_user(self, user_id: int) -> Dict[str, Any]:
+        self.wait()
+        with self.lock:
+            data = self.get(user_id)
+            if data is None:
+                data = self[user_id] = make_user_data()
+            return data
+
+
+class Shard:
+    """The journal of a single user."""
+
+    def __init__(self, filename: str):
+        self.journal = Journal(filename)
+        self.snapshot_size = 0
+        self.last_access = time.monotonic()
+
+
+class ShardedPersistence(IncrementalPersistence):
+    """Stores each user in its own journal, under `directory`.
+
+    Nothing is read on start, a user is loaded on its first update, so starting takes the same
+    time no matter how many users there are, and a corrupted file only affects one of them.
+    Users that haven't been seen in `idle_timeout` seconds are evicted from memory when the
+    changes are flushed, so memory follows the active users. Each journal is compacted like the
+    one of `JournalPersistence`.
+    """
+
+    extension = 'journal'
+
+    def __init__(
+        self,
+        directory: str,
+        compact_ratio: float = 1.0,
+        compact_min_size: int = 2**16,
+        flush_interval: float = 0,
+        idle_timeout: float = 600,
+    ):
+        super().__init__(flush_interval)
+        self.directory = directory
+        self.compact_ratio = compact_ratio
+        self.compact_min_size = compact_min_size
+        self.idle_timeout = idle_timeout
+
+        self.shards: Dict[int, Shard] = {}
+        self.last_eviction = time.monotonic()
+
+    def load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.user_data = LazyUserData(self.load_user)
+
+    def start_loading(self):
+        # Nothing is read until a user is looked up
+        self.get_user_data()
+
+    def load_user(self, user_id: int) -> Dict[str, Any]:
+        with self.lock:
+            # Another thread may have loaded it while this one waited
+            data = self.user_data.get(user_id)
+            if data is not None:
+                return data
+
+            shard = self.shards[user_id] = Shard(
+                os.path.join(self.directory, f'{user_id}.{self.extension}')
+            )
+            data = self.replay_user(user_id, shard.journal.replay())
+            shard.journal.size = shard.snapshot_size = (
+                os.path.getsize(shard.journal.filename)
+                if os.path.exists(shard.journal.filename)
+                else 0
+            )
+            self.user_data[user_id] = data
+            return data
+
+    def replay_user(self, user_id: int, records: Iterator[Record]) -> Dict[str, Any]:
+        replay = Replay()
+        for record in records:
+            replay.apply(record)
+        return replay.result()[user_id]
+
+    def user_records(self, user_id: int, data: Dict[str, Any]) -> Iterator[Record]:
+        return change_records(user_id, data, data['changes'])
+
+    def compact_user(self, user_id: int, shard: Shard, data: Dict[str, Any]):
+        shard.journal.rewrite(snapshot_records({user_id: data}))
+        shard.snapshot_size = shard.journal.size
+
+    def refresh_user_data(self, user_id: int, user_data: Dict[str, Any]):
+        # Called before the data is handed to a handler, the user isn't idle
+        shard = self.shards.get(user_id)
+        if shard is not None:
+            shard.last_access = time.monotonic()
+
+    def update_user_data(self, user_id: int, data: Dict[str, Any]):
+        with self.lock:
+            self.refresh_user_data(user_id, data)
+            super().update_user_data(user_id, data)
+
+    def write(self, user_ids: Set[int]) -> Tuple[int, int]:
+        count = size = 0
+        for user_id in user_ids:
+            data = self.user_data[user_id]
+            records = list(self.user_records(user_id, data))
+            shard = self.shards[user_id]
+            count += len(records)
+            size += shard.journal.append(records)
+            # Keep as few files open as there are threads writing
+            shard.journal.close()
+
+            appended = shard.journal.size - shard.snapshot_size
+            if appended > max(self.compact_min_size, self.compact_ratio * shard.snapshot_size):
+                self.compact_user(user_id, shard, data)
+        return count, size
+
+    def flush_dirty(self, wait: bool = False):
+        with self.lock:
+            super().flush_dirty(wait)
+            if time.monotonic() - self.last_eviction >= self.idle_timeout:
+                self.evict_idle()
+
+    def evict_idle(self):
+        """Drops the users without pending changes that haven't been seen in `idle_timeout`.
+
+        Their locks are dropped too, a user whose lock is held is being changed and stays.
+        """
+        with self.lock:
+            now = self.last_eviction = time.monotonic()
+            idle = [
+                user_id
+                for user_id, shard in self.shards.items()
+                if now - shard.last_access >= self.idle_timeout and user_id not in self.dirty
+            ]
+            idle = [user_id for user_id in idle if self.drop_user_lock(user_id)]
+            for user_id in idle:
+                del self.shards[user_id]
+                self.user_data.pop(user_id, None)
+            if idle:
+                logger.debug('Evicted %s idle users, %s loaded', len(idle), len(self.shards))
+
+    def flush(self):
+        with self.lock:
+            if self.user_data is not None:
+                self.flush_dirty(wait=True)
+
+
+# Event log
+
+
+def replay_operations(
+    records: Iterable[Record],
+    message_index_size: int = MESSAGE_INDEX_SIZE,
+    limit: Optional[int] = None,
+) -> Dict[str, Any]:
+    """Rebuilds the data of a user from its log, the last snapshot and the operations after it.
+
+    With a `limit`, only that many operations after the snapshot are applied, e.g. to see the
+    data as it was before a bad one.
+    """
+    data: Dict[str, Any] = {}
+    db = DB(data, message_index_size)
+    count = 0
+    for kind, _, *args in records:
+        if kind == 'user':
+            (value,) = args
+            data = dict(value)
+            db = DB(data, message_index_size)
+            count = 0
+        elif limit is None or count < limit:
+            db.apply((kind, *args))
+            count += 1
+    data['changes'] = Changes()
+    return data
+
+
+class EventLogPersistence(ShardedPersistence):
+    """Stores what each user did in a log per user, under `directory`.
+
+    Instead of the changes to the data, the operations `DB` applied are appended: events, config
+    changes, indexed messages and clears, see `Changes.operations`. A user is loaded by applying
+    them again after the last snapshot, so the log tells how the data got to be what it is.
+    Logs are compacted like the journals of `ShardedPersistence`, which bounds the time to load
+    a user, the previous `keep_logs` logs are kept as `<user_id>.log.1` and so on.
+    """
+
+    extension = 'log'
+
+    def __init__(
+        self,
+        directory: str,
+        compact_ratio: float = 1.0,
+        compact_min_size: int = 2**16,
+        flush_interval: float = 0,
+        idle_timeout: float = 600,
+        message_index_size: int = MESSAGE_INDEX_SIZE,
+        keep_logs: int = 1,
+    ):
+        super().__init__(directory, compact_ratio, compact_min_size, flush_interval, idle_timeout)
+        # Evictions from the index are replayed, they have to happen at the same size
+        self.message_index_size = message_index_size
+        self.keep_logs = keep_logs
+
+    def replay_user(self, user_id: int, records: Iterator[Record]) -> Dict[str, Any]:
+        data = replay_operations(records, self.message_index_size)
+        data['changes'] = Changes(record_operations=True)
+        return data
+
+    def user_records(self, user_id: int, data: Dict[str, Any]) -> Iterator[Record]:
+        for kind, *args in data['changes'].operations:
+            yield (kind, user_id, *args)
+
+    def compact_user(self, user_id: int, shard: Shard, data: Dict[str, Any]):
+        filename = shard.journal.filename
+        if self.keep_logs > 0:
+            for i in range(self.keep_logs - 1, 0, -1):
+                if os.path.exists(f'{filename}.{i}'):
+                    os.replace(f'{filename}.{i}', f'{filename}.{i + 1}')
+            # Copied, the log has to stay in place until the snapshot replaces it
+            shutil.copyfile(filename, f'{filename}.1')
+        super().compact_user(user_id, shard, data)
+
+
+# Pickle
+
+
+class UserPicklePersistence(PicklePersistence):
+    """PTB's `PicklePersistence` storing only `user_data`, made to start faster.
+
+    PTB walks the whole data to replace `Bot` instances after loading it and copies the data of
+    the user on every update, there are none here so both are skipped. Updates don't compare
+    the data with that copy to know if it changed, they look at the `Changes` recorded by `DB`.
+    The file is written after the updates that changed something, like PTB does, but it's
+    replaced instead of overwritten, so it's never left half written.
+    """
+
+    def __init__(self, filename: str, on_flush: bool = False):
+        super().__init__(
+            filename, store_chat_data=False, store_bot_data=False, on_flush=on_flush
+        )
+
+    @classmethod
+    def replace_bot(cls, obj: object) -> object:
+        return obj
+
+    def insert_bot(self, obj: object) -> object:
+        return obj
+
+    def read(self) -> DefaultDict[int, Dict[str, Any]]:
+        try:
+            with open(self.filename, 'rb') as file:
+                user_data = pickle.load(file)['user_data']
+        except FileNotFoundError:
+            user_data = {}
+        for data in user_data.values():
+            data.setdefault('changes', Changes())
+        return defaultdict(make_user_data, user_data)
+
+    def start_loading(self):
+        """Reads the data in a background thread, see `BackgroundUserData`."""
+        if self.user_data is None:
+            self.user_data = BackgroundUserData(self.read)
+
+    def get_user_data(self) -> DefaultDict[int, Dict[str, Any]]:
+        if self.user_data is None:
+            self.user_data = self.read()
+        return self.user_data
+
+    def update_user_data(self, user_id: int, data: Dict[str, Any]):
+        if self.user_data is None:
+            self.user_data = self.read()
+        self.user_data[user_id] = data
+
+        changes = data.setdefault('changes', Changes())
+        if not changes:
+            return
+        changes.reset()
+        if not self.on_flush:
+            self.dump()
+
+    def flush(self):
+        if self.user_data is not None:
+            self.dump()
+
+    def dump(self):
+        if isinstance(self.user_data, BackgroundUserData):
+            # Before opening the file, it must not be replaced if the data wasn't read
+            self.user_data.wait()
+
+        data = dict(
+            conversations=self.conversations,
+            user_data=self.user_data,
+            chat_data=self.chat_data,
+            bot_data=self.bot_data,
+            callback_data=self.callback_data,
+        )
+        with FLUSH_SECONDS.timer():
+            with open(f'{self.filename}.tmp', 'wb') as file:
+                pickle.dump(data, file)
+            os.replace(f'{self.filename}.tmp', self.filename)
@@ -0,0 +1,83 @@
+"""Profiles some of the updates of the live bot, to see where the time of a slow handler goes.
+
+Updates are picked at random, or because they come from a user that is being looked at. Only
+picked updates pay for the profiler, the rest only pay for a call to `random.random`.
+"""
+import cProfile
+import functools
+import logging
+import os
+import random
+import threading
+from datetime import datetime
+from typing import Callable, Collection, Optional
+
+import telegram
+
+
+logger = logging.getLogger(__name__)
+
+
+# Profiling
+
+
+Callback = Callable[[telegram.Update, telegram.ext.CallbackContext], None]
+
+
+class Profiler:
+    """Writes a .pstats file per profiled update, only the last `max_files` are kept.
+
+    One update is profiled at a time, others are handled normally meanwhile. Profiles of
+    concurrent updates would be mixed and newer Python versions only allow one profiler anyway.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        sample_rate: float = 0.0,
+        user_ids: Collection[int] = (),
+        max_files: int = 100,
+    ):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.user_ids = frozenset(user_ids)
+        self.max_files = max_files
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def wants(self, user_id: Optional[int]) -> bool:
+        return user_id in self.user_ids or random.random() < self.sample_rate
+
+    def wrap(self, callback: Callback) -> Callback:
+        @functools.wraps(callback)
+        def wrapper(update: telegram.Update, context: telegram.ext.CallbackContext):
+            user_id = update.effective_user.id if update.effective_user else None
+            if not self.wants(user_id) or not self.lock.acquire(blocking=False):
+                return callback(update, context)
+
+            try:
+                profile = cProfile.Profile()
+                try:
+                    return profile.runcall(callback, update, context)
+                finally:
+                    self.save(profile, f'{callback.__name__}-{user_id}')
+            finally:
+                self.lock.release()
+
+        return wrapper
+
+    def save(self, profile: cProfile.Profile, name: str):
+        # Names sort by date, the rotation relies on it
+        filename = os.path.join(
+            self.directory, f'{datetime.now():%Y%m%d-%H%M%S-%f}-{name}.pstats'
+        )
+        try:
+            profile.dump_stats(filename)
+            self.rotate()
+        except OSError:
+            logger.exception('Failed to save profile %s', filename)
+
+    def rotate(self):
+        filenames = sorted(f for f in os.listdir(self.directory) if f.endswith('.pstats'))
+        for filename in filenames[: max(len(filenames) - self.max_files, 0)]:
+            os.remove(os.path.join(self.directory, filename))
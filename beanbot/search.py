@@ -0,0 +1,100 @@
+import re
+import sys
+from datetime import datetime
+from decimal import Decimal
+from typing import Dict, Iterable, List, NamedTuple, Set
+
+from .models import Transaction
+
+
+# Search
+
+
+class Match(NamedTuple):
+    posting_id: int
+    tx_id: int
+    date: datetime
+    info: str
+    account: str
+    amount: Decimal
+    currency: str
+
+
+def tokenize(text: str) -> Set[str]:
+    return set(re.findall(r'\w+', text.lower()))
+
+
+class SearchIndex:
+    """Postings by the words in their debit account and in the info of their transaction.
+
+    `DB` updates it as transactions change. Like `IdIndex`, it isn't persisted, it's built from
+    the transactions the first time it's used. Only ids are kept, archived transactions included,
+    `DB.search` reads the matching ones from the archive blocks that have them.
+    """
+
+    def __init__(self):
+        self.built = False
+        self.postings: Dict[str, Set[int]] = {}  # posting ids by word
+        self.tx_ids: Dict[int, int] = {}  # transaction id by posting id
+        self.transactions: Dict[int, List[int]] = {}  # posting ids by transaction id
+        self.words: Dict[int, List[str]] = {}  # words of the postings by transaction id
+
+    def __reduce__(self):
+        return SearchIndex, ()
+
+    def build(self, transactions: Iterable[Transaction]):
+        self.clear()
+        for tx in transactions:
+            self.update(tx)
+
+    def update(self, tx: Transaction):
+        """Indexes the current postings of `tx`, replacing what was indexed before."""
+        if not self.built:
+            return
+        self.remove(tx)
+
+        info_words = tokenize(tx.info)
+        words = set(info_words)
+        for p in tx.postings:
+            self.tx_ids[p.id] = tx.id
+            for word in info_words | tokenize(p.debit_account):
+                self.postings.setdefault(word, set()).add(p.id)
+                words.add(word)
+        self.transactions[tx.id] = [p.id for p in tx.postings]
+        # Interned, each word is kept once however many transactions have it
+        self.words[tx.id] = [sys.intern(word) for word in words]
+
+    def remove(self, tx: Transaction):
+        # `tx` may have changed since, the words it had are those kept
+        posting_ids = self.transactions.pop(tx.id, [])
+        for word in self.words.pop(tx.id, []):
+            ids = self.postings.get(word)
+            if ids is None:
+                continue
+            ids.difference_update(posting_ids)
+            if not ids:
+                del self.postings[word]
+        for posting_id in posting_ids:
+            del self.tx_ids[posting_id]
+
+    def search(self, query: str) -> Dict[int, Set[int]]:
+        """Returns the ids of the postings with every word of `query`, by transaction id.
+
+        It only looks at the postings of the rarest word, not at every posting.
+        """
+        words = tokenize(query)
+        if not words:
+            return {}
+
+        sets = sorted((self.postings.get(word, set()) for word in words), key=len)
+        found: Dict[int, Set[int]] = {}
+        for posting_id in sets[0].intersection(*sets[1:]):
+            found.setdefault(self.tx_ids[posting_id], set()).add(posting_id)
+        return found
+
+    def clear(self):
+        self.postings.clear()
+        self.tx_ids.clear()
+        self.transactions.clear()
+        self.words.clear()
+        self.built = True
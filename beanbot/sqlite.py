@@ -0,0 +1,658 @@
+import argparse
+import contextlib
+import json
+import pickle
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from decimal import Decimal
+from itertools import groupby
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from . import timezones
+from .archive import Block
+from .db import DB, MESSAGE_INDEX_SIZE, History, Totals, TotalsKey
+from .errors import UserError
+from .models import Posting, Transaction, UserConfig
+from .persistence import FLUSH_SECONDS
+from .search import Match, tokenize
+
+
+# Schema
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    timezone TEXT NOT NULL,
+    currencies TEXT NOT NULL,
+    credit_accounts TEXT NOT NULL,
+    next_transaction INTEGER NOT NULL,
+    next_posting INTEGER NOT NULL,
+    last_event TEXT,
+    last_transaction INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS transactions (
+    user_id INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    info TEXT NOT NULL,
+    PRIMARY KEY (user_id, id)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS transactions_date ON transactions (user_id, date);
+
+CREATE TABLE IF NOT EXISTS postings (
+    user_id INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    transaction_id INTEGER NOT NULL,
+    debit_account TEXT NOT NULL,
+    credit_account TEXT NOT NULL,
+    amount TEXT NOT NULL,
+    currency TEXT NOT NULL,
+    PRIMARY KEY (user_id, id)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS postings_transaction ON postings (user_id, transaction_id);
+
+CREATE TABLE IF NOT EXISTS message_index (
+    user_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    transaction_id INTEGER NOT NULL,
+    posting_id INTEGER,
+    PRIMARY KEY (user_id, message_id)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS message_index_transaction ON message_index (user_id, transaction_id);
+
+-- Postings by the words in their debit account and in the info of their transaction
+CREATE TABLE IF NOT EXISTS words (
+    user_id INTEGER NOT NULL,
+    word TEXT NOT NULL,
+    posting_id INTEGER NOT NULL,
+    transaction_id INTEGER NOT NULL,
+    PRIMARY KEY (user_id, word, posting_id)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS words_transaction ON words (user_id, transaction_id);
+"""
+
+SELECT_TABLES = "SELECT name FROM sqlite_master WHERE type = 'table'"
+
+
+# Queries, always the same strings so sqlite3 reuses the prepared statements
+
+
+SELECT_USER = """
+SELECT
+    timezone, currencies, credit_accounts, next_transaction, next_posting, last_event,
+    last_transaction
+FROM users WHERE id = ?
+"""
+
+UPSERT_USER = """
+INSERT INTO users (
+    id, timezone, currencies, credit_accounts, next_transaction, next_posting, last_event,
+    last_transaction
+)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (id) DO UPDATE SET
+    timezone = excluded.timezone,
+    currencies = excluded.currencies,
+    credit_accounts = excluded.credit_accounts,
+    next_transaction = excluded.next_transaction,
+    next_posting = excluded.next_posting,
+    last_event = excluded.last_event,
+    last_transaction = excluded.last_transaction
+"""
+
+SELECT_TRANSACTIONS = """
+SELECT t.id, t.date, t.info, p.id, p.debit_account, p.credit_account, p.amount, p.currency
+FROM transactions t LEFT JOIN postings p ON p.user_id = t.user_id AND p.transaction_id = t.id
+WHERE t.user_id = ? {where}
+ORDER BY t.id, p.id
+"""
+
+SELECT_ALL_TRANSACTIONS = SELECT_TRANSACTIONS.format(where='')
+SELECT_TRANSACTION = SELECT_TRANSACTIONS.format(where='AND t.id = ?')
+SELECT_LAST_TRANSACTION = SELECT_TRANSACTIONS.format(
+    where='AND t.id = (SELECT max(id) FROM transactions WHERE user_id = ?)'
+)
+
+SELECT_TRANSACTIONS_FROM = SELECT_TRANSACTIONS.format(where='AND t.id >= ?')
+SELECT_TRANSACTIONS_BETWEEN = SELECT_TRANSACTIONS.format(where='AND t.date >= ? AND t.date < ?')
+
+INSERT_TRANSACTION = 'INSERT INTO transactions (user_id, id, date, info) VALUES (?, ?, ?, ?)'
+UPDATE_TRANSACTION = 'UPDATE transactions SET info = ? WHERE user_id = ? AND id = ?'
+DELETE_TRANSACTION = 'DELETE FROM transactions WHERE user_id = ? AND id = ?'
+DELETE_TRANSACTIONS_FROM = 'DELETE FROM transactions WHERE user_id = ? AND id >= ?'
+
+INSERT_POSTING = """
+INSERT INTO postings
+    (user_id, id, transaction_id, debit_account, credit_account, amount, currency)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+DELETE_POSTINGS = 'DELETE FROM postings WHERE user_id = ? AND transaction_id = ?'
+DELETE_POSTINGS_FROM = 'DELETE FROM postings WHERE user_id = ? AND transaction_id >= ?'
+
+SELECT_MESSAGE = """
+SELECT transaction_id, posting_id FROM message_index WHERE user_id = ? AND message_id = ?
+"""
+SELECT_MESSAGES = """
+SELECT message_id, transaction_id, posting_id FROM message_index WHERE user_id = ?
+"""
+SELECT_TRANSACTION_MESSAGES = """
+SELECT message_id, posting_id FROM message_index WHERE user_id = ? AND transaction_id = ?
+ORDER BY message_id DESC
+"""
+UPSERT_MESSAGE = """
+INSERT OR REPLACE INTO message_index (user_id, message_id, transaction_id, posting_id)
+VALUES (?, ?, ?, ?)
+"""
+
+DELETE_TRANSACTION_MESSAGES = """
+DELETE FROM message_index WHERE user_id = ? AND transaction_id = ?
+"""
+DELETE_POSTING_MESSAGES = """
+DELETE FROM message_index WHERE user_id = ? AND transaction_id = ? AND posting_id = ?
+"""
+DELETE_MESSAGE = 'DELETE FROM message_index WHERE user_id = ? AND message_id = ?'
+# Message ids only grow, so this evicts the oldest messages
+EVICT_MESSAGES = """
+DELETE FROM message_index WHERE user_id = ? AND message_id <= (
+    SELECT message_id FROM message_index WHERE user_id = ?
+    ORDER BY message_id DESC LIMIT 1 OFFSET ?
+)
+"""
+
+CLEAR_TRANSACTIONS = 'DELETE FROM transactions WHERE user_id = ?'
+CLEAR_POSTINGS = 'DELETE FROM postings WHERE user_id = ?'
+CLEAR_MESSAGES = 'DELETE FROM message_index WHERE user_id = ?'
+CLEAR_WORDS = 'DELETE FROM words WHERE user_id = ?'
+
+INSERT_WORD = 'INSERT INTO words (user_id, word, posting_id, transaction_id) VALUES (?, ?, ?, ?)'
+DELETE_WORDS = 'DELETE FROM words WHERE user_id = ? AND transaction_id = ?'
+DELETE_WORDS_FROM = 'DELETE FROM words WHERE user_id = ? AND transaction_id >= ?'
+COUNT_WORD = 'SELECT count(*) FROM words WHERE user_id = ? AND word = ?'
+SEARCH_WORD = """
+SELECT p.id, t.id, t.date, t.info, p.debit_account, p.amount, p.currency
+FROM words w
+JOIN transactions t ON t.user_id = w.user_id AND t.id = w.transaction_id
+JOIN postings p ON p.user_id = w.user_id AND p.id = w.posting_id
+WHERE w.user_id = ? AND w.word = ? AND t.date >= ? AND t.date < ?
+ORDER BY t.date, p.id
+"""
+SELECT_POSTING_TEXTS = """
+SELECT p.user_id, p.id, t.id, t.info, p.debit_account
+FROM postings p JOIN transactions t ON t.user_id = p.user_id AND t.id = p.transaction_id
+"""
+
+
+# Storage
+
+
+class SQLiteStorage:
+    """A SQLite database holding the data of every user."""
+
+    def __init__(self, filename: str):
+        self.conn = sqlite3.connect(filename, check_same_thread=False, cached_statements=64)
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+        # Read before the schema creates the missing ones
+        tables = {name for name, in self.conn.execute(SELECT_TABLES)}
+        self.conn.executescript(SCHEMA)
+        self.migrate_schema(tables)
+        # The connection is shared by the dispatcher threads
+        self.lock = threading.RLock()
+
+    def close(self):
+        self.conn.close()
+
+    @contextlib.contextmanager
+    def transaction(self) -> Iterator[None]:
+        """Holds the lock, the changes made inside are committed, or rolled back if it raises.
+
+        The commit writes them to the disk, it's timed like the flushes of the persistences.
+        """
+        with self.lock:
+            try:
+                yield
+            except BaseException:
+                self.conn.rollback()
+                raise
+            with FLUSH_SECONDS.timer():
+                self.conn.commit()
+
+    def migrate_schema(self, tables: Set[str]):
+        """Fills what databases created by older versions lack, `tables` are the ones they had."""
+        with self.conn:
+            columns = {row[1] for row in self.conn.execute('PRAGMA table_info(users)')}
+            if 'last_transaction' not in columns:
+                self.conn.execute('ALTER TABLE users ADD COLUMN last_transaction INTEGER')
+            if 'postings' in tables and 'words' not in tables:
+                self.conn.executemany(
+                    INSERT_WORD,
+                    (
+                        (user_id, word, posting_id, tx_id)
+                        for user_id, posting_id, tx_id, info, account in self.conn.execute(
+                            SELECT_POSTING_TEXTS
+                        )
+                        for word in tokenize(info) | tokenize(account)
+                    ),
+                )
+
+
+class SQLiteDB(DB):
+    """A `DB` that keeps the data of user `user_id` in `storage` instead of `user_data`.
+
+    Only the `history` of /undo and /redo is kept in memory, it's given by the caller.
+    """
+
+    def __init__(
+        self,
+        storage: SQLiteStorage,
+        user_id: int,
+        message_index_size: int = MESSAGE_INDEX_SIZE,
+        history: Optional[History] = None,
+    ):
+        self.message_index_size = message_index_size
+        self.storage = storage
+        self.conn = storage.conn
+        self.user_id = user_id
+        # Written as they are made, nothing is recorded or copied for a persistence
+        self.changes = None
+        # Whether the user row needs to be written
+        self.user_changed = False
+        self.history = history if history is not None else History()
+        self._step = None
+
+        row = self.conn.execute(SELECT_USER, (user_id,)).fetchone()
+        if row is None:
+            self.config = UserConfig()
+            self.next_ids = dict(transaction=1, posting=1)
+            self.vars = {}
+        else:
+            timezone, currencies, credit_accounts, next_tx, next_posting, *user_vars = row
+            self.config = UserConfig(
+                timezone=timezone,
+                currencies=json.loads(currencies),
+                credit_accounts=json.loads(credit_accounts),
+            )
+            self.next_ids = dict(transaction=next_tx, posting=next_posting)
+            last_event, last_transaction = user_vars
+            self.vars = dict(
+                last_event=last_event and datetime.fromisoformat(last_event),
+                last_transaction=last_transaction,
+            )
+
+    @property
+    def transactions(self) -> List[Transaction]:
+        return self._select(SELECT_ALL_TRANSACTIONS, (self.user_id,))
+
+    def iter_transactions(
+        self, start: Optional[datetime] = None, end: Optional[datetime] = None
+    ) -> Iterator[Transaction]:
+        # A separate cursor, so other queries can run while this one is consumed
+        if start is None and end is None:
+            return self._iter_select(SELECT_ALL_TRANSACTIONS, (self.user_id,))
+
+        return self._iter_select(
+            SELECT_TRANSACTIONS_BETWEEN, (self.user_id, *utc_range(start, end))
+        )
+
+    def get_entries_by_message_id(self, message_id: int) -> Tuple[Transaction, Optional[Posting]]:
+        index = self._get_message_entry(message_id)
+        if index is None:
+            raise UserError("This message is too old or was already done, it can't be changed")
+
+        txs = self._select(SELECT_TRANSACTION, (self.user_id, index[0]))
+        if not txs:
+            raise UserError(f'No transaction for message {message_id}')
+
+        tx = txs[0]
+        posting = index[1] and next(filter(lambda v: v.id == index[1], tx.postings), None)
+        if index[1] and posting is None:
+            raise UserError(f'No posting for message {message_id}')
+        return tx, posting
+
+    def process_event(self, event):
+        with self.storage.transaction():
+            result = super().process_event(event)
+            self._save_user()
+        return result
+
+    def undo(self):
+        with self.storage.transaction():
+            result = super().undo()
+            self._save_user()
+        return result
+
+    def redo(self):
+        with self.storage.transaction():
+            result = super().redo()
+            self._save_user()
+        return result
+
+    def _import_block(self, transactions: List[Transaction]):
+        # A commit per block, the lock isn't held while the next one is read and the progress
+        # is sent. If the import fails, the blocks before stay, like with `DB`.
+        with self.storage.transaction():
+            super()._import_block(transactions)
+            self._save_user()
+
+    def clear(self):
+        with self.storage.transaction(), self._undo_step():
+            messages = self.conn.execute(SELECT_MESSAGES, (self.user_id,))
+            self._undoable(
+                'restore',
+                self.transactions,
+                [],
+                {message_id: (tx_id, posting_id) for message_id, tx_id, posting_id in messages},
+            )
+            for query in (CLEAR_WORDS, CLEAR_POSTINGS, CLEAR_TRANSACTIONS, CLEAR_MESSAGES):
+                self.conn.execute(query, (self.user_id,))
+            self.last_event = None
+            self.last_transaction_id = None
+            self._save_user()
+
+    def find_message(
+        self, tx_id: int, posting_id: Optional[int] = None
+    ) -> Optional[Tuple[int, Optional[int]]]:
+        rows = self.conn.execute(SELECT_TRANSACTION_MESSAGES, (self.user_id, tx_id)).fetchall()
+        for message_id, p in rows:
+            if p == posting_id:
+                return message_id, p
+        return rows[0] if rows else None
+
+    def get_totals(self, month: Optional[str] = None) -> Dict[TotalsKey, Decimal]:
+        # Summed from the stored postings, only those of the month are read
+        start = end = None
+        if month is not None:
+            year, number = map(int, month.split('-'))
+            tzinfo = self.config.tzinfo
+            start = timezones.localize(datetime(year, number, 1), tzinfo)
+            end = timezones.localize(datetime(year + number // 12, number % 12 + 1, 1), tzinfo)
+
+        totals = Totals()
+        totals.build(self.iter_transactions(start, end))
+        return totals.get(month)
+
+    def search(
+        self, query: str, start: Optional[datetime] = None, end: Optional[datetime] = None
+    ) -> List[Match]:
+        # Like `SearchIndex.search`, only the postings of the rarest word are read
+        words = tokenize(query)
+        if not words:
+            return []
+        rarest = min(
+            words,
+            key=lambda word: self.conn.execute(COUNT_WORD, (self.user_id, word)).fetchone()[0],
+        )
+        rows = self.conn.execute(SEARCH_WORD, (self.user_id, rarest, *utc_range(start, end)))
+        tzinfo = self.config.tzinfo
+        return [
+            Match(
+                posting_id,
+                tx_id,
+                datetime.fromisoformat(date).astimezone(tzinfo),
+                info,
+                account,
+                Decimal(amount),
+                currency,
+            )
+            for posting_id, tx_id, date, info, account, amount, currency in rows
+            if words <= tokenize(info) | tokenize(account)
+        ]
+
+    def check_totals(self) -> List[str]:
+        # Nothing is kept, so there is nothing to drift
+        return []
+
+    def set_config(self, key: str, value: Any):
+        super().set_config(key, value)
+        with self.storage.transaction():
+            self._save_user()
+
+    def update_message_index(self, message_id: int, tx: Transaction, posting: Posting):
+        assert message_id is not None
+        assert tx.id is not None
+        with self.storage.transaction():
+            self.conn.execute(
+                UPSERT_MESSAGE, (self.user_id, message_id, tx.id, posting and posting.id)
+            )
+            self.conn.execute(
+                EVICT_MESSAGES, (self.user_id, self.user_id, self.message_index_size)
+            )
+
+    # Storage
+
+    def _select(self, query: str, params: Tuple) -> List[Transaction]:
+        return list(self._iter_select(query, params))
+
+    def _iter_select(self, query: str, params: Tuple) -> Iterator[Transaction]:
+        rows = self.conn.execute(query, params)
+        tzinfo = self.config.tzinfo
+        for (tx_id, date, info), group in groupby(rows, key=lambda row: row[:3]):
+            yield Transaction(
+                id=tx_id,
+                date=datetime.fromisoformat(date).astimezone(tzinfo),
+                info=info,
+                postings=[
+                    Posting(
+                        id=row[3],
+                        debit_account=row[4],
+                        credit_account=row[5],
+                        amount=Decimal(row[6]),
+                        currency=row[7],
+                    )
+                    for row in group
+                    if row[3] is not None
+                ],
+            )
+
+    def _save_user(self):
+        if not self.user_changed:
+            return
+        self.user_changed = False
+
+        last_event = self.last_event
+        self.conn.execute(
+            UPSERT_USER,
+            (
+                self.user_id,
+                self.config.timezone,
+                json.dumps(self.config.currencies),
+                json.dumps(self.config.credit_accounts),
+                self.next_ids['transaction'],
+                self.next_ids['posting'],
+                last_event and last_event.isoformat(),
+                self.last_transaction_id,
+            ),
+        )
+
+    def _changed(self, key: str):
+        self.user_changed = True
+
+    def _insert_transaction(self, tx: Transaction):
+        self.conn.execute(
+            INSERT_TRANSACTION,
+            (self.user_id, tx.id, tx.date.astimezone(timezone.utc).isoformat(), tx.info),
+        )
+
+    def _get_transaction(self, tx_id: int) -> Optional[Transaction]:
+        txs = self._select(SELECT_TRANSACTION, (self.user_id, tx_id))
+        return txs[0] if txs else None
+
+    def _get_last_transaction(self) -> Optional[Transaction]:
+        txs = self._select(SELECT_LAST_TRANSACTION, (self.user_id, self.user_id))
+        return txs[0] if txs else None
+
+    def _get_message_entry(self, message_id: int) -> Optional[Tuple[int, Optional[int]]]:
+        return self.conn.execute(SELECT_MESSAGE, (self.user_id, message_id)).fetchone()
+
+    def _unindex_messages(self, tx_id: int, posting_id: Optional[int] = None):
+        if self._step is not None:
+            for message_id, p in self.conn.execute(
+                SELECT_TRANSACTION_MESSAGES, (self.user_id, tx_id)
+            ).fetchall():
+                if posting_id is None or p == posting_id:
+                    self._undoable('index', message_id, (tx_id, p))
+
+        if posting_id is None:
+            self.conn.execute(DELETE_TRANSACTION_MESSAGES, (self.user_id, tx_id))
+        else:
+            self.conn.execute(DELETE_POSTING_MESSAGES, (self.user_id, tx_id, posting_id))
+
+    def _set_message_entry(self, message_id: int, entry: Optional[Tuple[int, Optional[int]]]):
+        self._undoable('index', message_id, self._get_message_entry(message_id))
+        if entry is None:
+            self.conn.execute(DELETE_MESSAGE, (self.user_id, message_id))
+        else:
+            self.conn.execute(UPSERT_MESSAGE, (self.user_id, message_id, *entry))
+
+    def _restore(
+        self,
+        transactions: List[Transaction],
+        blocks: List[Block],
+        message_id_index: Dict[int, Tuple[int, Optional[int]]],
+    ):
+        self._undoable('clear')
+        self._add_transactions(transactions)
+        self.conn.executemany(
+            UPSERT_MESSAGE,
+            (
+                (self.user_id, message_id, tx_id, posting_id)
+                for message_id, (tx_id, posting_id) in message_id_index.items()
+            ),
+        )
+
+    def _add_transactions(self, transactions: List[Transaction]):
+        self.conn.executemany(
+            INSERT_TRANSACTION,
+            (
+                (self.user_id, tx.id, tx.date.astimezone(timezone.utc).isoformat(), tx.info)
+                for tx in transactions
+            ),
+        )
+        self.conn.executemany(INSERT_POSTING, self._posting_rows(transactions))
+        self.conn.executemany(INSERT_WORD, self._word_rows(transactions))
+
+    def _remove_transactions(self, tx_id: int) -> List[Transaction]:
+        removed = self._select(SELECT_TRANSACTIONS_FROM, (self.user_id, tx_id))
+        self.conn.execute(DELETE_WORDS_FROM, (self.user_id, tx_id))
+        self.conn.execute(DELETE_POSTINGS_FROM, (self.user_id, tx_id))
+        self.conn.execute(DELETE_TRANSACTIONS_FROM, (self.user_id, tx_id))
+        return removed
+
+    def _insert_posting(self, tx: Transaction, posting: Posting, position: Optional[int] = None):
+        tx.postings.insert(len(tx.postings) if position is None else position, posting)
+
+    def _remove_posting(self, tx: Transaction, posting: Posting):
+        tx.postings.remove(posting)
+
+    def _save_transaction(self, tx: Transaction):
+        self.conn.execute(UPDATE_TRANSACTION, (tx.info, self.user_id, tx.id))
+        self.conn.execute(DELETE_POSTINGS, (self.user_id, tx.id))
+        self.conn.execute(DELETE_WORDS, (self.user_id, tx.id))
+        self.conn.executemany(INSERT_POSTING, self._posting_rows([tx]))
+        self.conn.executemany(INSERT_WORD, self._word_rows([tx]))
+
+    def _delete_transaction(self, tx: Transaction):
+        self.conn.execute(DELETE_POSTINGS, (self.user_id, tx.id))
+        self.conn.execute(DELETE_WORDS, (self.user_id, tx.id))
+        self.conn.execute(DELETE_TRANSACTION, (self.user_id, tx.id))
+
+    def _count_posting(self, tx: Transaction, posting: Posting, sign: int = 1):
+        pass
+
+    def _archive_transactions(self, now: datetime):
+        # Transactions are only read when needed, there is nothing to move out of memory
+        pass
+
+    def _posting_rows(self, txs: Iterable[Transaction]):
+        for tx in txs:
+            for p in tx.postings:
+                yield (
+                    self.user_id,
+                    p.id,
+                    tx.id,
+                    p.debit_account,
+                    p.credit_account,
+                    str(p.amount),
+                    p.currency,
+                )
+
+    def _word_rows(self, txs: Iterable[Transaction]):
+        for tx in txs:
+            info_words = tokenize(tx.info)
+            for p in tx.postings:
+                for word in info_words | tokenize(p.debit_account):
+                    yield (self.user_id, word, p.id, tx.id)
+
+    # Migration
+
+    def import_db(self, db: DB):
+        """Copies everything in `db` into this user, replacing what was there."""
+        with self.storage.transaction():
+            for query in (CLEAR_WORDS, CLEAR_POSTINGS, CLEAR_TRANSACTIONS, CLEAR_MESSAGES):
+                self.conn.execute(query, (self.user_id,))
+
+            self.config = db.config
+            self.next_ids = dict(db.next_ids)
+            self.vars = dict(last_event=db.last_event, last_transaction=db.last_transaction_id)
+            self.user_changed = True
+            self._save_user()
+
+            self.conn.executemany(
+                INSERT_TRANSACTION,
+                (
+                    (self.user_id, tx.id, tx.date.astimezone(timezone.utc).isoformat(), tx.info)
+                    for tx in db.iter_transactions()
+                ),
+            )
+            self.conn.executemany(INSERT_POSTING, self._posting_rows(db.iter_transactions()))
+            self.conn.executemany(INSERT_WORD, self._word_rows(db.iter_transactions()))
+            self.conn.executemany(
+                UPSERT_MESSAGE,
+                (
+                    (self.user_id, message_id, tx_id, posting_id)
+                    for message_id, (tx_id, posting_id) in db.message_id_index.items()
+                ),
+            )
+
+
+def utc_range(start: Optional[datetime], end: Optional[datetime]) -> Tuple[str, str]:
+    """Returns the dates to compare stored ones with, the range is open without them."""
+    # Dates are stored as ISO strings in UTC, which sort chronologically
+    start_string = '0' if start is None else start.astimezone(timezone.utc).isoformat()
+    end_string = '9' if end is None else end.astimezone(timezone.utc).isoformat()
+    return start_string, end_string
+
+
+def migrate(pickle_filename: str, storage: SQLiteStorage) -> int:
+    """Imports the users of a `PicklePersistence` file, returns how many were imported."""
+    with open(pickle_filename, 'rb') as file:
+        data = pickle.load(file)
+
+    user_data = data.get('user_data') or {}
+    for user_id, value in user_data.items():
+        SQLiteDB(storage, user_id).import_db(DB(value))
+    return len(user_data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert a db.pickle file into SQLite.')
+    parser.add_argument('pickle', help='PicklePersistence file')
+    parser.add_argument('sqlite', help='SQLite database, created if it does not exist')
+    args = parser.parse_args()
+
+    storage = SQLiteStorage(args.sqlite)
+    count = migrate(args.pickle, storage)
+    storage.close()
+
+    print(f'Imported {count} users')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+from datetime import datetime, tzinfo
+from functools import lru_cache
+
+from .errors import UserError
+
+
+# Timezones
+
+
+# Either pytz or zoneinfo, the latter doesn't need pytz to be imported at all
+BACKENDS = ('pytz', 'zoneinfo')
+
+backend = 'pytz'
+
+
+def set_backend(name: str):
+    global backend
+    if name not in BACKENDS:
+        raise ValueError(f'Unknown timezone backend {name}')
+    backend = name
+    get_timezone.cache_clear()
+
+
+@lru_cache(maxsize=None)
+def get_timezone(name: str) -> tzinfo:
+    """Returns the tzinfo of an IANA timezone, looking it up only the first time."""
+    if backend == 'zoneinfo':
+        import zoneinfo
+
+        try:
+            return zoneinfo.ZoneInfo(name)
+        except (zoneinfo.ZoneInfoNotFoundError, ValueError) as ex:
+            raise UserError(f'Invalid IANA timezone: {name}') from ex
+    else:
+        import pytz
+
+        try:
+            return pytz.timezone(name)
+        except pytz.UnknownTimeZoneError as ex:
+            raise UserError(f'Invalid IANA timezone: {name}') from ex
+
+
+def localize(value: datetime, tz: tzinfo) -> datetime:
+    """Sets the timezone of a naive datetime."""
+    if hasattr(tz, 'localize'):  # pytz
+        return tz.localize(value)
+    return value.replace(tzinfo=tz)
@@ -0,0 +1,141 @@
+"""Webhook mode, Telegram posts the updates to a local HTTP server instead of being polled.
+
+Updates are handed to a fixed number of workers through bounded queues. All the updates of a user
+go to the same worker, so they are handled in order and never at the same time. When a queue is
+full the server answers 503 and Telegram sends the update again later, that way a burst of updates
+slows down the intake instead of piling up in memory.
+"""
+import json
+import logging
+import signal
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Full, Queue
+from typing import Dict, List, Optional
+
+import telegram
+from telegram.ext import Dispatcher
+
+
+logger = logging.getLogger(__name__)
+
+WORKERS = 1
+QUEUE_SIZE = 100
+
+# Seconds Telegram is asked to wait before retrying when the queues are full
+RETRY_AFTER = 1
+
+
+class WebhookServer:
+    def __init__(
+        self,
+        dispatcher: Dispatcher,
+        listen: str = '127.0.0.1',
+        port: int = 8443,
+        url_path: str = '/',
+        workers: int = WORKERS,
+        queue_size: int = QUEUE_SIZE,
+    ):
+        self.dispatcher = dispatcher
+        self.url_path = url_path
+        self.queues: List['Queue[Optional[telegram.Update]]'] = [
+            Queue(maxsize=queue_size) for _ in range(workers)
+        ]
+        self.workers = [
+            threading.Thread(target=self.work, args=(queue,), name=f'webhook-worker-{i}')
+            for i, queue in enumerate(self.queues)
+        ]
+
+        self.httpd = ThreadingHTTPServer((listen, port), WebhookHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.webhook = self  # type: ignore[attr-defined]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='webhook-server')
+
+    @property
+    def port(self) -> int:
+        return self.httpd.server_address[1]
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+        self.thread.start()
+        logger.info('Webhook listening on port %s', self.port)
+
+    def stop(self):
+        """Stops receiving updates and waits until the queued ones are handled."""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+        for queue in self.queues:
+            queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def idle(self, stop_signals=(signal.SIGINT, signal.SIGTERM, signal.SIGABRT)):
+        """Blocks until one of `stop_signals` is received, then stops."""
+        stopped = threading.Event()
+        for sig in stop_signals:
+            signal.signal(sig, lambda signum, frame: stopped.set())
+        while not stopped.wait(1):
+            pass
+        self.stop()
+
+    def submit(self, update: telegram.Update) -> bool:
+        """Queues an update, returns False if its queue is full."""
+        if update.effective_user is not None:
+            key = update.effective_user.id
+        elif update.effective_chat is not None:
+            key = update.effective_chat.id
+        else:
+            key = update.update_id
+
+        try:
+            self.queues[key % len(self.queues)].put_nowait(update)
+        except Full:
+            logger.warning('Webhook queue is full, update %s rejected', update.update_id)
+            return False
+        return True
+
+    def work(self, queue: 'Queue[Optional[telegram.Update]]'):
+        while True:
+            update = queue.get()
+            if update is None:
+                return
+            try:
+                self.dispatcher.process_update(update)
+            except Exception:
+                logger.exception('Failed to process update %s', update.update_id)
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    server: ThreadingHTTPServer
+
+    def do_POST(self):
+        webhook: WebhookServer = self.server.webhook  # type: ignore[attr-defined]
+        if self.path != webhook.url_path:
+            self.respond(404)
+            return
+
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            update = telegram.Update.de_json(json.loads(body), webhook.dispatcher.bot)
+            if update is None:
+                raise ValueError('Empty update')
+        except (ValueError, TypeError, KeyError, AttributeError):
+            self.respond(400)
+            return
+
+        if webhook.submit(update):
+            self.respond(200)
+        else:
+            self.respond(503, {'Retry-After': str(RETRY_AFTER)})
+
+    def respond(self, code: int, headers: Optional[Dict[str, str]] = None):
+        self.send_response(code)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format: str, *args):
+        logger.debug(format, *args)
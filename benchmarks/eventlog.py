@@ -0,0 +1,114 @@
+"""Measures how fast a user is loaded from its event log, the time compaction bounds.
+
+    python -m benchmarks.eventlog [--events 10000 100000 1000000] [--tail 10000]
+
+For each count, a user sends that many messages and presses buttons like in the bot, which
+`EventLogPersistence` writes to its log. Reports the size of the log and the operations per second
+of loading the user by applying all of them, then the time to load it from a snapshot followed
+by `--tail` operations, which is what compaction leaves.
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from collections import deque
+from datetime import timedelta
+from typing import Deque
+
+from beanbot import parser
+from beanbot.db import DB
+from beanbot.errors import UserError
+from beanbot.models import Action, Event
+from beanbot.persistence import EventLogPersistence
+
+from . import synthetic
+
+
+EVENTS = [10_000, 100_000, 1_000_000]
+
+USER_ID = 1
+
+# Operations are written in batches like the flushes of the bot
+FLUSH_EVERY = 1_000
+
+
+def write_events(persistence: EventLogPersistence, count: int, seed: int) -> DB:
+    """Sends `count` messages and button presses to a user, returns its data."""
+    rng = random.Random(seed)
+    user_data = persistence.get_user_data()[USER_ID]
+    db = DB(user_data)
+    # Set like the user would, so it's in the log
+    config = synthetic.make_config()
+    for key in ('timezone', 'currencies', 'credit_accounts'):
+        db.set_config(key, getattr(config, key))
+
+    date = db.last_event or synthetic.START_DATE
+    message_id = max(db.message_id_index, default=0)
+    # Messages with a posting, the ones with buttons
+    recent: Deque[int] = deque(maxlen=100)
+    for i in range(count):
+        date += timedelta(minutes=rng.choice([1, 2, 10, 60, 600]))
+        if recent and rng.random() < 0.2:
+            action = rng.choice([Action.SET_CURRENCY, Action.SET_CREDIT_ACCOUNT])
+            event = Event(action, rng.randrange(3), message_id=rng.choice(recent))
+        else:
+            event = parser.parse_message(synthetic.make_message(rng))
+        event.date = date
+        try:
+            tx, posting = db.process_event(event)
+        except UserError:
+            pass
+        else:
+            message_id += 1
+            db.update_message_index(message_id, tx, posting)
+            if posting:
+                recent.append(message_id)
+        persistence.update_user_data(USER_ID, user_data)
+        if i % FLUSH_EVERY == 0:
+            persistence.flush()
+    persistence.flush()
+    return db
+
+
+def load(directory: str) -> float:
+    start = time.perf_counter()
+    EventLogPersistence(directory).get_user_data()[USER_ID]
+    return time.perf_counter() - start
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('--events', type=int, nargs='+', default=EVENTS)
+    arg_parser.add_argument('--tail', type=int, default=10_000, help='events after the snapshot')
+    arg_parser.add_argument('--seed', type=int, default=0)
+    args = arg_parser.parse_args()
+
+    print(f'{"events":>10}{"log MiB":>10}{"ops/s":>12}{"replay":>10}{"snapshot":>10}')
+    for count in args.events:
+        with tempfile.TemporaryDirectory() as directory:
+            # Never compacted, all of them are replayed
+            persistence = EventLogPersistence(
+                directory, compact_min_size=2**62, flush_interval=3600
+            )
+            write_events(persistence, count, args.seed)
+            journal = persistence.shards[USER_ID].journal
+            size = os.path.getsize(journal.filename)
+            operations = sum(1 for _ in journal.replay())
+            replay = load(directory)
+
+            # Then compacted, with a tail like the one a compaction would leave
+            shard, user_data = persistence.shards[USER_ID], persistence.user_data[USER_ID]
+            persistence.compact_user(USER_ID, shard, user_data)
+            write_events(persistence, args.tail, args.seed + 1)
+            snapshot = load(directory)
+
+        print(
+            f'{count:>10}{size / 2**20:>10.1f}{operations / replay:>12.0f}'
+            f'{replay:>9.2f}s{snapshot:>9.2f}s',
+            flush=True,
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Measures how many rows per minute are imported from an uploaded CSV file or Beancount ledger.
+
+    python -m benchmarks.importer [--rows 10000 100000] [--engines memory sqlite]
+
+The files are the synthetic history, written by `/beancount` or as a CSV with a posting per row.
+Each one is imported into an empty user, recording changes like the journal persistence does, or
+into SQLite. The target is 100k rows per minute.
+"""
+import argparse
+import csv
+import os
+import tempfile
+import time
+from typing import List
+
+from beanbot import bot, export
+from beanbot.db import DB, Changes
+from beanbot.models import Transaction
+from beanbot.sqlite import SQLiteDB, SQLiteStorage
+
+from . import synthetic
+
+
+ROWS = [10_000, 100_000]
+ENGINES = ['memory', 'sqlite']
+
+
+def make_transactions(rows: int, seed: int) -> List[Transaction]:
+    """Returns synthetic transactions with about `rows` postings."""
+    # 3.9 postings per transaction on average, see `synthetic.POSTING_COUNTS`
+    db = synthetic.make_history(rows * 10 // 39, seed)
+    return list(db.iter_transactions())
+
+
+def write_csv(filename: str, transactions: List[Transaction]) -> int:
+    count = 0
+    with open(filename, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(('date', 'info', 'debit_account', 'credit_account', 'amount', 'currency'))
+        for tx in transactions:
+            for i, p in enumerate(tx.postings):
+                # The postings after the first one continue its transaction
+                date, info = ('', '') if i else (tx.date.isoformat(), tx.info)
+                writer.writerow(
+                    (date, info, p.debit_account, p.credit_account, p.amount, p.currency)
+                )
+                count += 1
+    return count
+
+
+def write_beancount(filename: str, transactions: List[Transaction]) -> int:
+    with open(filename, 'w', encoding='utf-8') as f:
+        f.writelines(export.iter_beancount(transactions))
+    return sum(len(tx.postings) for tx in transactions)
+
+
+def bench_import(engine: str, filename: str, directory: str) -> float:
+    """Returns the seconds to import `filename` into an empty user."""
+    if engine == 'sqlite':
+        storage = SQLiteStorage(os.path.join(directory, f'{time.monotonic_ns()}.sqlite3'))
+        db: DB = SQLiteDB(storage, 1)
+    else:
+        storage = None
+        db = DB(dict(config=synthetic.make_config(), changes=Changes()))
+
+    start = time.perf_counter()
+    with open(filename, 'rb') as file:
+        bot.import_file(db, file, os.path.basename(filename), lambda count: None)
+    elapsed = time.perf_counter() - start
+
+    if storage is not None:
+        storage.close()
+    return elapsed
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('--rows', type=int, nargs='+', default=ROWS)
+    arg_parser.add_argument('--engines', nargs='+', default=ENGINES)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    args = arg_parser.parse_args()
+
+    print(f'{"rows":>10}{"format":>12}{"engine":>10}{"seconds":>10}{"rows/min":>12}')
+    with tempfile.TemporaryDirectory() as directory:
+        for rows in args.rows:
+            transactions = make_transactions(rows, args.seed)
+            for name, write in (('csv', write_csv), ('beancount', write_beancount)):
+                filename = os.path.join(directory, f'ledger.{name}')
+                count = write(filename, transactions)
+                for engine in args.engines:
+                    elapsed = bench_import(engine, filename, directory)
+                    print(
+                        f'{count:>10}{name:>12}{engine:>10}{elapsed:>10.2f}'
+                        f'{count / elapsed * 60:>12,.0f}',
+                        flush=True,
+                    )
+
+
+if __name__ == '__main__':
+    main()
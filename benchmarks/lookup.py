@@ -0,0 +1,47 @@
+"""Measures `DB.get_entries_by_message_id` as the history grows.
+
+    python -m benchmarks.lookup [sizes...]
+"""
+import random
+import sys
+import time
+from datetime import datetime
+from decimal import Decimal
+
+import pytz
+
+from beanbot.db import DB
+from beanbot.models import Posting, Transaction
+
+
+def make_db(size: int) -> DB:
+    db = DB({})
+    date = datetime(2021, 1, 1, tzinfo=pytz.utc)
+    for i in range(1, size + 1):
+        tx = Transaction(i, date, '', postings=[Posting(i, 'Food', 'Cash', Decimal(1), 'USD')])
+        db.transactions.append(tx)
+        db.message_id_index[i] = (i, i)
+    db.next_ids.update(transaction=size + 1, posting=size + 1)
+    return db
+
+
+def bench(size: int, lookups: int = 100_000) -> float:
+    """Returns the mean lookup time in microseconds."""
+    db = make_db(size)
+    db.get_entries_by_message_id(1)  # Builds the index
+
+    message_ids = [random.randint(1, size) for _ in range(lookups)]
+    start = time.perf_counter()
+    for message_id in message_ids:
+        db.get_entries_by_message_id(message_id)
+    return (time.perf_counter() - start) / lookups * 1e6
+
+
+def main():
+    sizes = [int(v) for v in sys.argv[1:]] or [100, 1_000, 10_000, 100_000, 1_000_000]
+    for size in sizes:
+        print(f'{size:>10} transactions: {bench(size):.3f} us/lookup')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""Measures the memory and pickle size of postings, before and after they had slots.
+
+    python -m benchmarks.memory [count]
+"""
+import pickle
+import sys
+import tracemalloc
+from dataclasses import dataclass
+from decimal import Decimal
+from typing import Optional
+
+from beanbot.models import Posting
+
+
+ACCOUNTS = ['Food', 'Transport', 'Coffee', 'Rent', 'Books']
+CREDIT_ACCOUNTS = ['Cash', 'CC', 'Other']
+CURRENCIES = ['USD', 'EUR']
+
+
+@dataclass
+class LegacyPosting:
+    id: Optional[int]
+    debit_account: str
+    credit_account: str
+    amount: Decimal
+    currency: str
+
+
+def copy(s: str) -> str:
+    # A new string object, like the ones loaded from a journal record or a database row
+    return ''.join(list(s))
+
+
+def make_postings(cls, count: int):
+    return [
+        cls(
+            i,
+            copy(ACCOUNTS[i % len(ACCOUNTS)]),
+            copy(CREDIT_ACCOUNTS[i % len(CREDIT_ACCOUNTS)]),
+            Decimal(i % 100),
+            copy(CURRENCIES[i % len(CURRENCIES)]),
+        )
+        for i in range(count)
+    ]
+
+
+def bench(cls, count: int):
+    """Returns the bytes per posting in memory and in a pickle."""
+    tracemalloc.start()
+    postings = make_postings(cls, count)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    size = len(pickle.dumps(postings, protocol=pickle.HIGHEST_PROTOCOL))
+    return memory / count, size / count
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    for name, cls in [('before', LegacyPosting), ('after', Posting)]:
+        memory, size = bench(cls, count)
+        print(f'{name:>6}: {memory:.1f} bytes/posting in memory, {size:.1f} in pickle')
+
+
+if __name__ == '__main__':
+    main()
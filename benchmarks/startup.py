@@ -0,0 +1,192 @@
+"""Measures how long the bot takes to start with a large history.
+
+    python -m benchmarks.startup [--users 200] [--size 10000] [--runs 3]
+
+Reports the time to import `beanbot.bot` and, for each persistence, the time from starting the
+process until the first update is answered. The bot runs against a fake Bot API that sends it a
+message from a user with `--size` transactions, among `--users` users like them.
+"""
+import argparse
+import json
+import os
+import pickle
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List
+
+from beanbot.persistence import JournalPersistence
+
+from . import synthetic
+
+
+PERSISTENCES = ['pickle', 'journal']
+
+# Seconds to wait for the bot to answer
+TIMEOUT = 120
+
+IMPORT_SCRIPT = (
+    'import time; start = time.perf_counter(); import beanbot.bot; '
+    'print(time.perf_counter() - start)'
+)
+
+
+# Data
+
+
+def make_user_data(users: int, size: int, seed: int) -> Dict[int, Dict[str, Any]]:
+    data = pickle.dumps(synthetic.make_user_data(size, seed))
+    # Copies, so they aren't shared in the pickle
+    return {user_id: pickle.loads(data) for user_id in range(1, users + 1)}
+
+
+def write_pickle(filename: str, user_data: Dict[int, Dict[str, Any]]):
+    with open(filename, 'wb') as f:
+        pickle.dump(dict(user_data=user_data, chat_data={}, bot_data={}, conversations={}), f)
+
+
+def write_journal(filename: str, user_data: Dict[int, Dict[str, Any]]):
+    persistence = JournalPersistence(filename)
+    persistence.get_user_data().update(user_data)
+    persistence.compact()
+    persistence.flush()
+
+
+# Fake Bot API
+
+
+class FakeBotAPI(ThreadingHTTPServer):
+    """Sends a single message to the bot and records when it's answered."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeBotAPIHandler)
+        self.update_sent = False
+        self.answered = threading.Event()
+        self.answered_at = 0.0
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}/bot'
+
+    def handle_error(self, request, client_address):
+        # The bot is killed while polling
+        pass
+
+    def call(self, method: str) -> Any:
+        if method == 'getMe':
+            return dict(id=1000, is_bot=True, first_name='Beanbot', username='beanbot')
+        if method == 'getUpdates':
+            if self.update_sent:
+                time.sleep(0.1)
+                return []
+            self.update_sent = True
+            user = dict(id=1, is_bot=False, first_name='User')
+            chat = dict(id=1, type='private')
+            message = dict(message_id=1, date=0, chat=chat, text='Coffee 3.5', **{'from': user})
+            return [dict(update_id=1, message=message)]
+        if method == 'sendMessage':
+            self.answered_at = time.perf_counter()
+            self.answered.set()
+            return dict(message_id=2, date=0, chat=dict(id=1, type='private'), text='')
+        return True
+
+
+class FakeBotAPIHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        result = self.server.call(self.path.rsplit('/', 1)[-1])
+
+        body = json.dumps(dict(ok=True, result=result)).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Benchmarks
+
+
+def bench_import() -> float:
+    output = subprocess.run(
+        [sys.executable, '-c', IMPORT_SCRIPT], check=True, capture_output=True, text=True
+    ).stdout
+    return float(output)
+
+
+def bench_first_update(persistence: str, db_path: str) -> float:
+    """Returns the seconds from starting the bot until it answers the first update."""
+    api = FakeBotAPI()
+    threading.Thread(target=api.serve_forever, daemon=True).start()
+    env = dict(
+        os.environ,
+        BOT_TOKEN='123:TOKEN',
+        BOT_API_URL=api.url,
+        DB_PATH=db_path,
+        DB_PERSISTENCE=persistence,
+    )
+
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, '-c', 'from beanbot import bot; bot.run()'],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        if not api.answered.wait(TIMEOUT):
+            raise TimeoutError(f'The bot did not answer in {TIMEOUT}s')
+        return api.answered_at - start
+    finally:
+        # Killed, the copy of the data it would write isn't needed
+        process.kill()
+        process.wait()
+        api.shutdown()
+        api.server_close()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('--users', type=int, default=200)
+    arg_parser.add_argument('--size', type=int, default=10_000, help='transactions per user')
+    arg_parser.add_argument('--runs', type=int, default=3)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--persistences', nargs='+', default=PERSISTENCES)
+    args = arg_parser.parse_args()
+
+    import_timings = [bench_import() for _ in range(args.runs)]
+    median = statistics.median(import_timings)
+    print(f'{"import beanbot.bot":<30}{median * 1e3:>10.0f} ms', flush=True)
+
+    user_data = make_user_data(args.users, args.size, args.seed)
+    with tempfile.TemporaryDirectory() as directory:
+        for persistence in args.persistences:
+            db_path = os.path.join(directory, f'db.{persistence}')
+            write = write_pickle if persistence == 'pickle' else write_journal
+            write(db_path, user_data)
+            size = os.path.getsize(db_path)
+
+            timings: List[float] = []
+            for _ in range(args.runs):
+                # Answering writes the data, start every run from the same file
+                with open(db_path, 'rb') as f:
+                    original = f.read()
+                timings.append(bench_first_update(persistence, db_path))
+                with open(db_path, 'wb') as f:
+                    f.write(original)
+
+            name = f'first update [{persistence}, {size / 2**20:.0f} MiB]'
+            print(f'{name:<30}{statistics.median(timings) * 1e3:>10.0f} ms', flush=True)
+
+
+if __name__ == '__main__':
+    main()
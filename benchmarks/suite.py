@@ -0,0 +1,275 @@
+"""Measures the parser, the database, the formatter and persistence over synthetic histories.
+
+    python -m benchmarks.suite [--sizes 1000 100000] [--save results.json]
+    python -m benchmarks.suite --compare results.json
+
+Reports operations per second, p50/p99 latency and the peak memory allocated while running. The
+results can be saved as JSON and used as a baseline to find regressions in a later commit.
+"""
+import argparse
+import json
+import pickle
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from beanbot import formatter, parser
+from beanbot.bot import make_actions_keyboard
+from beanbot.db import DB
+from beanbot.errors import UserError
+
+from . import synthetic
+
+
+SIZES = [1_000, 10_000, 100_000]
+
+# Latency is measured on every operation, memory only on the first few
+MEMORY_OPS = 1_000
+
+Result = Dict[str, Any]
+
+
+def measure(op: Callable, args: Sequence[tuple], memory_args: Optional[Sequence[tuple]] = None):
+    """Calls `op` with each of `args` and returns its stats.
+
+    Memory is measured in another run, over `memory_args` if the first one can't be repeated.
+    """
+    timings = []
+    for a in args:
+        start = time.perf_counter_ns()
+        op(*a)
+        timings.append(time.perf_counter_ns() - start)
+
+    if memory_args is None:
+        memory_args = args[:MEMORY_OPS]
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    for a in memory_args:
+        op(*a)
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+
+    timings.sort()
+    return dict(
+        ops=len(timings),
+        ops_per_sec=len(timings) / (sum(timings) / 1e9),
+        p50_us=percentile(timings, 0.50) / 1e3,
+        p99_us=percentile(timings, 0.99) / 1e3,
+        peak_kib=peak / 1024,
+    )
+
+
+def percentile(values: List[int], q: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+# Benchmarks
+
+
+def bench_parse_message(ops: int, seed: int) -> Result:
+    messages = synthetic.make_messages(ops, seed)
+    return measure(parser.parse_message, [(m,) for m in messages])
+
+
+def bench_history(size: int, seed: int) -> Tuple[DB, Result]:
+    tracemalloc.start()
+    start = time.perf_counter()
+    db = synthetic.make_history(size, seed)
+    elapsed = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return db, dict(ops=size, ops_per_sec=size / elapsed, peak_kib=memory / 1024)
+
+
+def bench_get_entries_by_message_id(db: DB, ops: int, seed: int) -> Result:
+    rng = random.Random(seed)
+    message_ids = list(db.message_id_index)
+    db.get_entries_by_message_id(message_ids[-1])  # Builds the index
+    return measure(db.get_entries_by_message_id, [(rng.choice(message_ids),) for _ in range(ops)])
+
+
+def bench_get_totals(db: DB, ops: int, seed: int) -> Result:
+    rng = random.Random(seed)
+    db.get_totals()  # Builds the totals
+    months = list(db.totals.months)
+    return measure(db.get_totals, [(rng.choice(months),) for _ in range(ops)])
+
+
+def bench_format_transaction(db: DB, ops: int, seed: int) -> Result:
+    rng = random.Random(seed)
+    currency = db.config.currencies[0]
+    return measure(
+        formatter.format_transaction,
+        [(rng.choice(db.transactions), currency) for _ in range(ops)],
+    )
+
+
+def bench_make_actions_keyboard(db: DB, ops: int, seed: int) -> Result:
+    rng = random.Random(seed)
+    args = []
+    for _ in range(ops):
+        tx = rng.choice(db.transactions)
+        args.append((db.config, tx, rng.choice(tx.postings)))
+    return measure(make_actions_keyboard, args)
+
+
+def bench_process_event(db: DB, ops: int, seed: int) -> Result:
+    """Text messages and buttons, it changes the database."""
+    rng = random.Random(seed)
+
+    def make_events(count: int):
+        # Some messages are sent right after the previous one, so they join its transaction
+        date = max(db.last_event or synthetic.START_DATE, db.transactions[-1].date)
+        events = []
+        for message in synthetic.make_messages(count, rng.random()):
+            date += timedelta(minutes=rng.choice([1, 2, 10, 60, 600]))
+            event = parser.parse_message(message)
+            event.date = date
+            events.append(event)
+        events.extend(synthetic.make_button_events(db, count // 4, rng.random()))
+        rng.shuffle(events)
+        return [(e,) for e in events]
+
+    def process_event(event):
+        # Buttons of transactions archived in the meantime fail, like they would in the bot
+        try:
+            db.process_event(event)
+        except UserError:
+            pass
+
+    args = make_events(ops)
+    return measure(process_event, args, make_events(MEMORY_OPS))
+
+
+def bench_pickle(db: DB, ops: int, seed: int) -> Result:
+    """Dumps and loads the whole user data, like `PicklePersistence` does."""
+    user_data = dict(
+        transactions=db.transactions,
+        archive=db.archive,
+        config=db.config,
+        next_ids=db.next_ids,
+        message_id_index=db.message_id_index,
+        vars=db.vars,
+    )
+
+    def round_trip():
+        pickle.loads(pickle.dumps(user_data, protocol=pickle.HIGHEST_PROTOCOL))
+
+    result = measure(round_trip, [()] * ops, [()])
+    result['bytes'] = len(pickle.dumps(user_data, protocol=pickle.HIGHEST_PROTOCOL))
+    return result
+
+
+def run(
+    sizes: List[int], ops: int, seed: int, only: Optional[List[str]] = None
+) -> Dict[str, Result]:
+    results = {}
+
+    def record(name: str, result: Result):
+        results[name] = result
+        print(format_result(name, result), flush=True)
+
+    def enabled(name: str) -> bool:
+        return not only or any(o in name for o in only)
+
+    if enabled('parse_message'):
+        record('parse_message', bench_parse_message(ops, seed))
+
+    for size in sizes:
+        db, result = bench_history(size, seed)
+        record(f'history[{size}]', result)
+
+        # Read only benchmarks first, then the ones that change the database
+        benchmarks = [
+            ('get_entries_by_message_id', bench_get_entries_by_message_id, ops),
+            ('get_totals', bench_get_totals, ops),
+            ('format_transaction', bench_format_transaction, ops),
+            ('make_actions_keyboard', bench_make_actions_keyboard, ops),
+            ('pickle', bench_pickle, 3),
+            ('process_event', bench_process_event, ops),
+        ]
+        for name, bench, bench_ops in benchmarks:
+            name = f'{name}[{size}]'
+            if enabled(name):
+                record(name, bench(db, bench_ops, seed))
+
+        del db
+
+    return results
+
+
+# Reporting
+
+
+def format_result(name: str, result: Result) -> str:
+    parts = [f'{result["ops_per_sec"]:>12,.0f} ops/s']
+    if 'p50_us' in result:
+        parts.append(f'p50 {result["p50_us"]:>9.2f} us')
+        parts.append(f'p99 {result["p99_us"]:>9.2f} us')
+    parts.append(f'peak {result["peak_kib"]:>10,.0f} KiB')
+    return f'{name:<40}' + '  '.join(parts)
+
+
+def compare(results: Dict[str, Result], baseline: Dict[str, Result], threshold: float) -> bool:
+    """Prints the change against the baseline, returns whether anything got slower."""
+    regressed = False
+    print(f'\n{"":<40}{"ops/s":>8}{"p99":>9}{"peak":>9}')
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        speed = result['ops_per_sec'] / old['ops_per_sec'] - 1
+        columns = [f'{speed:>+8.1%}']
+        for key in ('p99_us', 'peak_kib'):
+            if old.get(key):
+                columns.append(f'{result[key] / old[key] - 1:>+9.1%}')
+            else:
+                columns.append(f'{"-":>9}')
+        slower = speed < -threshold
+        regressed |= slower
+        print(f'{name:<40}' + ''.join(columns) + ('  <- slower' if slower else ''))
+    return regressed
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    arg_parser.add_argument('--ops', type=int, default=10_000, help='operations per benchmark')
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--only', nargs='+', help='run the benchmarks with these names')
+    arg_parser.add_argument('--save', help='write the results to this JSON file')
+    arg_parser.add_argument('--compare', help='compare the results with this JSON file')
+    arg_parser.add_argument(
+        '--threshold', type=float, default=0.1, help='slowdown reported as a regression'
+    )
+    args = arg_parser.parse_args()
+
+    results = run(args.sizes, args.ops, args.seed, args.only)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(
+                dict(
+                    date=datetime.now().isoformat(timespec='seconds'),
+                    python=platform.python_version(),
+                    machine=platform.machine(),
+                    args=dict(sizes=args.sizes, ops=args.ops, seed=args.seed),
+                    results=results,
+                ),
+                f,
+                indent=4,
+            )
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
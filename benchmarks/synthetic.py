@@ -0,0 +1,123 @@
+"""Synthetic histories and messages for the benchmarks, always the same for a given seed."""
+import random
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Any, Dict, List
+
+import pytz
+
+from beanbot.db import DB
+from beanbot.models import Action, Event, Posting, Transaction, UserConfig
+
+
+ACCOUNTS = [
+    'Food',
+    'Groceries',
+    'Transport',
+    'Taxi',
+    'Coffee',
+    'Rent',
+    'Books',
+    'Movies',
+    'Gifts',
+    'Health',
+    'Phone',
+    'Internet',
+]
+CREDIT_ACCOUNTS = ['Cash', 'CC', 'Debit', 'Other']
+CURRENCIES = ['USD', 'EUR', 'PEN']
+INFOS = ['', '', '', 'Lunch', 'Supermarket', 'Trip', 'Birthday', 'Pharmacy']
+
+# Most transactions have a single posting, receipts have a few more
+POSTING_COUNTS = [1, 1, 1, 1, 2, 2, 3, 5, 8, 15]
+
+START_DATE = datetime(2021, 1, 1, tzinfo=pytz.utc)
+
+
+def make_config() -> UserConfig:
+    return UserConfig(
+        timezone='America/Lima',
+        currencies=list(CURRENCIES),
+        credit_accounts=list(CREDIT_ACCOUNTS),
+    )
+
+
+def make_amount(rng: random.Random) -> Decimal:
+    return Decimal(rng.randint(1, 20000)) / 100
+
+
+def make_history(size: int, seed: int = 0) -> DB:
+    """Returns a database with `size` transactions, as if every posting had been replied to."""
+    return DB(make_user_data(size, seed))
+
+
+def make_user_data(size: int, seed: int = 0) -> Dict[str, Any]:
+    """Returns the `user_data` of `make_history`."""
+    rng = random.Random(seed)
+    user_data: Dict[str, Any] = dict(config=make_config())
+    db = DB(user_data)
+
+    date = START_DATE
+    posting_id = 1
+    for tx_id in range(1, size + 1):
+        date += timedelta(minutes=rng.randint(10, 24 * 60))
+        postings = []
+        for _ in range(rng.choice(POSTING_COUNTS)):
+            postings.append(
+                Posting(
+                    posting_id,
+                    rng.choice(ACCOUNTS),
+                    rng.choice(CREDIT_ACCOUNTS),
+                    make_amount(rng),
+                    rng.choice(CURRENCIES),
+                )
+            )
+            posting_id += 1
+
+        tx = Transaction(tx_id, date.astimezone(db.config.tzinfo), rng.choice(INFOS), postings)
+        db.transactions.append(tx)
+        for posting in postings:
+            db.update_message_index(posting.id, tx, posting)
+
+    db.next_ids.update(transaction=size + 1, posting=posting_id)
+    # Like a long time user, most of the transactions are archived
+    db._archive_transactions(date)
+    return user_data
+
+
+def make_message(rng: random.Random) -> str:
+    kind = rng.random()
+    if kind < 0.5:
+        return f'{rng.choice(ACCOUNTS)} {make_amount(rng)}'
+    elif kind < 0.7:
+        return f'+{rng.choice(ACCOUNTS)} {make_amount(rng)}'
+    elif kind < 0.8:
+        return f'#{rng.choice(INFOS) or "Something"}'
+    elif kind < 0.9:
+        return f'{rng.choice("+-")}{rng.randint(1, 100) / 100}'
+    else:
+        # A receipt
+        lines = [f'{rng.choice(ACCOUNTS)} {make_amount(rng)}' for _ in range(rng.randint(2, 15))]
+        return '\n'.join(lines)
+
+
+def make_messages(count: int, seed: int = 0) -> List[str]:
+    """Returns a realistic mix of text messages."""
+    rng = random.Random(seed)
+    return [make_message(rng) for _ in range(count)]
+
+
+def make_button_events(db: DB, count: int, seed: int = 0) -> List[Event]:
+    """Returns currency and credit account changes on the messages that can still be edited."""
+    rng = random.Random(seed)
+    message_ids = list(db.message_id_index)
+    events = []
+    for _ in range(count):
+        if rng.random() < 0.5:
+            action, options = Action.SET_CURRENCY, db.config.currencies
+        else:
+            action, options = Action.SET_CREDIT_ACCOUNT, db.config.credit_accounts
+        events.append(
+            Event(action, rng.randrange(len(options)), message_id=rng.choice(message_ids))
+        )
+    return events
@@ -0,0 +1,158 @@
+"""A fake Telegram to run the bot offline.
+
+`FakeTelegram` answers the Bot API methods the bot uses and records the calls, pass its
+`base_url` to the `Bot`/`Updater`. `post_update` sends an update to a webhook like Telegram would.
+"""
+import email.parser
+import itertools
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Tuple
+
+
+BOT_USER = dict(id=1000, is_bot=True, first_name='Beanbot', username='beanbot')
+
+
+class FakeTelegram:
+    def __init__(self):
+        self.calls: List[Tuple[str, Dict[str, Any]]] = []
+        self.lock = threading.Lock()
+        self.message_ids = itertools.count(1000)
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), FakeTelegramHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.telegram = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+
+    @property
+    def base_url(self) -> str:
+        return f'http://127.0.0.1:{self.httpd.server_address[1]}/bot'
+
+    def start(self) -> 'FakeTelegram':
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+    def call(self, method: str, params: Dict[str, Any]) -> Any:
+        with self.lock:
+            self.calls.append((method, params))
+            message_id = next(self.message_ids)
+
+        if method == 'getMe':
+            return BOT_USER
+        if method.startswith('send') or method.startswith('edit'):
+            chat_id = int(params.get('chat_id') or 0)
+            return dict(
+                message_id=int(params.get('message_id') or message_id),
+                date=int(time.time()),
+                chat=dict(id=chat_id, type='private'),
+                text=params.get('text', ''),
+            )
+        return True
+
+    def get_calls(self, method: str) -> List[Dict[str, Any]]:
+        with self.lock:
+            return [params for name, params in self.calls if name == method]
+
+    def wait_for(self, method: str, count: int, timeout: float = 5) -> List[Dict[str, Any]]:
+        """Waits until `method` has been called `count` times, returns its calls."""
+        deadline = time.monotonic() + timeout
+        while len(self.get_calls(method)) < count:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'{method} called {len(self.get_calls(method))} times')
+            time.sleep(0.01)
+        return self.get_calls(method)
+
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        method = self.path.rsplit('/', 1)[-1]
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        result = self.server.telegram.call(method, parse_params(self.headers, body))
+
+        response = json.dumps(dict(ok=True, result=result)).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def parse_params(headers, body: bytes) -> Dict[str, Any]:
+    content_type = headers.get('Content-Type', '')
+    if content_type.startswith('application/json'):
+        return json.loads(body or b'{}')
+    if content_type.startswith('multipart/form-data'):
+        message = email.parser.BytesParser().parsebytes(
+            f'Content-Type: {content_type}\r\n\r\n'.encode('utf-8') + body
+        )
+        params = {}
+        for part in message.get_payload():
+            name = part.get_param('name', header='content-disposition')
+            value = part.get_payload(decode=True)
+            if part.get_filename():
+                params[name] = dict(filename=part.get_filename(), content=value)
+            else:
+                params[name] = value.decode('utf-8')
+        return params
+    return {}
+
+
+def post_update(url: str, update: Any) -> int:
+    """Posts an update to a webhook, returns the status code."""
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(update).encode('utf-8'),
+        headers={'Content-Type': 'application/json'},
+        method='POST',
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as ex:
+        return ex.code
+
+
+# Updates
+
+
+def make_message(text: str, update_id: int = 1, user_id: int = 1) -> Dict[str, Any]:
+    user = dict(id=user_id, is_bot=False, first_name='User')
+    chat = dict(id=user_id, type='private')
+    message = dict(message_id=update_id, date=0, chat=chat, text=text, **{'from': user})
+    if text.startswith('/'):
+        message['entities'] = [dict(type='bot_command', offset=0, length=len(text.split()[0]))]
+    return dict(update_id=update_id, message=message)
+
+
+def make_document(
+    file_id: str, file_name: str, file_size: int, update_id: int = 1, user_id: int = 1
+) -> Dict[str, Any]:
+    user = dict(id=user_id, is_bot=False, first_name='User')
+    chat = dict(id=user_id, type='private')
+    document = dict(
+        file_id=file_id, file_unique_id=file_id, file_name=file_name, file_size=file_size
+    )
+    message = dict(message_id=update_id, date=0, chat=chat, document=document, **{'from': user})
+    return dict(update_id=update_id, message=message)
+
+
+def make_callback_query(
+    data: str, message_id: int, update_id: int = 1, user_id: int = 1
+) -> Dict[str, Any]:
+    user = dict(id=user_id, is_bot=False, first_name='User')
+    chat = dict(id=user_id, type='private')
+    message = dict(message_id=message_id, date=0, chat=chat, text='')
+    query = dict(id='1', chat_instance='1', data=data, message=message, **{'from': user})
+    return dict(update_id=update_id, callback_query=query)
@@ -0,0 +1,263 @@
+import asyncio
+import functools
+import io
+import gzip
+import json
+from decimal import Decimal
+
+import pytest
+import tornado.web
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+
+from beanbot import aio, export, importer
+from beanbot.persistence import JournalPersistence
+from fake_telegram import make_callback_query, make_document, make_message
+
+
+class FakeAPI:
+    def __init__(self):
+        self.calls = []
+        self.next_message_id = 100
+        self.files = {}
+
+    async def call(self, method, request_timeout=None, **params):
+        await asyncio.sleep(0)  # Let other updates run meanwhile
+        self.calls.append((method, params))
+        if method == 'sendMessage':
+            self.next_message_id += 1
+            return dict(message_id=self.next_message_id)
+        return True
+
+    async def send_document(self, chat_id, file, filename):
+        self.calls.append(('sendDocument', dict(chat_id=chat_id, filename=filename)))
+        self.document = file.read()
+
+    async def download(self, file_id, file):
+        self.calls.append(('download', dict(file_id=file_id)))
+        file.write(self.files[file_id])
+
+    def close(self):
+        pass
+
+
+def run_updates(runtime, *updates):
+    async def main():
+        for update in updates:
+            await runtime.process_update(update)
+
+    asyncio.run(main())
+
+
+@pytest.fixture()
+def runtime():
+    return aio.Runtime(FakeAPI())
+
+
+class TestRuntime:
+    def test_text_message(self, runtime):
+        run_updates(runtime, make_message('Coffee 3.5'))
+
+        [(method, params)] = runtime.api.calls
+        assert method == 'sendMessage'
+        assert params['chat_id'] == 1
+        assert params['parse_mode'] == 'MarkdownV2'
+        assert params['reply_markup']['inline_keyboard'][-1][0]['callback_data'] == 'delete'
+
+        db = runtime.open_db(1)
+        assert db.transactions[0].postings[0].amount == Decimal('3.5')
+        assert db.get_entries_by_message_id(101) == (db.transactions[0], db.last_entries[1])
+
+    def test_inline_button(self, runtime):
+        run_updates(
+            runtime,
+            make_message('Coffee 3.5'),
+            make_callback_query('cur_1', 101),
+            make_callback_query('commit', 101),
+        )
+
+        methods = [method for method, _ in runtime.api.calls]
+        assert methods == ['sendMessage', 'editMessageText', 'editMessageReplyMarkup']
+        assert runtime.open_db(1).last_entries[1].currency == 'EUR'
+
+    def test_updates_of_a_user_are_handled_in_order(self, runtime):
+        async def main():
+            tasks = [
+                runtime.schedule(make_message(f'+Item{i} {i}', update_id=i)) for i in range(1, 21)
+            ]
+            tasks.append(runtime.schedule(make_message('Other 1', update_id=21, user_id=2)))
+            await asyncio.wait(tasks)
+
+        asyncio.run(main())
+
+        db = runtime.open_db(1)
+        assert [p.debit_account for p in db.transactions[0].postings] == [
+            f'Item{i}' for i in range(1, 21)
+        ]
+        assert len(runtime.open_db(2).transactions) == 1
+        # Locks are dropped once the updates of their user are handled
+        assert runtime.locks == {}
+        assert not runtime.pending
+
+    def test_commands(self, runtime):
+        run_updates(
+            runtime,
+            make_message('Coffee 3.5'),
+            make_message('/config currencies PEN USD'),
+            make_message('/config currencies'),
+            make_message('/json gzip'),
+            make_message('/report all'),
+            make_message('/search coffee 2021-01-01'),
+            make_message('/clear'),
+        )
+
+        texts = [params.get('text') for _, params in runtime.api.calls]
+        assert texts[1:3] == ['Updated!', 'PEN\nUSD']
+        assert runtime.api.calls[3][1]['filename'].endswith('.json.gz')
+        assert json.loads(gzip.decompress(runtime.api.document))[0]['info'] == ''
+        assert texts[4].startswith('All months\n`  3.50 USD `_Coffee_')
+        assert texts[5].startswith('1 found for coffee\n`  3.50 USD `_Coffee_')
+        assert texts[6] == 'Cleared!'
+        assert runtime.open_db(1).transactions == []
+
+    def test_undo_and_redo(self, runtime):
+        run_updates(
+            runtime,
+            make_message('Coffee 3.5'),
+            make_message('/undo'),
+            make_message('/redo'),
+            make_message('/redo'),
+        )
+
+        calls = runtime.api.calls
+        assert [method for method, _ in calls] == [
+            'sendMessage',
+            'editMessageText',
+            'sendMessage',
+            'editMessageText',
+            'sendMessage',
+            'sendMessage',
+        ]
+        assert calls[1][1]['message_id'] == 101
+        assert calls[1][1]['text'] == '~Coffee 3\\.5~'
+        assert calls[1][1]['reply_markup'] == {'inline_keyboard': [[]]}
+        assert calls[2][1]['text'] == 'Undone!'
+        assert calls[3][1]['text'] == calls[0][1]['text']
+        assert calls[3][1]['reply_markup'] == calls[0][1]['reply_markup']
+        texts = [params['text'] for _, params in calls[4:]]
+        assert texts == ['Redone!', 'There is nothing to redo']
+        assert len(runtime.open_db(1).transactions) == 1
+
+    def test_import(self, runtime, monkeypatch):
+        monkeypatch.setattr(
+            importer, 'report_progress', functools.partial(importer.report_progress, interval=0)
+        )
+        rows = ['date,debit_account,amount'] + [f'2021-01-01,Rent,{i}' for i in range(150)]
+        runtime.api.files['1'] = '\n'.join(rows + ['2021-01-02,Rent,x']).encode('utf-8')
+        run_updates(
+            runtime,
+            make_document('1', 'ledger.csv', 1000),
+            make_document('2', 'ledger.pdf', 1000, update_id=2),
+        )
+
+        calls = runtime.api.calls
+        assert [method for method, _ in calls] == [
+            'sendMessage',
+            'download',
+            'editMessageText',
+            'editMessageText',
+            'sendMessage',
+        ]
+        assert calls[0][1]['text'] == 'Importing...'
+        assert calls[2][1]['text'] == 'Importing... 100 transactions so far'
+        assert calls[3][1] == dict(
+            chat_id=1,
+            message_id=101,
+            text='Imported 150 transactions\n'
+            '1 rows have errors and were skipped:\n'
+            'Line 152: Invalid amount x',
+        )
+        assert calls[4][1]['text'].startswith('Send a .csv file')
+        assert len(runtime.open_db(1).transactions) == 150
+
+    def test_errors_are_replied(self, runtime):
+        run_updates(runtime, make_message('#Info'), make_message('No amount'))
+
+        assert [params['text'] for _, params in runtime.api.calls] == [
+            'There are no transactions',
+            'Invalid amount',
+        ]
+
+    def test_persistence(self, tmp_path):
+        filename = str(tmp_path / 'db.journal')
+        runtime = aio.Runtime(FakeAPI(), persistence=JournalPersistence(filename))
+
+        async def main():
+            await runtime.process_update(make_message('Coffee 3.5'))
+            await runtime.stop()
+
+        asyncio.run(main())
+
+        user_data = JournalPersistence(filename).get_user_data()
+        assert user_data[1]['transactions'][0].postings[0].debit_account == 'Coffee'
+
+
+class TelegramHandler(tornado.web.RequestHandler):
+    def post(self, method):
+        self.application.requests.append((method, self.request))
+        if method == 'getFile':
+            result = dict(file_path='documents/file.csv')
+        else:
+            result = dict(message_id=1)
+        self.write(dict(ok=method != 'fail', result=result, description='Failed'))
+
+
+class FileHandler(tornado.web.RequestHandler):
+    def get(self, path):
+        self.write(f'{path}\n'.encode('utf-8') * 10_000)
+
+
+def test_telegram_api():
+    async def main():
+        app = tornado.web.Application(
+            [
+                (r'/bot(?:[^/]+)/(\w+)', TelegramHandler),
+                (r'/file/bot(?:[^/]+)/(.+)', FileHandler),
+            ]
+        )
+        app.requests = []
+        sock, port = bind_unused_port()
+        server = HTTPServer(app)
+        server.add_sockets([sock])
+
+        api = aio.TelegramAPI(
+            'TOKEN',
+            url=f'http://127.0.0.1:{port}/bot{{token}}/{{method}}',
+            file_url=f'http://127.0.0.1:{port}/file/bot{{token}}/{{path}}',
+        )
+        try:
+            assert await api.call('sendMessage', chat_id=1, text='Hi') == dict(message_id=1)
+            with pytest.raises(aio.TelegramError, match='Failed'):
+                await api.call('fail')
+
+            file = export.export_file(['x' * 100_000])
+            await api.send_document(1, file, 'file.txt')
+
+            downloaded = io.BytesIO()
+            await api.download('1', downloaded)
+            assert downloaded.getvalue() == b'documents/file.csv\n' * 10_000
+        finally:
+            api.close()
+            server.stop()
+
+        method, request = app.requests[0]
+        assert json.loads(request.body) == dict(chat_id=1, text='Hi')
+
+        method, request = app.requests[2]
+        assert method == 'sendDocument'
+        files = request.files['document']
+        assert files[0]['filename'] == 'file.txt'
+        assert files[0]['body'] == b'x' * 100_000
+        assert request.body_arguments['chat_id'] == [b'1']
+
+    asyncio.run(main())
@@ -0,0 +1,63 @@
+from datetime import datetime
+from decimal import Decimal
+
+import pytz
+
+from beanbot.archive import Archive, Block
+from beanbot.models import Posting, Transaction
+
+
+def make_transactions(*days):
+    return [
+        Transaction(
+            day,
+            datetime(2021, 1, day, tzinfo=pytz.utc),
+            f'Day {day}',
+            [Posting(day, 'Food', 'Cash', Decimal('1.50'), 'USD')],
+        )
+        for day in days
+    ]
+
+
+def test_block():
+    transactions = make_transactions(1, 2, 3)
+    block = Block.pack(transactions)
+    assert block.count == 3
+    assert block.start == datetime(2021, 1, 1, tzinfo=pytz.utc).timestamp()
+    assert block.end == datetime(2021, 1, 3, tzinfo=pytz.utc).timestamp()
+    assert block.unpack() == transactions
+
+
+def test_between():
+    archive = Archive()
+    archive.append(Block.pack(make_transactions(1, 3, 2)))
+    archive.append(Block.pack(make_transactions(5, 6)))
+    assert len(archive) == 5
+    assert [tx.id for tx in archive] == [1, 3, 2, 5, 6]
+
+    def between(start, end):
+        return [
+            tx.id
+            for tx in archive.between(
+                start and datetime(2021, 1, start, tzinfo=pytz.utc),
+                end and datetime(2021, 1, end, tzinfo=pytz.utc),
+            )
+        ]
+
+    assert between(None, None) == [1, 2, 3, 5, 6]
+    assert between(2, 6) == [2, 3, 5]
+    assert between(4, 5) == []
+
+
+def test_find():
+    archive = Archive()
+    archive.append(Block.pack(make_transactions(1, 3, 2)))
+    archive.append(Block.pack(make_transactions(5, 6)))
+    assert [tx.id for tx in archive.find({6, 3})] == [3, 6]
+    assert [tx.id for tx in archive.find({4})] == []
+    start, end = datetime(2021, 1, 2, tzinfo=pytz.utc), datetime(2021, 1, 6, tzinfo=pytz.utc)
+    assert [tx.id for tx in archive.find({1, 2, 6}, start, end)] == [2]
+
+    # Blocks archived before ids were kept
+    archive.blocks[0].first_id = archive.blocks[0].last_id = None
+    assert [tx.id for tx in archive.find({2})] == [2]
@@ -0,0 +1,142 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from telegram import Update
+from telegram.ext import Updater
+
+from beanbot import bot, parser
+from beanbot.concurrency import UserQueues
+from beanbot.db import DB
+from fake_telegram import FakeTelegram, make_callback_query, make_message
+
+
+def test_user_queues():
+    queues = UserQueues()
+    done = {user_id: [] for user_id in range(5)}
+    running = set()
+    overlaps = []
+
+    def make_job(user_id, i):
+        def job():
+            if user_id in running:
+                overlaps.append(user_id)
+            running.add(user_id)
+            time.sleep(random.random() / 1000)
+            done[user_id].append(i)
+            running.discard(user_id)
+
+        return job
+
+    with ThreadPoolExecutor(8) as executor:
+        for i in range(50):
+            for user_id in done:
+                queues.submit(user_id, make_job(user_id, i), executor.submit)
+
+    assert overlaps == []
+    assert all(jobs == list(range(50)) for jobs in done.values())
+    assert queues.pending == {}
+
+
+def test_failed_jobs_dont_block_the_user():
+    queues = UserQueues()
+    done = []
+
+    def fail():
+        raise ValueError()
+
+    with ThreadPoolExecutor(2) as executor:
+        queues.submit(1, fail, executor.submit)
+        queues.submit(1, lambda: done.append(1), executor.submit)
+
+    assert done == [1]
+
+
+@pytest.fixture()
+def telegram():
+    telegram = FakeTelegram().start()
+    yield telegram
+    telegram.stop()
+
+
+@pytest.fixture()
+def jitter(monkeypatch):
+    """Makes handlers take a random time before changing the data."""
+
+    def slow(parse):
+        def wrapper(value):
+            time.sleep(random.random() / 200)
+            return parse(value)
+
+        return wrapper
+
+    monkeypatch.setattr(parser, 'parse_message', slow(parser.parse_message))
+    monkeypatch.setattr(parser, 'parse_keyboard_data', slow(parser.parse_keyboard_data))
+
+
+def test_interleaved_updates_keep_users_consistent(telegram, jitter):
+    updater = Updater('123:TOKEN', base_url=telegram.base_url, workers=8)
+    dp = updater.dispatcher
+    bot.add_handlers(dp, run_async=True)
+    thread = threading.Thread(target=dp.start)
+    thread.start()
+
+    users = range(1, 7)
+    count = 30
+    update_ids = iter(range(1, 10_000))
+
+    # Text messages and buttons, buttons on message ids that may not be known yet
+    for i in range(count):
+        for user_id in users:
+            text = f'Start {i}' if i == 0 else f'+Item{i} {i}'
+            dp.process_update(
+                Update.de_json(make_message(text, next(update_ids), user_id), updater.bot)
+            )
+            if i % 5 == 4:
+                data = random.choice(['cur_1', 'acc_1'])
+                message_id = random.randint(1000, 1000 + i * len(users))
+                dp.process_update(
+                    Update.de_json(
+                        make_callback_query(data, message_id, next(update_ids), user_id),
+                        updater.bot,
+                    )
+                )
+
+    telegram.wait_for('sendMessage', count * len(users), timeout=30)
+    dp.stop()
+    thread.join()
+
+    posting_ids = set()
+    for user_id in users:
+        db = DB(dp.user_data[user_id])
+        [tx] = db.transactions
+        assert [p.debit_account for p in tx.postings] == ['Start'] + [
+            f'Item{i}' for i in range(1, count)
+        ]
+
+        ids = [p.id for p in tx.postings]
+        assert ids == list(range(1, count + 1))
+        assert db.next_ids == dict(transaction=2, posting=count + 1)
+        posting_ids.update((user_id, i) for i in ids)
+
+        # Every reply is indexed, pointing to its own posting
+        assert len(db.message_id_index) == count
+        for message_id, (tx_id, posting_id) in list(db.message_id_index.items()):
+            assert tx_id == tx.id
+            assert db.get_entries_by_message_id(message_id)[1].id == posting_id
+
+    assert len(posting_ids) == count * len(users)
+
+
+def test_run_async_needs_an_incremental_persistence(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(bot, 'config', bot.config)
+    for name in ('DB_ENGINE', 'DB_PERSISTENCE', 'BOT_RUNTIME'):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv('BOT_TOKEN', '123:TOKEN')
+    monkeypatch.setenv('RUN_ASYNC', 'true')
+
+    with pytest.raises(ValueError, match='RUN_ASYNC needs'):
+        bot.run()
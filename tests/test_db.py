@@ -1,11 +1,15 @@
-from datetime import datetime
+import pickle
+from datetime import datetime, timedelta
 from decimal import Decimal
 
 import pytest
 import pytz
 from freezegun import freeze_time
 
-from beanbot.db import DB
+from beanbot import db as database, parser
+from beanbot.archive import Block
+from beanbot.db import DB, Changes
+from beanbot.errors import UserError
 from beanbot.models import Action, Event, Posting, Transaction, UserConfig
 
 
@@ -146,3 +150,603 @@ class TestDB:
         )
 
         assert len(sample_db.transactions) == 0
+
+    def test_id_index(self, sample_db: DB):
+        date = datetime.now(pytz.utc)
+        for i, action in enumerate([Action.NEW, Action.ADD, Action.NEW]):
+            tx, posting = sample_db.process_event(
+                Event(action, dict(info=f'Item {i}', amount=Decimal(1)), date=date)
+            )
+            sample_db.update_message_index(10 + i, tx, posting)
+            sample_db.process_event(Event(Action.COMMIT, None))
+
+        assert sample_db.get_entries_by_message_id(11) == (
+            sample_db.transactions[1],
+            sample_db.transactions[1].postings[1],
+        )
+
+        sample_db.process_event(Event(Action.DELETE, None, message_id=12))
+        assert len(sample_db.transactions) == 2
+        with pytest.raises(UserError):
+            sample_db.get_entries_by_message_id(12)
+        assert sample_db.get_entries_by_message_id(11)[1].debit_account == 'Item 1'
+
+        sample_db.process_event(Event(Action.DELETE, None, message_id=11))
+        assert sample_db.transactions[1].postings == [
+            sample_db.get_entries_by_message_id(10)[1]
+        ]
+
+        sample_db.clear()
+        assert sample_db.index.transactions == {}
+        assert sample_db.index.postings == {}
+
+    def test_id_index_is_rebuilt_after_loading(self, sample_db: DB):
+        user_data = pickle.loads(pickle.dumps(dict(transactions=sample_db.transactions)))
+        user_data['message_id_index'] = sample_db.message_id_index
+
+        db = DB(user_data)
+        assert db.index.transactions == {}
+        assert db.get_entries_by_message_id(1) == (
+            db.transactions[0],
+            db.transactions[0].postings[0],
+        )
+
+    def test_message_index_is_pruned(self, sample_db: DB):
+        date = datetime.now(pytz.utc)
+        tx, posting = sample_db.process_event(
+            Event(Action.ADD, dict(info='Item', amount=Decimal(1)), date=date)
+        )
+        sample_db.update_message_index(2, tx, posting)
+        tx, _ = sample_db.process_event(Event(Action.SET_INFO, 'Info', date=date))
+        sample_db.update_message_index(3, tx, None)
+
+        # Deleted postings
+        sample_db.process_event(Event(Action.DELETE, None, message_id=2))
+        assert set(sample_db.message_id_index) == {1, 3}
+
+        # Committed transactions
+        sample_db.process_event(Event(Action.COMMIT, None, message_id=1))
+        assert sample_db.message_id_index == {}
+        with pytest.raises(UserError):
+            sample_db.process_event(Event(Action.SET_CURRENCY, 0, message_id=1))
+
+    def test_message_index_evicts_least_recently_used(self, sample_db: DB):
+        sample_db.message_index_size = 3
+        tx, posting = sample_db.last_entries
+        for message_id in range(2, 5):
+            sample_db.update_message_index(message_id, tx, posting)
+            sample_db.get_entries_by_message_id(2)
+
+        assert list(sample_db.message_id_index) == [3, 4, 2]
+        with pytest.raises(UserError):
+            sample_db.process_event(Event(Action.SET_CURRENCY, 0, message_id=1))
+
+    def test_batch(self, sample_db: DB):
+        sample_db.process_event(Event(Action.COMMIT, None))
+        tx, posting = sample_db.process_event(
+            Event(
+                Action.BATCH,
+                [
+                    Event(Action.NEW, dict(info='Bread', amount=Decimal('2.50'))),
+                    Event(Action.ADD, dict(info='Milk', amount=Decimal('1.20'))),
+                    Event(Action.SET_INFO, 'Groceries'),
+                    Event(Action.FIX_AMOUNT, Decimal('-0.20')),
+                ],
+            )
+        )
+
+        assert len(sample_db.transactions) == 2
+        assert tx is sample_db.transactions[-1]
+        assert tx.info == 'Groceries'
+        assert tx.postings == [
+            Posting(2, 'Bread', 'Cash', Decimal('2.50'), 'USD'),
+            Posting(3, 'Milk', 'Cash', Decimal('1.00'), 'USD'),
+        ]
+        assert posting is tx.postings[-1]
+
+    def test_failed_batch_changes_nothing(self):
+        db = DB({})
+        with pytest.raises(UserError):
+            db.process_event(
+                Event(
+                    Action.BATCH,
+                    [
+                        Event(Action.SET_INFO, 'Groceries'),
+                        Event(Action.NEW, dict(info='Bread', amount=Decimal('2.50'))),
+                    ],
+                )
+            )
+
+        assert db.transactions == []
+        assert db.next_ids == dict(transaction=1, posting=1)
+
+    def test_only_modifications_are_recorded(self, sample_db: DB):
+        changes = sample_db.changes = Changes()
+
+        list(sample_db.iter_transactions())
+        sample_db.get_entries_by_message_id(1)
+        sample_db.set_config('timezone', 'America/Lima')
+        sample_db.last_event = None
+        assert not changes
+
+        sample_db.set_config('timezone', 'UTC')
+        sample_db.process_event(Event(Action.ADD, dict(info='Bread', amount=Decimal('2.50'))))
+        assert changes.keys == {'config', 'next_ids', 'vars'}
+        assert set(changes.transactions) == {1}
+
+    def test_operations_are_only_recorded_if_asked(self, sample_db: DB, monkeypatch):
+        def fail(value):
+            raise AssertionError('Copied')
+
+        monkeypatch.setattr(database, 'copy_event', fail)
+        monkeypatch.setattr(database, 'copy_transaction', fail)
+        monkeypatch.setattr(database.copy, 'deepcopy', fail)
+        changes = sample_db.changes = Changes()
+        sample_db.process_event(Event(Action.SET_INFO, 'Lunch'))
+        sample_db.import_transactions(TestImport().make_transactions(2))
+        sample_db.undo()
+        sample_db.redo()
+        assert changes and changes.operations == []
+
+    def test_operations_replay(self):
+        db = DB(dict(changes=Changes(record_operations=True)), message_index_size=2)
+        db.set_config('credit_accounts', ['Cash', 'CC'])
+        for message_id, text in enumerate(['Coffee 3.5', 'Bread 2\nMilk 1.5', '+Tea 2']):
+            tx, posting = db.process_event(parser.parse_message(text))
+            db.update_message_index(message_id, tx, posting)
+        db.process_event(Event(Action.SET_CREDIT_ACCOUNT, 1, message_id=2))
+        with pytest.raises(UserError):
+            db.process_event(Event(Action.DELETE, None, message_id=0))
+
+        replayed = DB({}, message_index_size=2)
+        for operation in db.changes.operations:
+            replayed.apply(operation)
+        assert replayed.transactions == db.transactions
+        assert replayed.message_id_index == db.message_id_index
+        assert replayed.next_ids == db.next_ids
+        assert replayed.config == db.config
+
+    def test_iter_transactions_between_dates(self):
+        db = DB({})
+        for day in (3, 1, 2, 5):
+            tx, posting = db.process_event(
+                Event(
+                    Action.NEW,
+                    dict(info=f'Day {day}', amount=Decimal(1)),
+                    date=datetime(2021, 1, day, tzinfo=pytz.utc),
+                )
+            )
+            db.update_message_index(day, tx, posting)
+            db.process_event(Event(Action.COMMIT, None))
+        db.process_event(Event(Action.DELETE, None, message_id=3))
+
+        def between(start, end):
+            return [
+                tx.postings[0].debit_account
+                for tx in db.iter_transactions(
+                    start and datetime(2021, 1, start, tzinfo=pytz.utc),
+                    end and datetime(2021, 1, end, tzinfo=pytz.utc),
+                )
+            ]
+
+        assert between(None, None) == ['Day 1', 'Day 2', 'Day 5']
+        assert between(2, 5) == ['Day 2']
+        assert between(None, 2) == ['Day 1']
+        assert between(2, None) == ['Day 2', 'Day 5']
+
+
+class TestTotals:
+    def test_totals_follow_the_postings(self, sample_db: DB):
+        def post(message_id, info, amount, date):
+            tx, posting = sample_db.process_event(
+                Event(Action.NEW, dict(info=info, amount=Decimal(amount)), date=date)
+            )
+            sample_db.update_message_index(message_id, tx, posting)
+
+        post(2, 'Food', '10.00', datetime(2021, 1, 10, tzinfo=pytz.utc))
+        assert sample_db.get_totals('2021-01') == {('USD', 'Food', 'Cash'): Decimal(10)}
+
+        post(3, 'Food', '5.00', datetime(2021, 2, 10, tzinfo=pytz.utc))
+        sample_db.process_event(Event(Action.FIX_AMOUNT, Decimal('0.50')))
+        sample_db.process_event(Event(Action.SET_CURRENCY, 1, message_id=3))
+        post(4, 'Bus', '2.00', datetime(2021, 2, 20, tzinfo=pytz.utc))
+        sample_db.process_event(Event(Action.SET_CREDIT_ACCOUNT, 1, message_id=4))
+        post(5, 'Bus', '1.00', datetime(2021, 2, 21, tzinfo=pytz.utc))
+        sample_db.process_event(Event(Action.DELETE, None, message_id=5))
+
+        assert sample_db.get_totals('2021-02') == {
+            ('EUR', 'Food', 'Cash'): Decimal('5.50'),
+            ('USD', 'Bus', 'Other'): Decimal(2),
+        }
+        assert sample_db.get_totals('2021-03') == {}
+        assert sample_db.get_totals()[('USD', 'Food', 'Cash')] == Decimal(10)
+        assert sample_db.check_totals() == []
+
+        sample_db.clear()
+        assert sample_db.get_totals() == {}
+
+    def test_drift_is_detected(self, sample_db: DB):
+        sample_db.process_event(
+            Event(
+                Action.NEW,
+                dict(info='Food', amount=Decimal(10)),
+                date=datetime(2021, 1, 10, tzinfo=pytz.utc),
+            )
+        )
+        sample_db.get_totals()
+        sample_db.transactions[-1].postings[0].amount = Decimal(20)
+
+        assert sample_db.check_totals() == ['2021-01']
+        assert sample_db.get_totals('2021-01') == {('USD', 'Food', 'Cash'): Decimal(20)}
+        assert sample_db.check_totals() == []
+
+
+class TestSearch:
+    def test_search_follows_the_postings(self, sample_db: DB):
+        def post(message_id, info, amount, day):
+            tx, posting = sample_db.process_event(
+                Event(
+                    Action.NEW,
+                    dict(info=info, amount=Decimal(amount)),
+                    date=datetime(2021, 1, day, tzinfo=pytz.utc),
+                )
+            )
+            sample_db.update_message_index(message_id, tx, posting)
+
+        post(2, 'Coffee', '3.00', 10)
+        assert [m.amount for m in sample_db.search('coffee')] == [Decimal(3)]
+
+        sample_db.process_event(Event(Action.ADD, dict(info='Cake', amount=Decimal(2))))
+        sample_db.process_event(Event(Action.SET_INFO, 'Starbucks'))
+        sample_db.process_event(Event(Action.FIX_AMOUNT, Decimal(1)))
+        assert [m.account for m in sample_db.search('starbucks')] == ['Coffee', 'Cake']
+        assert [m.amount for m in sample_db.search('cake')] == [Decimal(3)]
+
+        post(3, 'Iced coffee', '4.00', 20)
+        sample_db.process_event(Event(Action.DELETE, None, message_id=3))
+        assert [m.account for m in sample_db.search('coffee')] == ['Coffee']
+
+        sample_db.clear()
+        assert sample_db.search('coffee') == []
+
+
+class TestArchive:
+    @pytest.fixture(autouse=True)
+    def block_size(self, monkeypatch):
+        monkeypatch.setattr(database, 'ARCHIVE_BLOCK_SIZE', 3)
+
+    def new_transactions(self, db: DB, start: int, count: int):
+        for day in range(start, start + count):
+            date = datetime(2021, 1, day, tzinfo=pytz.utc)
+            tx, posting = db.process_event(
+                Event(Action.NEW, dict(info=f'Day {day}', amount=Decimal(1)), date=date)
+            )
+            db.update_message_index(day, tx, posting)
+            db.process_event(Event(Action.COMMIT, None, message_id=day, date=date))
+
+    def test_committed_transactions_are_archived(self):
+        db = DB({})
+        self.new_transactions(db, 1, 5)
+
+        # In blocks of at least 3, the last one is never archived
+        assert len(db.archive) == 3
+        assert [tx.id for tx in db.transactions] == [4, 5]
+        assert [tx.id for tx in db.iter_transactions()] == [1, 2, 3, 4, 5]
+
+        def between(start, end):
+            return [
+                tx.postings[0].debit_account
+                for tx in db.iter_transactions(
+                    datetime(2021, 1, start, tzinfo=pytz.utc),
+                    datetime(2021, 1, end, tzinfo=pytz.utc),
+                )
+            ]
+
+        assert between(2, 5) == ['Day 2', 'Day 3', 'Day 4']
+        assert between(4, 6) == ['Day 4', 'Day 5']
+
+        # The last one can still be modified
+        db.process_event(Event(Action.ADD, dict(info='More', amount=Decimal(1))))
+        assert len(db.transactions[-1].postings) == 2
+
+    def test_editable_transactions_are_kept(self):
+        db = DB({})
+        for day in range(1, 6):
+            tx, posting = db.process_event(
+                Event(
+                    Action.NEW,
+                    dict(info=f'Day {day}', amount=Decimal(1)),
+                    date=datetime(2021, 1, day, tzinfo=pytz.utc),
+                )
+            )
+            db.update_message_index(day, tx, posting)
+        assert len(db.archive) == 0
+
+        # Until they are too old
+        db.process_event(
+            Event(
+                Action.NEW,
+                dict(info='Later', amount=Decimal(1)),
+                date=datetime(2021, 2, 1, tzinfo=pytz.utc),
+            )
+        )
+        assert len(db.archive) == 5
+        assert db.message_id_index == {}
+        with pytest.raises(UserError):
+            db.get_entries_by_message_id(1)
+
+    def test_archived_transactions_are_found(self):
+        user_data = {}
+        db = DB(user_data)
+        self.new_transactions(db, 1, 5)
+        assert [m.account for m in db.search('day')] == [f'Day {day}' for day in range(1, 6)]
+
+        # Also when the index is built after archiving
+        db = DB(pickle.loads(pickle.dumps(user_data)))
+        assert [m.tx_id for m in db.search('day')] == [1, 2, 3, 4, 5]
+
+    def test_search_only_reads_the_blocks_with_matches(self, monkeypatch):
+        db = DB({})
+        self.new_transactions(db, 1, 8)
+        assert len(db.archive.blocks) == 2
+        db.search('day')
+
+        unpacked = []
+        unpack = Block.unpack
+        monkeypatch.setattr(
+            Block, 'unpack', lambda block: unpacked.append(block) or unpack(block)
+        )
+        assert [m.tx_id for m in db.search('day 2')] == [2]
+        assert unpacked == db.archive.blocks[:1]
+        unpacked.clear()
+        assert [m.tx_id for m in db.search('8')] == [8]
+        assert unpacked == []
+
+        start, end = datetime(2021, 1, 3, tzinfo=pytz.utc), datetime(2021, 1, 8, tzinfo=pytz.utc)
+        assert [m.tx_id for m in db.search('day', start, end)] == [3, 4, 5, 6, 7]
+
+    def test_clear(self):
+        db = DB({})
+        self.new_transactions(db, 1, 5)
+        db.clear()
+        assert list(db.iter_transactions()) == []
+
+
+def dump(db: DB):
+    """Returns the transactions and totals of `db`, to compare them at different times."""
+    transactions = [
+        (tx.id, tx.info, [pickle.dumps(p) for p in tx.postings]) for tx in db.iter_transactions()
+    ]
+    return transactions, db.get_totals()
+
+
+class TestUndo:
+    def test_every_action(self, sample_db: DB):
+        date = datetime.now(pytz.utc)
+        events = [
+            Event(Action.NEW, dict(info='Coffee', amount=Decimal('3.50')), date=date),
+            Event(Action.ADD, dict(info='Cake', amount=Decimal('4.00')), date=date),
+            Event(Action.SET_INFO, 'Lunch', date=date),
+            Event(Action.FIX_AMOUNT, Decimal('-0.50'), date=date),
+            Event(Action.SET_CURRENCY, 1, message_id=2, date=date),
+            Event(Action.SET_CREDIT_ACCOUNT, 1, message_id=2, date=date),
+            Event(Action.DELETE, None, message_id=3, date=date),
+            Event(Action.DELETE, None, message_id=2, date=date),
+            Event(Action.COMMIT, None, message_id=1, date=date),
+        ]
+        states = [dump(sample_db)]
+        for message_id, event in enumerate(events, 2):
+            tx, posting = sample_db.process_event(event)
+            if event.action in (Action.NEW, Action.ADD):
+                sample_db.update_message_index(message_id, tx, posting)
+            states.append(dump(sample_db))
+
+        for state in reversed(states[:-1]):
+            sample_db.undo()
+            assert dump(sample_db) == state
+        with pytest.raises(UserError):
+            sample_db.undo()
+
+        for state in states[1:]:
+            sample_db.redo()
+            assert dump(sample_db) == state
+        with pytest.raises(UserError):
+            sample_db.redo()
+        assert sample_db.check_totals() == []
+
+    def test_messages_of_undone_postings(self, sample_db: DB):
+        tx, posting = sample_db.process_event(Event(Action.ADD, dict(info='Cake', amount=1)))
+        sample_db.update_message_index(2, tx, posting)
+        sample_db.process_event(Event(Action.DELETE, None, message_id=1))
+
+        sample_db.undo()
+        assert sample_db.get_entries_by_message_id(1)[1].id == 1
+        sample_db.undo()
+        with pytest.raises(UserError):
+            sample_db.process_event(Event(Action.SET_CURRENCY, 1, message_id=2))
+        sample_db.redo()
+        assert sample_db.get_entries_by_message_id(2) == (tx, posting)
+
+    def test_changed_entries(self, sample_db: DB):
+        tx, posting = sample_db.last_entries
+        sample_db.process_event(Event(Action.DELETE, None, message_id=1))
+
+        assert sample_db.undo() == [(tx, posting)]
+        assert sample_db.transactions == [tx]
+        assert sample_db.get_entries_by_message_id(1) == (tx, posting)
+
+        [(deleted, deleted_posting)] = sample_db.redo()
+        assert deleted.id == tx.id and deleted_posting.id == posting.id
+        assert sample_db.transactions == []
+
+    def test_clear(self, monkeypatch):
+        monkeypatch.setattr(database, 'ARCHIVE_BLOCK_SIZE', 3)
+        db = DB(dict(changes=Changes(record_operations=True)))
+        TestArchive().new_transactions(db, 1, 5)
+        before = dump(db), dict(db.message_id_index)
+        archive = db.archive.blocks
+
+        db.clear()
+        db.undo()
+        assert (dump(db), db.message_id_index) == before
+        assert db.archive.blocks is archive
+        assert set(db.changes.transactions) == {4, 5} and db.changes.cleared
+
+        db.redo()
+        assert list(db.iter_transactions()) == []
+
+    def test_new_events_drop_redo(self, sample_db: DB):
+        sample_db.process_event(Event(Action.SET_INFO, 'Lunch'))
+        sample_db.undo()
+        sample_db.process_event(Event(Action.SET_INFO, 'Dinner'))
+
+        with pytest.raises(UserError):
+            sample_db.redo()
+        sample_db.undo()
+        assert sample_db.transactions[-1].info == ''
+
+    def test_history_is_bounded(self, sample_db: DB):
+        sample_db.history = database.History(size=2)
+        for info in ('A', 'B', 'C'):
+            sample_db.process_event(Event(Action.SET_INFO, info))
+
+        sample_db.undo()
+        sample_db.undo()
+        with pytest.raises(UserError):
+            sample_db.undo()
+        assert sample_db.transactions[-1].info == 'A'
+
+    def test_failed_events_are_not_undone(self, sample_db: DB):
+        with pytest.raises(UserError):
+            sample_db.process_event(Event(Action.DELETE, None, message_id=100))
+
+        with pytest.raises(UserError):
+            sample_db.undo()
+
+    def test_undo_is_replayed(self):
+        user_data = dict(changes=Changes(record_operations=True))
+        db = DB(user_data)
+        for message_id, text in enumerate(['Coffee 3.5', 'Bread 2\nMilk 1.5', '+Tea 2']):
+            tx, posting = db.process_event(parser.parse_message(text))
+            db.update_message_index(message_id, tx, posting)
+        db.process_event(Event(Action.DELETE, None, message_id=1))
+        db.undo()
+        db.undo()
+        db.redo()
+        db.clear()
+        db.undo()
+
+        replayed = DB({})
+        for operation in db.changes.operations:
+            replayed.apply(operation)
+        assert dump(replayed) == dump(db)
+        assert replayed.message_id_index == db.message_id_index
+
+    def test_reverted_step_is_recorded_as_it_was(self):
+        db = DB(dict(changes=Changes(record_operations=True)))
+        tx, posting = db.process_event(parser.parse_message('Food 1'))
+        db.update_message_index(10, tx, posting)
+        db.process_event(Event(Action.DELETE, None, message_id=10))
+        db.undo()
+
+        replayed = DB({})
+        for operation in db.changes.operations:
+            replayed.apply(operation)
+        assert dump(replayed) == dump(db)
+        assert [p.debit_account for p in replayed.transactions[0].postings] == ['Food']
+
+    def test_failed_undo_changes_nothing(self, sample_db: DB):
+        sample_db.changes = Changes(record_operations=True)
+        tx = sample_db.transactions[0]
+        sample_db.history.push([('info', 999, 'Gone'), ('info', tx.id, 'Old')])
+
+        with pytest.raises(UserError, match="can't be undone"):
+            sample_db.undo()
+        assert tx.info == ''
+        assert sample_db.changes.operations == []
+
+        with pytest.raises(UserError):
+            sample_db.redo()
+
+
+class TestImport:
+    def make_transactions(self, count: int):
+        return [
+            Transaction(
+                None,
+                datetime(2020, 1, 1 + i % 28, tzinfo=pytz.utc),
+                f'Imported {i}',
+                [Posting(None, 'Rent', 'Bank', Decimal(i), 'USD')],
+            )
+            for i in range(count)
+        ]
+
+    def test_ids_are_given_in_blocks(self, sample_db: DB, monkeypatch):
+        monkeypatch.setattr(database, 'IMPORT_BLOCK_SIZE', 2)
+        sample_db.get_totals()
+        sample_db.search('rent')
+
+        assert sample_db.import_transactions(iter(self.make_transactions(5))) == 5
+        assert [tx.id for tx in sample_db.transactions] == [1, 2, 3, 4, 5, 6]
+        assert [p.id for tx in sample_db.transactions[1:] for p in tx.postings] == [2, 3, 4, 5, 6]
+        assert sample_db.next_ids == dict(transaction=7, posting=7)
+        assert sample_db.get_totals('2020-01') == {('USD', 'Rent', 'Bank'): Decimal(10)}
+        assert len(sample_db.search('imported')) == 5
+        end = datetime(2020, 1, 3, tzinfo=pytz.utc)
+        infos = [tx.info for tx in sample_db.iter_transactions(end=end)]
+        assert infos == ['Imported 0', 'Imported 1']
+
+    def test_undo(self, sample_db: DB):
+        sample_db.import_transactions(self.make_transactions(3))
+        before = dump(sample_db)
+
+        assert sample_db.undo() == []
+        assert [tx.id for tx in sample_db.transactions] == [1]
+        assert sample_db.search('imported') == []
+
+        sample_db.redo()
+        assert dump(sample_db) == before
+
+    def test_import_is_replayed(self, monkeypatch):
+        monkeypatch.setattr(database, 'IMPORT_BLOCK_SIZE', 2)
+        db = DB(dict(changes=Changes(record_operations=True)))
+        db.process_event(parser.parse_message('Coffee 3.5'))
+        db.import_transactions(self.make_transactions(3))
+        db.import_transactions(self.make_transactions(2))
+        db.undo()
+        db.process_event(Event(Action.FIX_AMOUNT, Decimal(1), date=datetime.now(pytz.utc)))
+
+        replayed = DB({})
+        for operation in db.changes.operations:
+            replayed.apply(operation)
+        assert dump(replayed) == dump(db)
+        assert replayed.next_ids == db.next_ids
+        assert replayed.vars == db.vars
+
+    def test_events_keep_working_on_the_last_transaction(self):
+        db = DB({})
+        start = datetime(2021, 3, 4, 12, tzinfo=pytz.utc)
+        db.process_event(Event(Action.NEW, dict(info='Coffee', amount=Decimal(3)), date=start))
+        db.import_transactions(self.make_transactions(2))
+
+        # A minute later, it isn't added to the imported transaction
+        date = start + timedelta(minutes=1)
+        tea = Event(Action.NEW, dict(info='Tea', amount=Decimal(2)), date=date)
+        tx, _ = db.process_event(tea)
+        assert tx.id == 4 and [p.debit_account for p in tx.postings] == ['Tea']
+
+        db.undo()
+        tx, posting = db.process_event(Event(Action.FIX_AMOUNT, Decimal(1), date=date))
+        assert (tx.id, posting.amount) == (1, Decimal(4))
+        db.undo()
+        db.undo()
+        assert [tx.id for tx in db.transactions] == [1]
+        assert db.last_transaction_id is None and db.last_event == start
+
+    def test_no_transactions_before(self):
+        db = DB({})
+        db.import_transactions(self.make_transactions(2))
+        with pytest.raises(UserError, match='There are no transactions'):
+            db.process_event(Event(Action.SET_INFO, 'Lunch', date=datetime.now(pytz.utc)))
+        tx, _ = db.process_event(parser.parse_message('Tea 2'))
+        assert tx.id == 3
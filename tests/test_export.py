@@ -0,0 +1,121 @@
+import gzip
+import json
+import textwrap
+from dataclasses import asdict
+from datetime import datetime
+from decimal import Decimal
+
+import pytz
+
+from beanbot.export import beancount_account, export_file, iter_beancount, iter_json, json_default
+from beanbot.models import Posting, Transaction
+
+
+def make_transactions(count: int):
+    date = datetime(2021, 1, 1, tzinfo=pytz.utc)
+    return [
+        Transaction(
+            id=i,
+            date=date,
+            info=f'Info {i}',
+            postings=[
+                Posting(i * 2, 'Food', 'Cash', Decimal('10.50'), 'USD'),
+                Posting(i * 2 + 1, 'Café "ñ"', 'CC', Decimal('-1'), 'EUR'),
+            ],
+        )
+        for i in range(count)
+    ]
+
+
+class TestExportJSON:
+    def test_same_as_json_dump(self):
+        for count in (0, 1, 3):
+            transactions = make_transactions(count)
+            expected = json.dumps(list(map(asdict, transactions)), default=json_default, indent=4)
+            assert ''.join(iter_json(transactions)) == expected
+
+    def test_compact(self):
+        transactions = make_transactions(3)
+        output = ''.join(iter_json(transactions, compact=True))
+        assert output == json.dumps(
+            list(map(asdict, transactions)), default=json_default, separators=(',', ':')
+        )
+
+    def test_export_file(self):
+        transactions = make_transactions(2000)
+        expected = ''.join(iter_json(transactions)).encode('utf-8')
+
+        with export_file(iter_json(transactions)) as file:
+            assert file.read() == expected
+
+        with export_file(iter_json(transactions), compress=True) as file:
+            assert gzip.decompress(file.read()) == expected
+
+
+class TestExportBeancount:
+    def test_simple_transaction(self):
+        tx = Transaction(
+            id=1,
+            date=datetime(2021, 3, 4, 12, tzinfo=pytz.utc),
+            info='Lunch "menu"',
+            postings=[
+                Posting(1, 'Food', 'Cash', Decimal('10.50'), 'USD'),
+                Posting(2, 'candy bar', 'Cash', Decimal('2'), 'USD'),
+            ],
+        )
+
+        assert ''.join(iter_beancount([tx])) == textwrap.dedent("""\
+            2021-03-04 * "Lunch \\"menu\\""
+              Expenses:Food        10.50 USD
+              Expenses:Candy-bar       2 USD
+              Assets:Cash         -12.50 USD
+
+            2021-03-04 open Assets:Cash
+            2021-03-04 open Expenses:Candy-bar
+            2021-03-04 open Expenses:Food
+            """)
+
+    def test_multiple_currencies_and_credit_accounts(self):
+        txs = [
+            Transaction(
+                id=1,
+                date=datetime(2021, 3, 4, tzinfo=pytz.utc),
+                info='',
+                postings=[
+                    Posting(1, 'Food', 'Cash', Decimal('10'), 'USD'),
+                    Posting(2, 'Candy', 'Cash', Decimal('2'), 'EUR'),
+                    Posting(3, 'Books', 'Liabilities:CC', Decimal('5'), 'USD'),
+                ],
+            ),
+            Transaction(
+                id=2,
+                date=datetime(2021, 3, 5, tzinfo=pytz.utc),
+                info='Empty',
+                postings=[],
+            ),
+        ]
+
+        assert ''.join(iter_beancount(txs)) == textwrap.dedent("""\
+            2021-03-04 * ""
+              Expenses:Food    10 USD
+              Expenses:Candy    2 EUR
+              Expenses:Books    5 USD
+              Assets:Cash     -10 USD
+              Assets:Cash      -2 EUR
+              Liabilities:CC   -5 USD
+
+            2021-03-04 open Assets:Cash
+            2021-03-04 open Expenses:Books
+            2021-03-04 open Expenses:Candy
+            2021-03-04 open Expenses:Food
+            2021-03-04 open Liabilities:CC
+            """)
+
+    def test_empty(self):
+        assert ''.join(iter_beancount([])) == ''
+
+    def test_account_names(self):
+        assert beancount_account('Food', 'Expenses') == 'Expenses:Food'
+        assert beancount_account('Assets:bank account', 'Expenses') == 'Assets:Bank-account'
+        assert beancount_account('café & más!', 'Expenses') == 'Expenses:Café-más'
+        assert beancount_account(' :: ', 'Assets') == 'Assets:Unknown'
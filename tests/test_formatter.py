@@ -1,8 +1,12 @@
 import textwrap
+from datetime import datetime
 from decimal import Decimal
 
-from beanbot.formatter import format_transaction
+import pytz
+
+from beanbot.formatter import format_report, format_search, format_transaction
 from beanbot.models import Posting, Transaction
+from beanbot.search import Match
 
 
 class TestFormatTransaction:
@@ -327,3 +331,81 @@ class TestFormatTransaction:
         """
             ).strip()
         )
+
+    def test_cache_is_invalidated_by_touch(self):
+        tx = Transaction(
+            id=1,
+            date=None,
+            info='',
+            postings=[
+                Posting(
+                    id=1,
+                    debit_account='Food',
+                    credit_account='Cash',
+                    amount=Decimal(10),
+                    currency='USD',
+                )
+            ],
+        )
+
+        formatted = format_transaction(tx, default_currency='USD')
+        assert format_transaction(tx, default_currency='USD') is formatted
+        assert format_transaction(tx) != formatted
+
+        tx.postings[0].amount = Decimal(2)
+        tx.touch()
+
+        assert (
+            format_transaction(tx, default_currency='USD')
+            == textwrap.dedent(
+                """
+        `  2.00 `_Food_
+        `======`
+        `- 2.00 `Cash
+        """
+            ).strip()
+        )
+
+
+def test_format_report():
+    totals = {
+        ('USD', 'Food', 'Cash'): Decimal('12.50'),
+        ('USD', 'Bus', 'Cash'): Decimal(3),
+        ('EUR', 'Food', 'CC'): Decimal(100),
+    }
+    assert (
+        format_report('Report 2021-01', totals)
+        == textwrap.dedent(
+            """
+    Report 2021\\-01
+    `    3.00 USD `_Bus_
+    `  100.00 EUR `_Food_
+    `   12.50 USD `_Food_
+    `========`
+    `- 100.00 EUR `CC
+    `-  15.50 USD `Cash
+    """
+        ).strip()
+    )
+    assert format_report('Report', {}) == 'Report\nThere are no transactions'
+
+
+def test_format_search():
+    matches = [
+        Match(i, i, datetime(2021, 1, i, tzinfo=pytz.utc), '', 'Coffee', Decimal(i), currency)
+        for i, currency in ((1, 'USD'), (2, 'EUR'), (3, 'USD'))
+    ]
+    assert (
+        format_search('coffee', matches, limit=2)
+        == textwrap.dedent(
+            """
+    3 found for coffee, the last 2:
+    `  2.00 EUR `_Coffee_ 2021\\-01\\-02
+    `  3.00 USD `_Coffee_ 2021\\-01\\-03
+    `======`
+    `  2.00 EUR `Total
+    `  4.00 USD `
+    """
+        ).strip()
+    )
+    assert format_search('tea', []) == 'Nothing found for tea'
@@ -0,0 +1,155 @@
+import io
+import textwrap
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+import pytz
+
+from beanbot import importer
+from beanbot.errors import UserError
+from beanbot.export import iter_beancount
+from beanbot.importer import ImportErrors, format_summary, read_file, report_progress
+from beanbot.models import Posting, Transaction, UserConfig
+
+
+CONFIG = UserConfig(timezone='America/Lima', currencies=['PEN', 'USD'], credit_accounts=['CC'])
+
+
+def read(text: str, filename: str, errors=None):
+    file = io.BytesIO(textwrap.dedent(text).encode('utf-8'))
+    return list(read_file(file, filename, CONFIG, errors or ImportErrors()))
+
+
+def postings(tx: Transaction):
+    return [(p.debit_account, p.credit_account, p.amount, p.currency) for p in tx.postings]
+
+
+class TestImportCSV:
+    def test_rows(self):
+        [tx1, tx2] = read(
+            """\
+            Date,Info,Debit_Account,Credit_Account,Amount,Currency
+            2021-03-04,Lunch,Food,Cash,10.50,USD
+            ,,Drinks,,"2",
+            2021-03-05T20:00:00+00:00,,Taxi,,7,
+            """,
+            'ledger.csv',
+        )
+
+        assert tx1.id is None and tx1.info == 'Lunch'
+        assert tx1.date == pytz.timezone('America/Lima').localize(datetime(2021, 3, 4))
+        assert postings(tx1) == [
+            ('Food', 'Cash', Decimal('10.50'), 'USD'),
+            ('Drinks', 'CC', Decimal('2'), 'PEN'),
+        ]
+        assert tx2.date == datetime(2021, 3, 5, 20, tzinfo=pytz.utc)
+        assert postings(tx2) == [('Taxi', 'CC', Decimal('7'), 'PEN')]
+
+    def test_errors(self):
+        errors = ImportErrors(max_errors=2)
+        [tx] = read(
+            """\
+            date,debit_account,amount
+            2021-03-04,Food,ten
+            ,Drinks,2
+            2021-13-01,Food,1
+            2021-03-05,Taxi,7
+            2021-03-06,,7
+            """,
+            'ledger.CSV',
+            errors,
+        )
+
+        assert postings(tx) == [('Taxi', 'CC', Decimal('7'), 'PEN')]
+        assert errors.count == 4
+        assert errors.first == [(2, 'Invalid amount ten'), (3, 'The date is missing')]
+        assert format_summary(1, errors) == (
+            'Imported 1 transactions\n'
+            '4 rows have errors and were skipped:\n'
+            'Line 2: Invalid amount ten\n'
+            'Line 3: The date is missing\n'
+            'And 2 more'
+        )
+
+    def test_missing_columns(self):
+        with pytest.raises(UserError, match='Missing columns: debit_account, amount'):
+            read('date,info\n', 'ledger.csv')
+
+    def test_unknown_format(self):
+        with pytest.raises(UserError, match='Send a .csv file'):
+            importer.file_format('ledger.xlsx')
+        with pytest.raises(UserError, match='too big'):
+            importer.file_format('ledger.csv', importer.MAX_FILE_SIZE + 1)
+
+
+class TestImportBeancount:
+    def test_export_is_read_back(self):
+        date = pytz.utc.localize(datetime(2021, 3, 4, 5))
+        transactions = [
+            Transaction(
+                None,
+                date,
+                'Lunch "menu"',
+                [
+                    Posting(None, 'Food', 'Cash', Decimal('10.50'), 'USD'),
+                    Posting(None, 'Drinks', 'CC', Decimal('2'), 'USD'),
+                    Posting(None, 'Café', 'Cash', Decimal('-1'), 'EUR'),
+                ],
+            ),
+            Transaction(None, date, '', [Posting(None, 'Savings', 'Cash', Decimal(5), 'USD')]),
+        ]
+        text = ''.join(iter_beancount(transactions))
+
+        errors = ImportErrors()
+        imported = read(text, 'ledger.beancount', errors)
+        assert errors.count == 0
+        assert [tx.info for tx in imported] == ['Lunch "menu"', '']
+        assert imported[0].date == pytz.timezone('America/Lima').localize(datetime(2021, 3, 4))
+        assert postings(imported[0]) == postings(transactions[0])
+        assert postings(imported[1]) == postings(transactions[1])
+
+    def test_ledger(self):
+        errors = ImportErrors()
+        [tx1, tx2, tx3] = read(
+            """\
+            option "title" "Ledger"
+            2021-01-01 open Assets:Bank
+
+            2021-03-04 * "Shop" "Groceries" #food
+              receipt: "1234"
+              Expenses:Food       1,200.00 USD
+              ; Paid by card
+              Liabilities:Visa
+            2021-03-05 txn "Salary"
+              Assets:Bank   1000 USD
+              Income:Job   -1000 USD
+            2021-03-06 balance Assets:Bank 1000 USD
+            2021-03-07 ! "Broken"
+              Expenses:Food 10
+              Assets:Cash
+            2021-03-08 * "Trip"
+              Expenses:Hotel  100 USD @ 3.5 PEN
+              Expenses:Taxi    20 PEN
+              Assets:Cash   -100 USD
+              Assets:Cash    -20 PEN
+            """,
+            'ledger.bean',
+            errors,
+        )
+
+        assert tx1.info == 'Shop Groceries'
+        assert postings(tx1) == [('Food', 'Liabilities:Visa', Decimal('1200.00'), 'USD')]
+        assert postings(tx2) == [('Assets:Bank', 'Income:Job', Decimal(1000), 'USD')]
+        assert postings(tx3) == [
+            ('Hotel', 'Cash', Decimal(100), 'USD'),
+            ('Taxi', 'Cash', Decimal(20), 'PEN'),
+        ]
+        assert errors.first == [(14, 'Invalid posting Expenses:Food 10')]
+
+
+def test_report_progress():
+    counts = []
+    transactions = report_progress(range(250), counts.append, interval=0)
+    assert list(transactions) == list(range(250))
+    assert counts == [100, 200]
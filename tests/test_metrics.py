@@ -0,0 +1,138 @@
+import asyncio
+import urllib.error
+import urllib.request
+
+import pytest
+from telegram import Update
+from telegram.ext import ExtBot, Updater
+
+from beanbot import bot, metrics
+from beanbot.metrics import Histogram, MetricsServer, Registry
+from fake_telegram import FakeTelegram, make_message
+
+
+class TestHistogram:
+    def test_quantiles(self):
+        histogram = Histogram()
+        for i in range(1, 101):
+            histogram.observe(i / 1000)
+
+        assert histogram.count == 100
+        assert histogram.sum == pytest.approx(5.05)
+        # Bounded by the width of a bucket
+        assert 0.050 <= histogram.quantile(0.5) < 0.050 * 1.19
+        assert 0.095 <= histogram.quantile(0.95) < 0.095 * 1.19
+        assert 0.099 <= histogram.quantile(0.99) < 0.099 * 1.19
+
+    def test_empty(self):
+        assert Histogram().quantile(0.5) == 0.0
+
+    def test_values_out_of_bounds(self):
+        histogram = Histogram()
+        histogram.observe(0)
+        histogram.observe(10 ** 6)
+
+        assert histogram.quantile(0.5) == metrics.BOUNDS[0]
+        assert histogram.quantile(0.99) == metrics.BOUNDS[-1]
+
+    def test_timer(self):
+        histogram = Histogram()
+        with pytest.raises(ValueError):
+            with histogram.timer():
+                raise ValueError()
+
+        assert histogram.count == 1
+
+
+class TestRegistry:
+    def test_render(self):
+        registry = Registry()
+        registry.histogram('handler_seconds', 'Handlers', handler='b').observe(0.5)
+        registry.histogram('handler_seconds', 'Handlers', handler='a\n"x"').observe(0.25)
+
+        lines = registry.render().splitlines()
+        assert lines[:2] == ['# HELP handler_seconds Handlers', '# TYPE handler_seconds summary']
+        assert lines[2].startswith('handler_seconds{handler="a\\n\\"x\\"",quantile="0.5"} 0.2')
+        assert lines[5:7] == [
+            'handler_seconds_sum{handler="a\\n\\"x\\""} 0.25',
+            'handler_seconds_count{handler="a\\n\\"x\\""} 1',
+        ]
+        assert lines[-1] == 'handler_seconds_count{handler="b"} 1'
+
+    def test_same_labels_share_the_histogram(self):
+        registry = Registry()
+        histogram = registry.histogram('a', '', x='1', y='2')
+        assert registry.histogram('a', '', y='2', x='1') is histogram
+        assert registry.histogram('a', '', x='1') is not registry.histogram('a', '', x='2')
+
+
+class TestTimed:
+    def test_sync(self):
+        @metrics.timed('test_sync_seconds', '')
+        def add(a, b):
+            return a + b
+
+        assert add(1, 2) == 3
+        assert add.__name__ == 'add'
+        assert metrics.registry.histogram('test_sync_seconds', '').count == 1
+
+    def test_async(self):
+        @metrics.timed('test_async_seconds', '')
+        async def add(a, b):
+            await asyncio.sleep(0.01)
+            return a + b
+
+        assert asyncio.run(add(1, 2)) == 3
+        histogram = metrics.registry.histogram('test_async_seconds', '')
+        assert histogram.count == 1
+        assert histogram.sum >= 0.01
+
+    def test_raising(self):
+        @metrics.timed('test_raising_seconds', '')
+        def fail():
+            raise ValueError()
+
+        with pytest.raises(ValueError):
+            fail()
+        assert metrics.registry.histogram('test_raising_seconds', '').count == 1
+
+
+def test_server():
+    metrics.registry.histogram('test_server_seconds', 'Server').observe(1)
+    server = MetricsServer(port=0).start()
+    try:
+        url = f'http://127.0.0.1:{server.port}'
+        with urllib.request.urlopen(f'{url}/metrics') as response:
+            assert response.status == 200
+            assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+            assert 'test_server_seconds_count 1\n' in response.read().decode('utf-8')
+
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(f'{url}/other')
+        assert error.value.code == 404
+    finally:
+        server.stop()
+
+
+@pytest.fixture()
+def telegram():
+    telegram = FakeTelegram().start()
+    yield telegram
+    telegram.stop()
+
+
+def test_handlers_and_telegram_calls_are_timed(telegram):
+    handler = metrics.registry.histogram(
+        'beanbot_handler_seconds', '', handler='handle_text_message'
+    )
+    api = metrics.registry.histogram('beanbot_telegram_seconds', '', method='sendMessage')
+    counts = handler.count, api.count
+
+    request = bot.TimedRequest()
+    updater = Updater(bot=ExtBot('123:TOKEN', base_url=telegram.base_url, request=request))
+    bot.add_handlers(updater.dispatcher)
+    update = Update.de_json(make_message('Coffee 3.5'), updater.bot)
+    updater.dispatcher.process_update(update)
+
+    assert telegram.wait_for('sendMessage', 1)
+    assert (handler.count, api.count) == (counts[0] + 1, counts[1] + 1)
@@ -0,0 +1,71 @@
+import pickle
+from dataclasses import dataclass, field
+from datetime import datetime
+from decimal import Decimal
+from typing import List, Optional
+
+import pytz
+
+from beanbot import models
+from beanbot.models import Posting, Transaction
+
+
+# The models as they were before they had slots
+
+
+@dataclass
+class LegacyPosting:
+    id: Optional[int]
+    debit_account: str
+    credit_account: str
+    amount: Decimal
+    currency: str
+
+
+@dataclass
+class LegacyTransaction:
+    id: Optional[int]
+    date: datetime
+    info: str
+    postings: List[LegacyPosting] = field(default_factory=list)
+
+
+# So they pickle as if they were the models
+for cls, name in [(LegacyPosting, 'Posting'), (LegacyTransaction, 'Transaction')]:
+    cls.__module__ = models.__name__
+    cls.__qualname__ = name
+
+
+class TestModels:
+    def test_pickle_round_trip(self):
+        tx = Transaction(
+            1,
+            datetime(2021, 1, 1, tzinfo=pytz.utc),
+            'Info',
+            postings=[Posting(1, 'Food', 'Cash', Decimal('1.50'), 'USD')],
+        )
+        assert pickle.loads(pickle.dumps(tx)) == tx
+
+    def test_load_legacy_pickle(self, monkeypatch):
+        date = datetime(2021, 1, 1, tzinfo=pytz.utc)
+        legacy = LegacyTransaction(
+            1, date, 'Info', postings=[LegacyPosting(1, 'Food', 'Cash', Decimal('1.50'), 'USD')]
+        )
+
+        with monkeypatch.context() as m:
+            m.setattr(models, 'Posting', LegacyPosting)
+            m.setattr(models, 'Transaction', LegacyTransaction)
+            data = pickle.dumps(legacy)
+
+        tx = pickle.loads(data)
+        assert tx == Transaction(
+            1, date, 'Info', postings=[Posting(1, 'Food', 'Cash', Decimal('1.50'), 'USD')]
+        )
+
+    def test_strings_are_interned(self):
+        account = ''.join(['Ca', 'sh'])
+        posting = Posting(1, 'Food', account, Decimal(1), 'USD')
+        assert posting.credit_account is 'Cash'  # noqa: F632
+
+        posting = pickle.loads(pickle.dumps(Posting(1, 'Food', account, Decimal(1), 'USD')))
+        assert posting.credit_account is 'Cash'  # noqa: F632
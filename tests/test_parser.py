@@ -1,3 +1,4 @@
+from datetime import date
 from decimal import Decimal
 
 import pytest
@@ -5,7 +6,7 @@ from freezegun import freeze_time
 
 from beanbot.errors import UserError
 from beanbot.models import Action, Event
-from beanbot.parser import parse_keyboard_data, parse_message
+from beanbot.parser import parse_date, parse_keyboard_data, parse_message, parse_month
 
 
 invalid_messages = [
@@ -82,6 +83,26 @@ class TestParseEvent:
             with pytest.raises(UserError):
                 parse_message(message)
 
+    def test_parse_batch(self):
+        message = 'Bread 2.5\n\n+Milk 1.20\nEggs 3\n#Groceries\n-0.20\n'
+        assert parse_message(message) == Event(
+            Action.BATCH,
+            [
+                Event(Action.NEW, dict(info='Bread', amount=Decimal('2.5'))),
+                Event(Action.ADD, dict(info='Milk', amount=Decimal('1.20'))),
+                Event(Action.ADD, dict(info='Eggs', amount=Decimal('3'))),
+                Event(Action.SET_INFO, 'Groceries'),
+                Event(Action.FIX_AMOUNT, Decimal('-0.20')),
+            ],
+        )
+        assert parse_message('\nBread 2.5\n') == Event(
+            Action.NEW, dict(info='Bread', amount=Decimal('2.5'))
+        )
+
+    def test_invalid_batch(self):
+        with pytest.raises(UserError, match='Line 2'):
+            parse_message('Bread 2.5\nMilk\nEggs 3')
+
 
 @freeze_time()
 class TestParseKeyboardData:
@@ -101,3 +122,18 @@ class TestParseKeyboardData:
         for data in invalid_data:
             with pytest.raises(ValueError):
                 parse_keyboard_data(data)
+
+
+def test_parse_date():
+    assert parse_date('2021-03-04') == date(2021, 3, 4)
+    for value in ['2021-13-01', '04/03/2021', 'today']:
+        with pytest.raises(UserError):
+            parse_date(value)
+
+
+def test_parse_month():
+    assert parse_month('2021-03') == '2021-03'
+    assert parse_month('2021-3') == '2021-03'
+    for value in ['2021-13', '03/2021', '2021-03-04']:
+        with pytest.raises(UserError):
+            parse_month(value)
@@ -0,0 +1,489 @@
+import contextlib
+import os
+import pickle
+import threading
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import pytest
+import pytz
+
+from beanbot import db as database
+from beanbot.db import DB
+from beanbot.errors import UserError
+from beanbot.models import Action, Event
+from beanbot.persistence import (
+    FLUSH_SECONDS,
+    BackgroundUserData,
+    EventLogPersistence,
+    JournalPersistence,
+    ShardedPersistence,
+    UserPicklePersistence,
+    replay_operations,
+)
+
+
+def new_event(info: str, amount: str, date: datetime) -> Event:
+    return Event(Action.NEW, dict(info=info, amount=Decimal(amount)), date=date)
+
+
+@pytest.fixture()
+def journal_path(tmp_path):
+    return str(tmp_path / 'db.journal')
+
+
+def fill(persistence, user_id: int, count: int):
+    user_data = persistence.get_user_data()
+    db = DB(user_data[user_id])
+    date = datetime(2021, 1, 1, tzinfo=pytz.utc)
+    for i in range(count):
+        tx, posting = db.process_event(new_event(f'Item {i}', '1.50', date))
+        db.update_message_index(i, tx, posting)
+        persistence.update_user_data(user_id, user_data[user_id])
+        date += timedelta(hours=1)
+    return db
+
+
+@contextlib.contextmanager
+def held_in_thread(lock):
+    """Holds `lock` in another thread, like a handler running in the worker pool."""
+    locked, done = threading.Event(), threading.Event()
+
+    def hold():
+        with lock:
+            locked.set()
+            done.wait()
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    locked.wait()
+    try:
+        yield
+    finally:
+        done.set()
+        thread.join()
+
+
+class TestJournalPersistence:
+    def test_replay(self, journal_path):
+        persistence = JournalPersistence(journal_path)
+        db = fill(persistence, 1, 3)
+        db.process_event(Event(Action.DELETE, None, message_id=1))
+        db.process_event(Event(Action.SET_CURRENCY, 1, message_id=2))
+        db.set_config('timezone', 'America/Lima')
+        persistence.update_user_data(1, persistence.get_user_data()[1])
+        persistence.flush()
+
+        restored = DB(JournalPersistence(journal_path).get_user_data()[1])
+
+        assert restored.transactions == db.transactions
+        assert [tx.id for tx in restored.transactions] == [1, 3]
+        assert restored.transactions[1].postings[0].currency == 'EUR'
+        assert restored.message_id_index == db.message_id_index
+        assert restored.next_ids == db.next_ids
+        assert restored.config.timezone == 'America/Lima'
+
+    def test_load_in_background(self, journal_path):
+        persistence = JournalPersistence(journal_path)
+        db = fill(persistence, 1, 3)
+        persistence.flush()
+
+        persistence = JournalPersistence(journal_path)
+        persistence.start_loading()
+        user_data = persistence.get_user_data()
+        assert isinstance(user_data, BackgroundUserData)
+
+        assert DB(user_data[1]).transactions == db.transactions
+        fill(persistence, 2, 2)
+        persistence.compact()
+        assert len(DB(JournalPersistence(journal_path).get_user_data()[2]).transactions) == 2
+
+    def test_only_changes_are_appended(self, journal_path):
+        persistence = JournalPersistence(journal_path)
+        fill(persistence, 1, 100)
+        size = persistence.journal.size
+
+        user_data = persistence.get_user_data()[1]
+        DB(user_data).process_event(Event(Action.SET_INFO, 'Info'))
+        persistence.update_user_data(1, user_data)
+        assert persistence.journal.size - size < 1000
+
+        # Nothing changed
+        size = persistence.journal.size
+        persistence.update_user_data(1, user_data)
+        assert persistence.journal.size == size
+
+    def test_archive(self, journal_path, monkeypatch):
+        monkeypatch.setattr(database, 'ARCHIVE_BLOCK_SIZE', 3)
+        persistence = JournalPersistence(journal_path)
+        date = datetime(2021, 1, 1, tzinfo=pytz.utc)
+        user_data = persistence.get_user_data()
+        db = DB(user_data[1])
+        for i in range(10):
+            db.process_event(new_event(f'Item {i}', '1.50', date + timedelta(days=i)))
+            persistence.update_user_data(1, user_data[1])
+        persistence.flush()
+        assert len(db.archive) == 9
+
+        restored = DB(JournalPersistence(journal_path).get_user_data()[1])
+        assert list(restored.iter_transactions()) == list(db.iter_transactions())
+        assert [tx.id for tx in restored.transactions] == [10]
+
+    def test_flush_interval(self, journal_path):
+        persistence = JournalPersistence(journal_path, flush_interval=3600)
+        fill(persistence, 1, 3)
+        fill(persistence, 2, 2)
+        assert persistence.journal.size == 0
+        assert persistence.dirty == {1, 2}
+
+        # Clean users aren't marked as dirty
+        persistence.flush_dirty()
+        persistence.update_user_data(1, persistence.get_user_data()[1])
+        assert persistence.dirty == set()
+        assert persistence.metrics.last_users == 2
+
+        DB(persistence.get_user_data()[2]).process_event(Event(Action.SET_INFO, 'Info'))
+        persistence.update_user_data(2, persistence.get_user_data()[2])
+        persistence.flush()
+        assert persistence.metrics.cycles == 2
+        assert persistence.metrics.last_users == 1
+
+        user_data = JournalPersistence(journal_path).get_user_data()
+        assert len(DB(user_data[1]).transactions) == 3
+        assert DB(user_data[2]).transactions[-1].info == 'Info'
+
+    def test_clear(self, journal_path):
+        persistence = JournalPersistence(journal_path)
+        fill(persistence, 1, 3)
+        fill(persistence, 2, 2)
+        DB(persistence.get_user_data()[1]).clear()
+        persistence.update_user_data(1, persistence.get_user_data()[1])
+        persistence.flush()
+
+        user_data = JournalPersistence(journal_path).get_user_data()
+        assert DB(user_data[1]).transactions == []
+        assert DB(user_data[1]).message_id_index == {}
+        assert len(DB(user_data[2]).transactions) == 2
+
+    def test_users_being_changed_wait_for_the_next_flush(self, journal_path):
+        persistence = JournalPersistence(journal_path, flush_interval=3600)
+        db = fill(persistence, 1, 1)
+        fill(persistence, 2, 1)
+
+        with held_in_thread(persistence.user_lock(1)):
+            persistence.flush_dirty()
+            assert persistence.dirty == {1}
+            db.process_event(Event(Action.FIX_AMOUNT, Decimal(10)))
+        persistence.flush()
+
+        user_data = JournalPersistence(journal_path).get_user_data()
+        assert DB(user_data[1]).transactions[0].postings[0].amount == Decimal('11.50')
+        assert len(DB(user_data[2]).transactions) == 1
+
+    def test_compaction_waits_for_users_being_changed(self, journal_path, monkeypatch):
+        monkeypatch.setattr(database, 'ARCHIVE_BLOCK_SIZE', 3)
+        persistence = JournalPersistence(
+            journal_path, compact_ratio=0, compact_min_size=0, flush_interval=3600
+        )
+        user_data = persistence.get_user_data()
+        db = DB(user_data[1])
+        for day in range(1, 6):
+            db.process_event(new_event('Item', '1.50', datetime(2021, 1, day, tzinfo=pytz.utc)))
+            persistence.update_user_data(1, user_data[1])
+        assert len(db.archive) and persistence.dirty == {1}
+
+        with held_in_thread(persistence.user_lock(1)):
+            fill(persistence, 2, 1)
+            persistence.flush_dirty()
+            assert persistence.snapshot_size == 0
+        persistence.flush()
+        assert persistence.snapshot_size == persistence.journal.size
+
+        restored = DB(JournalPersistence(journal_path).get_user_data()[1])
+        assert list(restored.iter_transactions()) == list(db.iter_transactions())
+
+    def test_compaction_drops_the_changes_it_writes(self, journal_path):
+        persistence = JournalPersistence(journal_path, flush_interval=3600)
+        fill(persistence, 1, 2)
+        persistence.compact()
+        assert persistence.dirty == set() and not persistence.get_user_data()[1]['changes']
+        persistence.flush()
+
+        restored = DB(JournalPersistence(journal_path).get_user_data()[1])
+        assert len(restored.transactions) == 2
+
+    def test_clear_keeps_pending_values(self, journal_path):
+        persistence = JournalPersistence(journal_path, flush_interval=3600)
+        db = fill(persistence, 1, 3)
+        db.set_config('currencies', ['PEN'])
+        db.clear()
+        persistence.update_user_data(1, persistence.get_user_data()[1])
+        persistence.flush()
+
+        restored = DB(JournalPersistence(journal_path).get_user_data()[1])
+        assert restored.config.currencies == ['PEN']
+        assert restored.next_ids == db.next_ids
+        assert restored.last_event is None
+
+    def test_undo_clear(self, journal_path):
+        persistence = JournalPersistence(journal_path)
+        db = fill(persistence, 1, 3)
+        db.clear()
+        db.undo()
+        persistence.update_user_data(1, persistence.get_user_data()[1])
+        persistence.flush()
+
+        restored = DB(JournalPersistence(journal_path).get_user_data()[1])
+        assert restored.transactions == db.transactions
+        assert restored.message_id_index == db.message_id_index
+
+    def test_compaction(self, journal_path):
+        persistence = JournalPersistence(journal_path, compact_min_size=0)
+        db = fill(persistence, 1, 50)
+        assert persistence.snapshot_size > 0
+        persistence.flush()
+
+        restored = DB(JournalPersistence(journal_path).get_user_data()[1])
+        assert restored.transactions == db.transactions
+        assert restored.message_id_index == db.message_id_index
+
+    def test_truncated_tail_is_discarded(self, journal_path):
+        persistence = JournalPersistence(journal_path)
+        db = fill(persistence, 1, 3)
+        persistence.flush()
+
+        with open(journal_path, 'ab') as file:
+            file.write(b'\x80\x05garbage')
+
+        restored = DB(JournalPersistence(journal_path).get_user_data()[1])
+        assert restored.transactions == db.transactions
+
+
+@pytest.fixture()
+def shards_path(tmp_path):
+    return str(tmp_path / 'db')
+
+
+class TestShardedPersistence:
+    def test_replay(self, shards_path):
+        persistence = ShardedPersistence(shards_path)
+        db = fill(persistence, 1, 3)
+        fill(persistence, 2, 2)
+        db.process_event(Event(Action.DELETE, None, message_id=1))
+        persistence.update_user_data(1, persistence.get_user_data()[1])
+        persistence.flush()
+        assert sorted(os.listdir(shards_path)) == ['1.journal', '2.journal']
+
+        user_data = ShardedPersistence(shards_path).get_user_data()
+        assert len(user_data) == 0
+
+        restored = DB(user_data[1])
+        assert restored.transactions == db.transactions
+        assert restored.message_id_index == db.message_id_index
+        assert restored.next_ids == db.next_ids
+        assert list(user_data) == [1]
+        assert len(DB(user_data[2]).transactions) == 2
+
+    def test_idle_users_are_evicted(self, shards_path):
+        persistence = ShardedPersistence(shards_path, flush_interval=3600, idle_timeout=0)
+        fill(persistence, 1, 3)
+        fill(persistence, 2, 2)
+
+        # Users with changes not written yet stay
+        persistence.evict_idle()
+        assert set(persistence.get_user_data()) == {1, 2}
+
+        persistence.flush_dirty()
+        assert set(persistence.get_user_data()) == set()
+        assert len(DB(persistence.get_user_data()[1]).transactions) == 3
+
+    def test_locks_of_evicted_users_are_dropped(self, shards_path):
+        persistence = ShardedPersistence(shards_path, flush_interval=3600, idle_timeout=3600)
+        fill(persistence, 1, 3)
+        fill(persistence, 2, 2)
+        persistence.flush_dirty()
+        assert set(persistence.user_locks) == {1, 2}
+
+        # A user being changed stays, with its lock
+        persistence.idle_timeout = 0
+        with held_in_thread(persistence.user_lock(2)):
+            persistence.evict_idle()
+            assert set(persistence.user_locks) == {2}
+            assert set(persistence.shards) == {2}
+
+        persistence.evict_idle()
+        assert persistence.user_locks == {}
+        assert persistence.shards == {}
+
+    def test_compaction(self, shards_path):
+        persistence = ShardedPersistence(shards_path, compact_min_size=0)
+        db = fill(persistence, 1, 20)
+        assert persistence.shards[1].snapshot_size > 0
+
+        restored = DB(ShardedPersistence(shards_path).get_user_data()[1])
+        assert restored.transactions == db.transactions
+
+    def test_corrupted_shard_only_affects_its_user(self, shards_path):
+        persistence = ShardedPersistence(shards_path)
+        fill(persistence, 1, 3)
+        fill(persistence, 2, 2)
+        persistence.flush()
+
+        with open(os.path.join(shards_path, '1.journal'), 'r+b') as file:
+            file.truncate(10)
+
+        user_data = ShardedPersistence(shards_path).get_user_data()
+        assert DB(user_data[1]).transactions == []
+        assert len(DB(user_data[2]).transactions) == 2
+
+
+class TestEventLogPersistence:
+    def test_replay(self, shards_path):
+        persistence = EventLogPersistence(shards_path)
+        db = fill(persistence, 1, 6)
+        db.set_config('timezone', 'America/Lima')
+        with pytest.raises(UserError):
+            db.process_event(Event(Action.DELETE, None, message_id=100))
+        db.process_event(Event(Action.DELETE, None, message_id=5))
+        persistence.update_user_data(1, persistence.get_user_data()[1])
+        persistence.flush()
+        assert os.listdir(shards_path) == ['1.log']
+
+        restored = DB(EventLogPersistence(shards_path).get_user_data()[1])
+        assert restored.transactions == db.transactions
+        assert restored.message_id_index == db.message_id_index
+        assert restored.next_ids == db.next_ids
+        assert restored.config.timezone == 'America/Lima'
+
+    def test_stale_button(self, shards_path):
+        persistence = EventLogPersistence(shards_path)
+        db = fill(persistence, 1, 2)
+        db.set_config('currencies', ['PEN'])
+        # Its message still shows the buttons of the previous config
+        with pytest.raises(UserError, match='not in the config'):
+            db.process_event(Event(Action.SET_CURRENCY, 1, message_id=1))
+        persistence.update_user_data(1, persistence.get_user_data()[1])
+        persistence.flush()
+
+        restored = DB(EventLogPersistence(shards_path).get_user_data()[1])
+        assert restored.transactions == db.transactions
+
+    def test_failed_events_are_not_recorded(self, shards_path, monkeypatch):
+        persistence = EventLogPersistence(shards_path)
+        db = fill(persistence, 1, 2)
+        before = db.transactions[1].postings[0].amount
+
+        def fail(tx, posting, field, value):
+            raise IndexError('Bug')
+
+        with monkeypatch.context() as m:
+            # After changing the info
+            m.setattr(db, '_set_posting', fail)
+            with pytest.raises(IndexError):
+                db.process_event(
+                    Event(
+                        Action.BATCH,
+                        [Event(Action.SET_INFO, 'Lunch'), Event(Action.FIX_AMOUNT, Decimal(1))],
+                    )
+                )
+        assert db.transactions[1].info == '' and db.transactions[1].postings[0].amount == before
+        persistence.update_user_data(1, persistence.get_user_data()[1])
+        persistence.flush()
+
+        restored = DB(EventLogPersistence(shards_path).get_user_data()[1])
+        assert restored.transactions == db.transactions
+
+    def test_clear(self, shards_path):
+        persistence = EventLogPersistence(shards_path)
+        db = fill(persistence, 1, 3)
+        db.clear()
+        fill(persistence, 1, 2)
+        persistence.flush()
+
+        restored = DB(EventLogPersistence(shards_path).get_user_data()[1])
+        accounts = [tx.postings[0].debit_account for tx in restored.transactions]
+        assert accounts == ['Item 0', 'Item 1']
+
+    def test_only_operations_are_written(self, shards_path):
+        persistence = EventLogPersistence(shards_path)
+        fill(persistence, 1, 3)
+        persistence.flush()
+
+        records = list(persistence.shards[1].journal.replay())
+        assert [record[0] for record in records] == ['event', 'index'] * 3
+
+    def test_compaction_keeps_old_logs(self, shards_path):
+        persistence = EventLogPersistence(shards_path, compact_min_size=0, keep_logs=2)
+        db = fill(persistence, 1, 5)
+        assert sorted(os.listdir(shards_path)) == ['1.log', '1.log.1', '1.log.2']
+
+        restored = DB(EventLogPersistence(shards_path).get_user_data()[1])
+        assert restored.transactions == db.transactions
+        assert restored.message_id_index == db.message_id_index
+
+    def test_replay_until(self, shards_path):
+        persistence = EventLogPersistence(shards_path)
+        fill(persistence, 1, 3)
+        persistence.flush()
+
+        records = persistence.shards[1].journal.replay()
+        data = replay_operations(records, limit=4)
+        accounts = [tx.postings[0].debit_account for tx in DB(data).transactions]
+        assert accounts == ['Item 0', 'Item 1']
+
+
+@pytest.fixture()
+def pickle_path(tmp_path):
+    return str(tmp_path / 'db.pickle')
+
+
+class TestUserPicklePersistence:
+    def test_replay(self, pickle_path):
+        persistence = UserPicklePersistence(pickle_path)
+        db = fill(persistence, 1, 3)
+        db.process_event(Event(Action.DELETE, None, message_id=1))
+        persistence.update_user_data(1, persistence.get_user_data()[1])
+
+        restored = DB(UserPicklePersistence(pickle_path).get_user_data()[1])
+        assert restored.transactions == db.transactions
+        assert restored.message_id_index == db.message_id_index
+
+    def test_only_changes_are_written(self, pickle_path):
+        persistence = UserPicklePersistence(pickle_path)
+        db = fill(persistence, 1, 3)
+        os.utime(pickle_path, ns=(0, 0))
+
+        persistence.update_user_data(1, persistence.get_user_data()[1])
+        assert os.stat(pickle_path).st_mtime_ns == 0
+
+        count = FLUSH_SECONDS.count
+        db.process_event(Event(Action.SET_INFO, 'Info'))
+        persistence.update_user_data(1, persistence.get_user_data()[1])
+        assert os.stat(pickle_path).st_mtime_ns != 0
+        assert FLUSH_SECONDS.count == count + 1
+
+    def test_reads_ptb_pickles(self, pickle_path):
+        user_data = {}
+        db = DB(user_data)
+        db.process_event(new_event('Coffee', '3.50', datetime(2021, 1, 1, tzinfo=pytz.utc)))
+        with open(pickle_path, 'wb') as file:
+            pickle.dump(dict(user_data={1: user_data}, chat_data={}, bot_data={}), file)
+
+        persistence = UserPicklePersistence(pickle_path)
+        persistence.start_loading()
+        assert DB(persistence.get_user_data()[1]).transactions == db.transactions
+        assert DB(persistence.get_user_data()[2]).transactions == []
+
+    def test_failed_load_keeps_the_file(self, pickle_path):
+        with open(pickle_path, 'wb') as file:
+            file.write(b'not a pickle')
+
+        persistence = UserPicklePersistence(pickle_path)
+        persistence.start_loading()
+        with pytest.raises(RuntimeError):
+            persistence.get_user_data()[1]
+        with pytest.raises(RuntimeError):
+            persistence.flush()
+
+        with open(pickle_path, 'rb') as file:
+            assert file.read() == b'not a pickle'
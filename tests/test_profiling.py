@@ -0,0 +1,68 @@
+import os
+import pstats
+from types import SimpleNamespace
+
+import pytest
+
+from beanbot.profiling import Profiler
+
+
+def make_update(user_id):
+    return SimpleNamespace(effective_user=SimpleNamespace(id=user_id))
+
+
+def handle_update(update, context):
+    return sum(range(1000))
+
+
+def list_profiles(directory):
+    return sorted(f for f in os.listdir(directory) if f.endswith('.pstats'))
+
+
+class TestProfiler:
+    def test_profile_user(self, tmp_path):
+        callback = Profiler(str(tmp_path), user_ids=[1]).wrap(handle_update)
+
+        assert callback(make_update(1), None) == 499500
+        assert callback(make_update(2), None) == 499500
+
+        [filename] = list_profiles(tmp_path)
+        assert filename.endswith('-handle_update-1.pstats')
+        stats = pstats.Stats(str(tmp_path / filename))
+        assert any(name == 'handle_update' for _, _, name in stats.stats)
+
+    def test_sample_rate(self, tmp_path):
+        never = Profiler(str(tmp_path / 'never'), sample_rate=0).wrap(handle_update)
+        always = Profiler(str(tmp_path / 'always'), sample_rate=1).wrap(handle_update)
+        for _ in range(3):
+            never(make_update(1), None)
+            always(make_update(None), None)
+
+        assert list_profiles(tmp_path / 'never') == []
+        assert len(list_profiles(tmp_path / 'always')) == 3
+
+    def test_rotation(self, tmp_path):
+        callback = Profiler(str(tmp_path), sample_rate=1, max_files=2).wrap(handle_update)
+        for _ in range(5):
+            callback(make_update(1), None)
+
+        assert len(list_profiles(tmp_path)) == 2
+
+    def test_one_at_a_time(self, tmp_path):
+        profiler = Profiler(str(tmp_path), sample_rate=1)
+        callback = profiler.wrap(handle_update)
+        with profiler.lock:
+            assert callback(make_update(1), None) == 499500
+
+        assert list_profiles(tmp_path) == []
+
+    def test_errors_are_profiled(self, tmp_path):
+        def fail(update, context):
+            raise ValueError()
+
+        profiler = Profiler(str(tmp_path), sample_rate=1)
+        with pytest.raises(ValueError):
+            profiler.wrap(fail)(make_update(1), None)
+
+        assert len(list_profiles(tmp_path)) == 1
+        assert not profiler.lock.locked()
@@ -0,0 +1,60 @@
+from datetime import datetime
+from decimal import Decimal
+
+import pytz
+
+from beanbot.models import Posting, Transaction
+from beanbot.search import SearchIndex, tokenize
+
+
+def make_transaction(tx_id, day, info, *accounts):
+    return Transaction(
+        tx_id,
+        datetime(2021, 1, day, tzinfo=pytz.utc),
+        info,
+        [
+            Posting(tx_id * 10 + i, account, 'Cash', Decimal(i + 1), 'USD')
+            for i, account in enumerate(accounts)
+        ],
+    )
+
+
+def test_tokenize():
+    assert tokenize('Café con leche, 2x') == {'café', 'con', 'leche', '2x'}
+
+
+def test_search():
+    index = SearchIndex()
+    index.build(
+        [
+            make_transaction(1, 1, 'Starbucks', 'Coffee', 'Cake'),
+            make_transaction(2, 2, '', 'Iced coffee'),
+            make_transaction(3, 3, 'Market', 'Food'),
+        ]
+    )
+
+    assert index.search('coffee') == {1: {10}, 2: {20}}
+    assert index.search('starbucks') == {1: {10, 11}}
+    assert index.search('ICED Coffee') == {2: {20}}
+    assert index.search('coffee tea') == {}
+    assert index.search('') == {}
+
+
+def test_update_and_remove():
+    index = SearchIndex()
+    index.build([])
+    tx = make_transaction(1, 1, 'Starbucks', 'Coffee', 'Cake')
+    index.update(tx)
+
+    tx.info = 'Market'
+    del tx.postings[1]
+    index.update(tx)
+    assert index.search('starbucks') == {}
+    assert index.search('cake') == {}
+    assert index.search('market coffee') == {1: {10}}
+
+    # Only ids are kept, not the postings
+    index.remove(tx)
+    assert index.postings == {}
+    assert index.tx_ids == {}
+    assert index.words == {}
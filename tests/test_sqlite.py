@@ -0,0 +1,293 @@
+import pickle
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import pytest
+import pytz
+
+from beanbot import db as database
+from beanbot.db import DB
+from beanbot.errors import UserError
+from beanbot.models import Action, Event, Posting, Transaction, UserConfig
+from beanbot.persistence import FLUSH_SECONDS
+from beanbot.sqlite import SQLiteDB, SQLiteStorage, migrate
+
+
+def new_event(info: str, amount: str, date: datetime) -> Event:
+    return Event(Action.NEW, dict(info=info, amount=Decimal(amount)), date=date)
+
+
+@pytest.fixture()
+def storage(tmp_path):
+    storage = SQLiteStorage(str(tmp_path / 'db.sqlite3'))
+    yield storage
+    storage.close()
+
+
+@pytest.fixture()
+def sample_db(storage):
+    db = SQLiteDB(storage, 1)
+    db.set_config('timezone', 'America/Lima')
+    tx, posting = db.process_event(
+        new_event('Food', '10.00', datetime(2021, 1, 1, 12, tzinfo=pytz.utc))
+    )
+    db.update_message_index(1, tx, posting)
+    return db
+
+
+class TestSQLiteDB:
+    def test_new_transaction(self, storage, sample_db: SQLiteDB):
+        tx, posting = sample_db.process_event(
+            new_event('Candy', '2.50', datetime(2021, 1, 2, tzinfo=pytz.utc))
+        )
+
+        db = SQLiteDB(storage, 1)
+        assert db.transactions == [sample_db.transactions[0], tx]
+        assert tx.id == 2
+        assert tx.date.tzinfo.zone == 'America/Lima'
+        assert tx.postings == [Posting(2, 'Candy', 'Cash', Decimal('2.50'), 'USD')]
+
+    def test_add_and_fix_amount(self, storage, sample_db: SQLiteDB):
+        date = datetime(2021, 1, 1, 12, 1, tzinfo=pytz.utc)
+        sample_db.process_event(new_event('Candy', '2.50', date))
+        sample_db.process_event(Event(Action.FIX_AMOUNT, Decimal('-0.50'), date=date))
+        sample_db.process_event(Event(Action.SET_INFO, 'Lunch', date=date))
+
+        (tx,) = SQLiteDB(storage, 1).transactions
+        assert tx.info == 'Lunch'
+        assert [p.amount for p in tx.postings] == [Decimal('10.00'), Decimal('2.00')]
+
+    def test_buttons(self, storage, sample_db: SQLiteDB):
+        sample_db.process_event(Event(Action.SET_CURRENCY, 1, message_id=1))
+        sample_db.process_event(Event(Action.SET_CREDIT_ACCOUNT, 1, message_id=1))
+
+        tx, posting = SQLiteDB(storage, 1).get_entries_by_message_id(1)
+        assert posting == Posting(1, 'Food', 'CC', Decimal('10.00'), 'EUR')
+
+        sample_db.process_event(Event(Action.DELETE, None, message_id=1))
+        assert SQLiteDB(storage, 1).transactions == []
+
+    def test_users_are_isolated(self, storage, sample_db: SQLiteDB):
+        other = SQLiteDB(storage, 2)
+        assert other.transactions == []
+        assert other.config == UserConfig()
+        with pytest.raises(UserError):
+            other.get_entries_by_message_id(1)
+
+    def test_clear(self, storage, sample_db: SQLiteDB):
+        sample_db.clear()
+
+        db = SQLiteDB(storage, 1)
+        assert db.transactions == []
+        assert db.next_ids == dict(transaction=2, posting=2)
+        with pytest.raises(UserError):
+            db.get_entries_by_message_id(1)
+
+    def test_undo(self, storage, sample_db: SQLiteDB):
+        date = datetime(2021, 1, 1, 12, 1, tzinfo=pytz.utc)
+        sample_db.process_event(new_event('Candy', '2.50', date))
+        sample_db.process_event(Event(Action.DELETE, None, message_id=1))
+        sample_db.process_event(Event(Action.SET_INFO, 'Lunch', date=date))
+
+        sample_db.undo()
+        [(tx, posting)] = sample_db.undo()
+        assert posting.debit_account == 'Food'
+        assert sample_db.find_message(tx.id, posting.id) == (1, posting.id)
+
+        db = SQLiteDB(storage, 1)
+        (tx,) = db.transactions
+        assert tx.info == ''
+        assert [p.debit_account for p in tx.postings] == ['Food', 'Candy']
+        assert db.get_entries_by_message_id(1)[1] == posting
+
+        sample_db.redo()
+        assert [p.debit_account for p in db.transactions[0].postings] == ['Candy']
+
+    def test_undo_clear(self, storage, sample_db: SQLiteDB):
+        transactions = sample_db.transactions
+        sample_db.clear()
+        sample_db.undo()
+
+        db = SQLiteDB(storage, 1)
+        assert db.transactions == transactions
+        assert db.get_entries_by_message_id(1) == (transactions[0], transactions[0].postings[0])
+
+        sample_db.redo()
+        assert db.transactions == []
+
+    def test_import(self, storage, sample_db: SQLiteDB):
+        date = datetime(2020, 1, 1, 12, tzinfo=pytz.utc)
+        postings = [Posting(None, 'Rent', 'Bank', Decimal(i), 'USD') for i in range(3)]
+        sample_db.import_transactions(
+            Transaction(None, date, f'Rent {i}', [posting]) for i, posting in enumerate(postings)
+        )
+
+        db = SQLiteDB(storage, 1)
+        assert [tx.id for tx in db.transactions] == [1, 2, 3, 4]
+        assert db.transactions[-1].postings[0].id == 4
+        assert db.next_ids == dict(transaction=5, posting=5)
+        assert db.get_totals('2020-01') == {('USD', 'Rent', 'Bank'): Decimal(3)}
+
+        sample_db.undo()
+        assert [tx.info for tx in db.transactions] == ['']
+        sample_db.redo()
+        assert [tx.info for tx in db.transactions][1:] == ['Rent 0', 'Rent 1', 'Rent 2']
+
+        # Events keep working on the transaction before them
+        db = SQLiteDB(storage, 1)
+        assert db.last_transaction_id == 1 and db.last_event is None
+        tx, _ = db.process_event(Event(Action.SET_INFO, 'Lunch', date=date))
+        assert tx.id == 1
+        tx, _ = db.process_event(new_event('Tea', '2', date + timedelta(hours=1)))
+        assert tx.id == 5 and SQLiteDB(storage, 1).last_transaction_id is None
+
+    def test_import_commits_each_block(self, tmp_path, sample_db: SQLiteDB, monkeypatch):
+        monkeypatch.setattr(database, 'IMPORT_BLOCK_SIZE', 2)
+        date = datetime(2020, 1, 1, 12, tzinfo=pytz.utc)
+        other = SQLiteStorage(str(tmp_path / 'db.sqlite3'))
+        imported = []
+
+        def transactions():
+            for i in range(5):
+                # Read outside the transaction, the blocks before are committed
+                imported.append(len(SQLiteDB(other, 1).transactions) - 1)
+                posting = Posting(None, 'Rent', 'Bank', Decimal(1), 'USD')
+                yield Transaction(None, date, f'Rent {i}', [posting])
+
+        assert sample_db.import_transactions(transactions()) == 5
+        assert imported == [0, 0, 2, 2, 4]
+        assert len(SQLiteDB(other, 1).transactions) == 6
+
+        # Still a single step
+        sample_db.undo()
+        assert len(SQLiteDB(other, 1).transactions) == 1
+        other.close()
+
+    def test_nothing_is_copied(self, sample_db: SQLiteDB, monkeypatch):
+        def fail(value):
+            raise AssertionError('Copied')
+
+        monkeypatch.setattr(database, 'copy_event', fail)
+        monkeypatch.setattr(database, 'copy_transaction', fail)
+        monkeypatch.setattr(database.copy, 'deepcopy', fail)
+        sample_db.process_event(Event(Action.SET_INFO, 'Lunch', date=datetime.now(pytz.utc)))
+        sample_db.import_transactions([sample_db.transactions[0]])
+        sample_db.undo()
+        sample_db.undo()
+        assert sample_db.changes is None
+        assert [tx.info for tx in sample_db.transactions] == ['']
+
+    def test_old_schema(self, tmp_path):
+        filename = str(tmp_path / 'old.sqlite3')
+        storage = SQLiteStorage(filename)
+        SQLiteDB(storage, 1).process_event(new_event('Iced coffee', '3', datetime.now(pytz.utc)))
+        # What older versions lacked
+        storage.conn.executescript(
+            'DROP TABLE words; ALTER TABLE users DROP COLUMN last_transaction;'
+        )
+        storage.close()
+
+        storage = SQLiteStorage(filename)
+        db = SQLiteDB(storage, 1)
+        assert db.last_entries[0].id == 1
+        assert [m.account for m in db.search('coffee')] == ['Iced coffee']
+        storage.close()
+
+
+def test_migrate(tmp_path, storage):
+    user_data = {}
+    db = DB(user_data)
+    date = datetime(2021, 1, 1, tzinfo=pytz.utc)
+    for i in range(3):
+        tx, posting = db.process_event(new_event(f'Item {i}', '1.00', date))
+        db.update_message_index(10 + i, tx, posting)
+        date += timedelta(days=1)
+
+    filename = tmp_path / 'db.pickle'
+    with open(filename, 'wb') as file:
+        pickle.dump(dict(user_data={42: user_data}), file)
+
+    assert migrate(str(filename), storage) == 1
+
+    migrated = SQLiteDB(storage, 42)
+    assert migrated.transactions == db.transactions
+    assert migrated.next_ids == db.next_ids
+    assert migrated.last_event == db.last_event
+    assert migrated.get_entries_by_message_id(11) == (
+        db.transactions[1],
+        db.transactions[1].postings[0],
+    )
+
+
+def test_message_index_is_bounded(storage):
+    db = SQLiteDB(storage, 1, message_index_size=2)
+    tx, posting = db.process_event(
+        new_event('Food', '10.00', datetime(2021, 1, 1, 12, tzinfo=pytz.utc))
+    )
+    for message_id in range(1, 4):
+        db.update_message_index(message_id, tx, posting)
+
+    with pytest.raises(UserError):
+        db.get_entries_by_message_id(1)
+    assert db.get_entries_by_message_id(3) == (tx, posting)
+
+    db.process_event(Event(Action.COMMIT, None, message_id=3))
+    with pytest.raises(UserError):
+        db.get_entries_by_message_id(2)
+
+
+def test_iter_transactions_between_dates(storage):
+    db = SQLiteDB(storage, 1)
+    for day in (1, 2, 5):
+        db.process_event(new_event(f'Day {day}', '1', datetime(2021, 1, day, tzinfo=pytz.utc)))
+
+    txs = db.iter_transactions(
+        datetime(2021, 1, 2, tzinfo=pytz.utc), datetime(2021, 1, 5, tzinfo=pytz.utc)
+    )
+    assert [tx.postings[0].debit_account for tx in txs] == ['Day 2']
+
+
+def test_totals(storage):
+    db = SQLiteDB(storage, 1)
+    for month, day in ((1, 1), (1, 2), (2, 1)):
+        db.process_event(new_event('Food', '1.50', datetime(2021, month, day, tzinfo=pytz.utc)))
+
+    assert db.get_totals('2021-01') == {('USD', 'Food', 'Cash'): Decimal(3)}
+    assert db.get_totals() == {('USD', 'Food', 'Cash'): Decimal('4.50')}
+
+
+def test_commits_are_timed(storage):
+    db = SQLiteDB(storage, 1)
+    count = FLUSH_SECONDS.count
+    db.process_event(new_event('Coffee', '3', datetime(2021, 1, 1, tzinfo=pytz.utc)))
+    assert FLUSH_SECONDS.count == count + 1
+
+    with pytest.raises(UserError):
+        db.process_event(Event(Action.DELETE, None, message_id=1))
+    assert FLUSH_SECONDS.count == count + 1
+
+
+def test_search(storage):
+    db = SQLiteDB(storage, 1)
+    for day, info in ((1, 'Coffee'), (2, 'Food'), (3, 'Iced coffee')):
+        db.process_event(new_event(info, '1.50', datetime(2021, 1, day, tzinfo=pytz.utc)))
+
+    assert [m.account for m in db.search('coffee')] == ['Coffee', 'Iced coffee']
+    matches = db.search('coffee', None, datetime(2021, 1, 2, tzinfo=pytz.utc))
+    assert [m.account for m in matches] == ['Coffee']
+
+    # The words are kept up to date
+    date = datetime(2021, 1, 4, tzinfo=pytz.utc)
+    db.process_event(Event(Action.SET_INFO, 'Breakfast', date=date))
+    assert [m.info for m in db.search('breakfast coffee')] == ['Breakfast']
+    db.undo()
+    assert db.search('breakfast') == []
+    db.clear()
+    assert db.search('coffee') == []
+    db.undo()
+    assert len(db.search('coffee')) == 2
+    posting = Posting(None, 'Coffee', 'Bank', Decimal(1), 'USD')
+    db.import_transactions([Transaction(None, date, '', [posting])])
+    assert [m.date for m in db.search('coffee', date)] == [date]
+    db.undo()
+    assert db.search('coffee', date) == []
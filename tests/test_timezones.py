@@ -0,0 +1,38 @@
+from datetime import datetime
+
+import pytest
+
+from beanbot import timezones
+from beanbot.errors import UserError
+from beanbot.models import UserConfig
+
+
+@pytest.fixture(params=timezones.BACKENDS)
+def backend(request):
+    timezones.set_backend(request.param)
+    yield request.param
+    timezones.set_backend('pytz')
+
+
+class TestTimezones:
+    def test_tzinfo_is_cached(self, backend):
+        config = UserConfig(timezone='America/Lima')
+        assert config.tzinfo is config.tzinfo
+        assert config.tzinfo is UserConfig(timezone='America/Lima').tzinfo
+
+        config.timezone = 'Europe/Madrid'
+        assert config.tzinfo is timezones.get_timezone('Europe/Madrid')
+
+    def test_invalid_timezone(self, backend):
+        for name in ['Mars/Olympus', '../etc', '']:
+            with pytest.raises(UserError):
+                timezones.get_timezone(name)
+
+    def test_localize(self, backend):
+        tz = timezones.get_timezone('America/Lima')
+        value = timezones.localize(datetime(2021, 1, 1), tz)
+        assert value.utcoffset().total_seconds() == -5 * 3600
+
+    def test_backend(self, backend):
+        tz = timezones.get_timezone('UTC')
+        assert type(tz).__module__.split('.')[0] == backend
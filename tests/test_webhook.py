@@ -0,0 +1,98 @@
+import threading
+
+import pytest
+from telegram.ext import Updater
+
+from beanbot import bot
+from beanbot.webhook import WebhookServer
+from fake_telegram import FakeTelegram, make_callback_query, make_message, post_update
+
+
+@pytest.fixture()
+def telegram():
+    telegram = FakeTelegram().start()
+    yield telegram
+    telegram.stop()
+
+
+def start_server(dispatcher, **kwargs) -> WebhookServer:
+    server = WebhookServer(dispatcher, port=0, url_path='/hook', **kwargs)
+    server.start()
+    return server
+
+
+@pytest.fixture()
+def webhook(telegram):
+    updater = Updater('123:TOKEN', base_url=telegram.base_url)
+    bot.add_handlers(updater.dispatcher)
+    server = start_server(updater.dispatcher, workers=2)
+    yield f'http://127.0.0.1:{server.port}/hook'
+    server.stop()
+
+
+def test_webhook(telegram, webhook):
+    assert post_update(webhook, make_message('Coffee 3.5', update_id=1)) == 200
+    [message] = telegram.wait_for('sendMessage', 1)
+    assert int(message['chat_id']) == 1
+    assert message['text'] == '`  3.50 `_Coffee_\n`======`\n`- 3.50 `Cash'
+
+    assert post_update(webhook, make_callback_query('cur_1', 1000, update_id=2)) == 200
+    [edit] = telegram.wait_for('editMessageText', 1)
+    assert 'EUR' in edit['text']
+
+    assert post_update(webhook, make_message('/json', update_id=3)) == 200
+    [document] = telegram.wait_for('sendDocument', 1)
+    assert document['document']['filename'].endswith('.json')
+    assert b'"amount": "3.5"' in document['document']['content']
+
+
+def test_updates_of_a_user_are_handled_in_order(telegram, webhook):
+    threads = [
+        threading.Thread(
+            target=post_update,
+            args=(webhook, make_message(f'+Item {i}', update_id=i, user_id=1 + i % 2)),
+        )
+        for i in range(1, 21)
+    ]
+    for thread in threads:
+        thread.start()
+        thread.join()
+
+    messages = telegram.wait_for('sendMessage', 20)
+    for user_id in (1, 2):
+        last = [m['text'] for m in messages if int(m['chat_id']) == user_id][-1]
+        assert last.count('_Item_') == 10
+
+
+def test_bad_requests(webhook):
+    assert post_update(webhook.replace('/hook', '/other'), make_message('Coffee 3.5')) == 404
+    assert post_update(webhook, 'not an update') == 400
+    assert post_update(webhook, None) == 400
+
+
+def test_full_queue_is_rejected():
+    release = threading.Event()
+    processed = []
+
+    class Dispatcher:
+        bot = None
+
+        def process_update(self, update):
+            release.wait()
+            processed.append(update.update_id)
+
+    server = start_server(Dispatcher(), workers=1, queue_size=2)
+    url = f'http://127.0.0.1:{server.port}/hook'
+    try:
+        # The first one is taken by the worker, the next two fill the queue
+        assert post_update(url, make_message('A 1', update_id=1)) == 200
+        while not server.queues[0].empty():
+            pass
+        assert post_update(url, make_message('A 2', update_id=2)) == 200
+        assert post_update(url, make_message('A 3', update_id=3)) == 200
+        assert post_update(url, make_message('A 4', update_id=4)) == 503
+    finally:
+        release.set()
+        server.stop()
+
+    assert processed == [1, 2, 3]